@@ -0,0 +1,317 @@
+'''
+DolphinConnection for asyncio, without gevent.
+
+Offers the same commands as DolphinConnection. Reads and loads return
+futures to await, and subscriptions are async iterators:
+
+    dolphin = AsyncDolphinConnection("localhost", 6000)
+    await dolphin.connect()
+    money = await dolphin.read32(0x80401234)
+    async for hp in dolphin.subscribe16(0x80405678):
+        print(hp)
+'''
+
+from __future__ import print_function, division
+
+import time
+import asyncio
+
+from .protocol import (BaseConnection, LineBuffer, DisconnectReason, logger,
+                       DolphinTimeout, DolphinNotConnected, _logCallbackError)
+
+_closed = object()
+
+
+class AsyncRequest(asyncio.Future):
+    '''
+    Future of a command that gets answered by Dolphin.
+    Cancelling it discards the answer once it arrives.
+    '''
+    def __init__(self, loop, callback=None, timeout=None):
+        asyncio.Future.__init__(self, loop=loop)
+        self.callback = callback
+        self._timer = None
+        if timeout is not None:
+            self._timer = loop.call_later(timeout, self._expire)
+
+    def _resolve(self, value):
+        if self.done():
+            return False
+        self._stopTimer()
+        self.set_result(value)
+        return True
+
+    def _fail(self, exception):
+        if self.done():
+            return False
+        self._stopTimer()
+        self.set_exception(exception)
+        return True
+
+    def _link(self, func):
+        self.add_done_callback(func)
+
+    def _outcome(self):
+        if self.cancelled():
+            return asyncio.CancelledError(), None
+        exception = self.exception()
+        if exception is not None:
+            return exception, None
+        return None, self.result()
+
+    def _expire(self):
+        self._timer = None
+        self._fail(DolphinTimeout("Dolphin did not answer in time."))
+
+    def _stopTimer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class Subscription(object):
+    '''
+    Async iterator over the values of a subscription.
+    close() unsubscribes and ends the iteration. If the connection gets
+    lost, the iteration raises DolphinNotConnected once the values
+    received before are through. disconnect() ends it like close().
+    '''
+    def __init__(self, connection, addr, multi):
+        self._conn = connection
+        self._addr = addr
+        self._multi = multi
+        self._queue = asyncio.Queue()
+        # set once subscribed
+        self._listener = None
+        # exception ending the iteration, once ended
+        self._end = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._end is not None and self._queue.empty():
+            raise self._end
+        val = await self._queue.get()
+        if val is _closed:
+            raise self._end
+        return val
+
+    def close(self):
+        '''
+        Unsubscribes from the address, if still connected, and ends the
+        iteration.
+        '''
+        self._finish(StopAsyncIteration())
+
+    def _put(self, val):
+        self._queue.put_nowait(val)
+
+    def _finish(self, exception):
+        if self._end is not None:
+            return
+        self._end = exception
+        self._conn._subscriptions.discard(self)
+        if self._listener is not None:
+            self._conn.unsubscribe(self._listener)
+        self._queue.put_nowait(_closed)
+
+
+class _StreamProtocol(asyncio.Protocol):
+    def __init__(self, connection):
+        self._conn = connection
+        self._lines = LineBuffer()
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        conn = self._conn
+        metrics = conn._metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        lines = self._lines.feed(data)
+        for line in lines:
+            conn._process(line)
+        if metrics is not None:
+            metrics._received(len(data), len(lines), False,
+                              time.perf_counter() - start)
+
+    def connection_lost(self, exc):
+        conn = self._conn
+        if conn._transport is not self._transport:
+            return
+        if exc is None:
+            logger.info("DolphinConnection connection closed by peer.")
+            conn._disconnect(DisconnectReason.CONNECTION_CLOSED_BY_PEER)
+        else:
+            logger.warning("DolphinConnection connection lost.")
+            conn._disconnect(DisconnectReason.CONNECTION_LOST)
+
+
+class AsyncDolphinConnection(BaseConnection):
+    def __init__(self, host="localhost", port=6000, flushSize=16384):
+        '''
+        Creating a new AsyncDolphinConnection instance,
+        pointing to the DolphinConnection Server specified by host and port.
+        The connection must be established explicitly with connect(), from
+        within a running event loop.
+
+        host and port can be overwritten, followed by another connect()
+        call to reconnect.
+        :param flushSize: outgoing commands are buffered and written at the
+                          end of the current event loop iteration, or as
+                          soon as this many bytes are buffered
+        '''
+        BaseConnection.__init__(self, host, port, flushSize)
+        self._loop = None
+        self._transport = None
+        # Subscriptions still iterated, ended on disconnecting
+        self._subscriptions = set()
+
+    async def connect(self):
+        '''
+        Tries to establish a new connection to the server. Disconnects any
+        existing connection first.
+        If it succeeds, the onConnect callback will be called.
+        If it fails, the onDisconnect callback will be called.
+        Returns whether the connection got established.
+        Commands issued while connecting get sent once connected.
+        '''
+        self.disconnect()
+        self._loop = asyncio.get_running_loop()
+        self._transport = None
+        self._connected = True
+        try:
+            self._transport, _ = await self._loop.create_connection(
+                lambda: _StreamProtocol(self), self.host, self.port)
+        except OSError:
+            logger.info("DolphinConnection connection to %s:%d failed.",
+                        self.host, self.port)
+            self._disconnect(DisconnectReason.CONNECTION_NOT_ESTABLISHED)
+            return False
+        logger.info("DolphinConnection connection to %s:%d established! " +
+                    "Ready for work!", self.host, self.port)
+        self.flush()
+        if self._cFunc:
+            self._cFunc(self)
+        return True
+
+    def flush(self):
+        '''
+        Writes all buffered commands to the transport now instead of at the
+        end of the current event loop iteration.
+        '''
+        self._flushScheduled = False
+        # still connecting, connect() flushes once connected
+        if self._transport is None:
+            return
+        if self._out and self._connected:
+            if self._metrics is not None:
+                self._metrics._sent(len(self._out))
+            self._transport.write(bytes(self._out))
+            del self._out[:]
+            self._sendStats["sends"] += 1
+
+    def subscribe8(self, addr):
+        '''
+        Sends a command to send back 8 bytes of data at the given address,
+        repeating each time the value changes.
+        Returns a Subscription to iterate the values with async for.
+        '''
+        return self._subscribeIter(8, addr)
+
+    def subscribe16(self, addr):
+        '''
+        Sends a command to send back 16 bytes of data at the given address,
+        repeating each time the value changes.
+        Returns a Subscription to iterate the values with async for.
+        '''
+        return self._subscribeIter(16, addr)
+
+    def subscribe32(self, addr):
+        '''
+        Sends a command to send back 32 bytes of data at the given address,
+        repeating each time the value changes.
+        Returns a Subscription to iterate the values with async for.
+        '''
+        if addr % 4 != 0:
+            raise ValueError("Read address must be whole word; " +
+                             "multiple of 4")
+        return self._subscribeIter(32, addr)
+
+    def subscribeMulti(self, size, addr):
+        '''
+        Sends a command to send back <size> bytes of data starting at the
+        given address,
+        repeating each time any value changes. Useful for strings or arrays.
+        Returns a Subscription to iterate the values, as bytes objects,
+        with async for.
+        Older versions gave a list of ints instead, use list(data) where
+        one is still needed.
+        '''
+        subscription = Subscription(self, addr, True)
+        subscription._listener = self._subscribeMulti(size, addr,
+                                                      subscription._put)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def load(self, filename, timeout=None):
+        '''
+        Tells Dolphin to load the savestate located at <filename>.
+        Returns a future resolving to true if it succeeded, else false.
+        CAUTION: Will never resolve if dolphin was paused and no timeout is
+                 given :(
+        :param timeout: seconds after which the future fails with
+                        DolphinTimeout
+        '''
+        return self._load(filename, timeout)
+
+    ######################################
+    # private methods below
+
+    def _subscribeIter(self, mode, addr):
+        subscription = Subscription(self, addr, False)
+        subscription._listener = self._subscribe(mode, addr,
+                                                 subscription._put)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def _disconnect(self, reason):
+        BaseConnection._disconnect(self, reason)
+        for subscription in list(self._subscriptions):
+            if reason == DisconnectReason.CONNECTION_CLOSED_BY_HOST:
+                subscription._finish(StopAsyncIteration())
+            else:
+                subscription._finish(DolphinNotConnected(
+                    "DolphinConnection lost its connection."))
+
+    def _sendRest(self, data):
+        # the transport writes out what it buffered before closing
+        if self._transport is None or self._transport.is_closing():
+            return False
+        self._transport.write(data)
+        if self._metrics is not None:
+            self._metrics._sent(len(data))
+        return True
+
+    def _close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    def _newRequest(self, callback=None, timeout=None):
+        return AsyncRequest(self._loop, callback, timeout)
+
+    def _scheduleFlush(self):
+        self._loop.call_soon(self.flush)
+
+    def _dispatch(self, addr, callback, val):
+        self._loop.call_soon(_runCallback, callback, val)
+
+
+def _runCallback(callback, val):
+    try:
+        callback(val)
+    except Exception as e:
+        _logCallbackError(e)
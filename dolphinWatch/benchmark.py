@@ -0,0 +1,841 @@
+'''
+Throughput benchmarks for DolphinConnection.
+
+Run with `python -m dolphinWatch.benchmark`, or with `--json FILE` to
+write the results as JSON, to compare them between releases. With
+`--baseline REV` it compares the receive loop and the parser with those
+of the package at the git revision REV instead, e.g. the first commit,
+which needs a git checkout. The
+micro benchmarks feed a synthetic stream of DolphinWatch messages through
+a local socket pair, the workloads run against a FakeDolphinServer, and
+the replays serve a recorded trace through a ReplayServer, so no running
+Dolphin is needed.
+'''
+
+from __future__ import print_function, division
+
+import os
+import sys
+import shutil
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tarfile
+import subprocess
+import tracemalloc
+
+import gevent
+import gevent.event
+from gevent import socket
+
+from . import DolphinConnection, DispatchMode, Framing
+from .dispatch import Overflow
+from .testing import FakeDolphinServer, ReplayServer, encodeMemMulti
+from .trace import TraceRecorder, TraceReader
+from .triggers import below
+
+
+# name -> import statement measured by benchImport()
+IMPORTS = {
+    "package":  "import dolphinWatch",
+    "buttons":  "from dolphinWatch import GCPadButtons",
+    "protocol": "from dolphinWatch import DolphinNotConnected",
+    "gevent":   "from dolphinWatch import DolphinConnection",
+    "asyncio":  "from dolphinWatch import AsyncDolphinConnection",
+}
+
+_importScript = """
+import sys, time, tracemalloc
+if %(traced)r:
+    tracemalloc.start()
+before = set(sys.modules)
+start = time.perf_counter()
+%(statement)s
+elapsed = time.perf_counter() - start
+print(elapsed, tracemalloc.get_traced_memory()[1],
+      len(set(sys.modules) - before), "gevent" in sys.modules)
+"""
+
+
+# measures the receive loop and the parser of whatever dolphinWatch is
+# importable, old revisions included: those split str lines, and spawn a
+# greenlet for every callback instead of calling _dispatch
+_baselineScript = """
+import sys, json, time
+import gevent
+from gevent import socket
+import dolphinWatch
+
+class Spawned(object):
+    def link_exception(self, func):
+        pass
+
+def feed(sock, data):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+def memMulti(addr, size):
+    return ("MEM_MULTI %%d %%s" %% (addr, " ".join(
+        str((addr + i) %% 256) for i in range(size)))).encode()
+
+def recv(lines, size):
+    data = (memMulti(0x80000000, size) + b"\\n") * lines
+    conn = dolphinWatch.DolphinConnection()
+    received = []
+    conn._process = received.append
+    a, b = socket.socketpair()
+    conn._sock = a
+    conn._connected = True
+    feeder = gevent.spawn(feed, b, data)
+    start = time.perf_counter()
+    conn._recv()
+    elapsed = time.perf_counter() - start
+    feeder.join()
+    assert len(received) == lines
+    return lines / elapsed
+
+def ignore(val):
+    pass
+
+def parse(lines, size):
+    pattern = [b"MEM %%d %%d" %% (0x80000000 + 4 * i, i * 7919 %% 65536)
+               for i in range(6)]
+    pattern += [memMulti(0x80001000, size), b"LOG 5 frame advanced"]
+    stream = [pattern[i %% len(pattern)] for i in range(lines)]
+    conn = dolphinWatch.DolphinConnection()
+    # subscribed like any user would, the commands go nowhere
+    a, b = socket.socketpair()
+    conn._sock = a
+    conn._connected = True
+    conn._scheduleFlush = lambda: None
+    for i in range(6):
+        conn.subscribe32(0x80000000 + 4 * i, ignore)
+    conn.subscribeMulti(size, 0x80001000, ignore)
+    conn._dispatch = lambda addr, callback, val: None
+    gevent.spawn = lambda *args: Spawned()
+    try:
+        conn._process(stream[0])
+    except TypeError:
+        stream = [line.decode() for line in stream]
+    start = time.perf_counter()
+    for line in stream:
+        conn._process(line)
+    return lines / (time.perf_counter() - start)
+
+# the best of a few runs, the least disturbed by anything else running
+print(json.dumps({
+    "recv": dict((size, max(recv(max(20000, 2000000 // size), size)
+                            for _ in range(%(runs)d)))
+                 for size in %(recvSizes)r),
+    "parse": dict((size, max(parse(100000, size) for _ in range(%(runs)d)))
+                  for size in %(parseSizes)r),
+}))
+"""
+
+
+def _memMultiLine(addr, size):
+    return ("MEM_MULTI %d %s\n" % (addr, " ".join(
+        str((addr + i) % 256) for i in range(size)))).encode()
+
+
+def _mixedLines(count, size):
+    # roughly what a busy subscription set looks like: mostly MEM updates,
+    # some MEM_MULTI blocks and the odd LOG line
+    pattern = [b"MEM %d %d" % (0x80000000 + 4 * i, i * 7919 % 65536)
+               for i in range(6)]
+    pattern += [_memMultiLine(0x80001000, size).rstrip(),
+                b"LOG 5 frame advanced"]
+    return [pattern[i % len(pattern)] for i in range(count)]
+
+
+def _feed(sock, data):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def benchRecv(lines=100000, size=256, readSize=16384):
+    '''
+    Measures how many lines per second the receive loop can split off the
+    socket. Lines are counted but not parsed.
+    :param lines: number of MEM_MULTI lines to send
+    :param size: number of bytes per MEM_MULTI line
+    :param readSize: readSize of the DolphinConnection under test
+    :return: lines per second
+    '''
+    data = _memMultiLine(0x80000000, size) * lines
+    conn = DolphinConnection(readSize=readSize)
+    received = []
+    conn._process = received.append
+    a, b = socket.socketpair()
+    conn._sock = a
+    conn._connected = True
+    feeder = gevent.spawn(_feed, b, data)
+    start = time.perf_counter()
+    conn._recv()
+    elapsed = time.perf_counter() - start
+    feeder.join()
+    b.close()
+    assert len(received) == lines
+    return lines / elapsed
+
+
+def benchParse(lines=100000, size=64):
+    '''
+    Measures how many mixed MEM/MEM_MULTI/LOG lines per second _process can
+    parse. Callbacks are subscribed but dispatched to a stub, so only the
+    parser is measured.
+    :param lines: number of lines to parse
+    :param size: number of bytes per MEM_MULTI line
+    :return: lines per second
+    '''
+    stream = _mixedLines(lines, size)
+    conn = DolphinConnection(flushSize=1 << 30)
+    _offline(conn)
+    for i in range(6):
+        conn.subscribe32(0x80000000 + 4 * i, _ignore)
+    conn.subscribeMulti(size, 0x80001000, _ignore)
+    conn._dispatch = lambda addr, callback, val: None
+    start = time.perf_counter()
+    for line in stream:
+        conn._process(line)
+    return lines / (time.perf_counter() - start)
+
+
+def benchDispatch(dispatch, lines=100000):
+    '''
+    Measures end-to-end MEM messages per second, from the socket to the
+    callback, for the given DispatchMode.
+    :return: messages per second
+    '''
+    addrs = [0x80000000 + 4 * i for i in range(64)]
+    data = b"".join(b"MEM %d %d\n" % (addrs[i % len(addrs)], i)
+                    for i in range(lines))
+    conn = DolphinConnection(dispatch=dispatch, flushSize=1 << 30)
+    _offline(conn)
+    done = gevent.event.Event()
+    count = [0]
+
+    def callback(val):
+        count[0] += 1
+        if count[0] == lines:
+            done.set()
+    for addr in addrs:
+        conn.subscribe32(addr, callback)
+    a, b = socket.socketpair()
+    conn._sock = a
+    feeder = gevent.spawn(_feed, b, data)
+    start = time.perf_counter()
+    receiver = gevent.spawn(conn._recv)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    receiver.join()
+    feeder.join()
+    b.close()
+    return lines / elapsed
+
+
+def benchTriggers(trigger, lines=100000, every=100):
+    '''
+    Measures MEM messages per second from the socket to the callback when
+    only every <every>-th value is of interest, with SPAWN dispatch.
+    :param trigger: whether to use a trigger, or a subscription whose
+                    callback returns early for the other values
+    :return: (messages per second, callbacks dispatched)
+    '''
+    addrs = [0x80000000 + 4 * i for i in range(64)]
+    # the last value is of interest, so all are handled once it arrives
+    values = [(lines - 1 - i) % every for i in range(lines)]
+    data = b"".join(b"MEM %d %d\n" % (addrs[i % len(addrs)], values[i])
+                    for i in range(lines))
+    expected = values.count(0)
+    conn = DolphinConnection(dispatch=DispatchMode.SPAWN,
+                             flushSize=1 << 30)
+    _offline(conn)
+    done = gevent.event.Event()
+    count = [0, 0]
+
+    def callback(val):
+        count[1] += 1
+        if val >= 1:
+            return
+        count[0] += 1
+        if count[0] == expected:
+            done.set()
+    for addr in addrs:
+        if trigger:
+            conn.trigger(16, addr, below(1), callback)
+        else:
+            conn.subscribe16(addr, callback)
+    a, b = socket.socketpair()
+    conn._sock = a
+    feeder = gevent.spawn(_feed, b, data)
+    start = time.perf_counter()
+    receiver = gevent.spawn(conn._recv)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    receiver.join()
+    feeder.join()
+    b.close()
+    return lines / elapsed, count[1]
+
+
+def benchStall(overflow=None, lines=100000, stall=0.2, highWatermark=1000,
+               dispatch=DispatchMode.BATCH):
+    '''
+    Measures the memory used while the callback stalls for <stall> seconds
+    at its first call and MEM messages keep arriving, e.g. during a GC
+    pause or a slow database write.
+    :param overflow: Overflow policy at <highWatermark> pending callbacks,
+                     None for no limit
+    :return: dict of the peak bytes allocated, callbacks run, seconds until
+             all were done, and the dispatch stats
+    '''
+    addrs = [0x80000000 + 4 * i for i in range(64)]
+    data = b"".join(b"MEM %d %d\n" % (addrs[i % len(addrs)], i)
+                    for i in range(lines))
+    if overflow is None:
+        conn = DolphinConnection(dispatch=dispatch, flushSize=1 << 30)
+    else:
+        conn = DolphinConnection(dispatch=dispatch, flushSize=1 << 30,
+                                 highWatermark=highWatermark,
+                                 overflow=overflow)
+    _offline(conn)
+    count = [0]
+
+    def callback(val):
+        if not count[0]:
+            gevent.sleep(stall)
+        count[0] += 1
+    for addr in addrs:
+        conn.subscribe32(addr, callback)
+    a, b = socket.socketpair()
+    conn._sock = a
+    tracemalloc.start()
+    feeder = gevent.spawn(_feed, b, data)
+    start = time.perf_counter()
+    receiver = gevent.spawn(conn._recv)
+    receiver.join()
+    while conn._dispatcher.pending:
+        gevent.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    feeder.join()
+    b.close()
+    return {"peakBytes": peak, "callbacks": count[0], "seconds": elapsed,
+            "dispatch": conn.dispatchStats()}
+
+
+def benchFraming(binary, messages=50000, size=256, blocks=16):
+    '''
+    Measures MEM_MULTI messages per second from the socket to the callback
+    with text or binary framing. Callbacks are not dispatched, so only
+    splitting and decoding are measured.
+    :param binary: whether to use binary framing
+    :param size: number of bytes per MEM_MULTI message
+    :param blocks: number of different subscribed addresses
+    :return: (messages per second, bytes on the wire per message)
+    '''
+    addrs = [0x80000000 + size * i for i in range(blocks)]
+    encoded = [encodeMemMulti(addr, bytes((addr + i) % 256
+                                          for i in range(size)), binary)
+               for addr in addrs]
+    data = b"".join(encoded[i % blocks] for i in range(messages))
+    conn = DolphinConnection(flushSize=1 << 30)
+    _offline(conn)
+    count = [0]
+
+    def dispatch(addr, callback, val):
+        count[0] += 1
+    conn._dispatch = dispatch
+    for addr in addrs:
+        conn.subscribeMulti(size, addr, _ignore)
+    a, b = socket.socketpair()
+    conn._sock = a
+    conn._framing = Framing.BINARY if binary else Framing.TEXT
+    feeder = gevent.spawn(_feed, b, data)
+    start = time.perf_counter()
+    conn._recv()
+    elapsed = time.perf_counter() - start
+    feeder.join()
+    b.close()
+    assert count[0] == messages
+    return messages / elapsed, len(data) / messages
+
+
+def benchImport(statement, runs=5):
+    '''
+    Measures what running the import <statement> costs a fresh
+    interpreter, e.g. a short-lived script.
+    :param runs: number of interpreters to take the median time of
+    :return: dict of the median seconds, the peak bytes allocated, the
+             number of modules loaded, and whether gevent got imported
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, (root, env.get("PYTHONPATH"))))
+
+    def run(traced):
+        output = subprocess.check_output(
+            [sys.executable, "-c", _importScript % {
+                "statement": statement, "traced": traced}], env=env)
+        elapsed, peak, modules, gevent = output.split()
+        return float(elapsed), int(peak), int(modules), gevent == b"True"
+    times = sorted(run(False)[0] for _ in range(runs))
+    _, peak, modules, gevent = run(True)
+    return {"seconds": times[len(times) // 2], "peakBytes": peak,
+            "modules": modules, "gevent": gevent}
+
+
+def benchBaseline(rev, recvSizes=(4, 64, 256, 1024), parseSizes=(16, 256),
+                  runs=5):
+    '''
+    Measures the receive loop and the parser of this package and of the
+    package at the git revision <rev> the same way, each in a fresh
+    interpreter, to see what changed since. Needs git and the repository
+    this package is in.
+    :param recvSizes: bytes per MEM_MULTI line of the receive benchmarks,
+                      see benchRecv()
+    :param parseSizes: bytes per MEM_MULTI line of the parse benchmarks,
+                       see benchParse()
+    :param runs: number of runs to take the best of
+    :return: dict of "recv" and "parse", mapping each size to a (before,
+             after) tuple of lines per second
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = _baselineScript % {"recvSizes": tuple(recvSizes),
+                                "parseSizes": tuple(parseSizes),
+                                "runs": runs}
+
+    def run(path):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = path
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         env=env, cwd=path)
+        return json.loads(output.decode())
+    tmp = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(tmp, "baseline.tar")
+        subprocess.check_call(["git", "archive", "-o", archive, rev,
+                               "dolphinWatch"], cwd=root)
+        with tarfile.open(archive) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(tmp, filter="data")
+            else:
+                # Pythons without extraction filters, the archive comes
+                # from our own repository
+                tar.extractall(tmp)
+        before = run(tmp)
+    finally:
+        shutil.rmtree(tmp)
+    after = run(root)
+    return dict((kind, dict((int(size), (rate, after[kind][size]))
+                            for size, rate in before[kind].items()))
+                for kind in ("recv", "parse"))
+
+
+def _ignore(val):
+    pass
+
+
+def _offline(conn):
+    # lets <conn> take commands without a server, they pile up unsent.
+    # Needs a large flushSize.
+    conn._connected = True
+    conn._scheduleFlush = lambda: None
+
+
+def _drain(sock):
+    while sock.recv(65536):
+        pass
+
+
+def benchSend(commands=100000, burst=8):
+    '''
+    Issues input-like bursts of <burst> commands, yielding to the event
+    loop after each burst, and measures commands per second.
+    :return: (commands per second, send calls made)
+    '''
+    conn = DolphinConnection()
+    a, b = socket.socketpair()
+    conn._sock = a
+    conn._connected = True
+    drainer = gevent.spawn(_drain, b)
+    start = time.perf_counter()
+    for i in range(commands // burst):
+        for pad in range(burst):
+            conn.gcButton(pad % 4, i & 0x1fff, 0.5, -0.5)
+        gevent.sleep(0)
+    conn.flush()
+    elapsed = time.perf_counter() - start
+    a.shutdown(socket.SHUT_WR)
+    drainer.join()
+    a.close()
+    b.close()
+    return commands / elapsed, conn.sendStats()["sends"]
+
+
+def benchEncode(commands=200000):
+    '''
+    Measures how many gcButton commands per second get encoded into the
+    send buffer, cycling through 64 different pad states. Nothing is sent.
+    :return: commands per second
+    '''
+    conn = DolphinConnection(flushSize=1 << 40)
+    conn._connected = True
+    conn._scheduleFlush = lambda: None
+    states = [(i % 4, (i * 37) & 0x1fff, (i % 3 - 1) * 0.5, 0.0)
+              for i in range(64)]
+    start = time.perf_counter()
+    for i in range(commands):
+        pad, mask, x, y = states[i & 63]
+        conn.gcButton(pad, mask, x, y)
+    return commands / (time.perf_counter() - start)
+
+
+def benchTrace(records=200000, size=64, path=None):
+    '''
+    Measures how many MEM_MULTI records per second a TraceRecorder writes
+    and a TraceReader reads back, filtered by one of 16 addresses.
+    :param path: trace file to use, a temporary one by default
+    :return: (records written per second, records scanned per second)
+    '''
+    directory = None
+    if path is None:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "bench.trace")
+    data = bytes(i % 256 for i in range(size))
+    try:
+        recorder = TraceRecorder(path)
+        start = time.perf_counter()
+        for i in range(records):
+            recorder.memMulti(0x80000000 + (i & 15) * size, data)
+        recorder.close()
+        written = records / (time.perf_counter() - start)
+        with TraceReader(path) as reader:
+            start = time.perf_counter()
+            for event in reader.events(addrs=(0x80000000,)):
+                pass
+            scanned = records / (time.perf_counter() - start)
+    finally:
+        os.remove(path)
+        if directory is not None:
+            os.rmdir(directory)
+    return written, scanned
+
+
+def benchSubscriptionMemory(count=10000):
+    '''
+    Measures the memory allocated per subscribe32() on a connection,
+    including the buffered command.
+    :return: bytes per subscription
+    '''
+    # nothing is sent, the commands stay buffered
+    conn = DolphinConnection(flushSize=1 << 30)
+    conn._connected = True
+    conn._scheduleFlush = lambda: None
+
+    def callback(val):
+        pass
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        conn.subscribe32(0x80000000 + 4 * i, callback)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / count
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {"p%d" % p: values[min(len(values) - 1, len(values) * p // 100)]
+              for p in (50, 90, 99)}
+    result["max"] = values[-1]
+    return result
+
+
+def _stamp():
+    return time.perf_counter_ns() // 1000 & 0xffffffff
+
+
+def benchWorkload(subscriptions=64, multiSize=0, rate=60.0, duration=2.0,
+                  dispatch=DispatchMode.BATCH, binary=False):
+    '''
+    Subscribes to <subscriptions> values of a FakeDolphinServer, which
+    changes each of them <rate> times per second, and measures what the
+    DolphinConnection receives for <duration> seconds. The values carry a
+    timestamp to measure the latency from the server changing a value to
+    its callback starting. Server and connection share one process, so
+    high rates are bounded by the server as well.
+    :param multiSize: bytes per subscription, subscribed with
+                      subscribeMulti(). 0 subscribes 32 bit values.
+    :param rate: updates per second and subscription, None for as fast as
+                 possible
+    :return: dict of messages per second, callback latency percentiles in
+             microseconds, and the connection's send statistics
+    '''
+    stride = max(4, multiSize)
+    server = FakeDolphinServer(size=subscriptions * stride, binary=binary)
+    server.start()
+    conn = DolphinConnection(*server.address(), dispatch=dispatch,
+                             binary=binary)
+    conn.connect()
+    latencies = []
+
+    def callback(val):
+        if multiSize:
+            val = int.from_bytes(val[:4], "big")
+        latencies.append((_stamp() - val) & 0xffffffff)
+
+    def step(n):
+        return _stamp().to_bytes(4, "big") + bytes(stride - 4)
+    addrs = [server.base + stride * i for i in range(subscriptions)]
+    for addr in addrs:
+        if multiSize:
+            conn.subscribeMulti(multiSize, addr, callback)
+        else:
+            conn.subscribe32(addr, callback)
+    # let the initial values arrive before measuring
+    gevent.sleep(0.1)
+    del latencies[:]
+    for addr in addrs:
+        server.animate(addr, stride, rate, step)
+    start = time.perf_counter()
+    gevent.sleep(duration)
+    server.stopAnimations()
+    elapsed = time.perf_counter() - start
+    received = len(latencies)
+    conn.disconnect()
+    server.stop()
+    return {
+        "subscriptions": subscriptions,
+        "multiSize": multiSize,
+        "rate": rate,
+        "binary": binary,
+        "dispatch": DispatchMode.names[dispatch],
+        "messages": received,
+        "msgsPerSec": received / elapsed,
+        "latencyUs": _percentiles(latencies),
+        "send": conn.sendStats(),
+    }
+
+
+def benchReplay(speed, seconds=2.0, subscriptions=64, rate=60.0,
+                dispatch=DispatchMode.BATCH, binary=True, path=None):
+    '''
+    Replays a synthetic trace of <subscriptions> 32 bit values changing
+    <rate> times per second for <seconds> seconds through a ReplayServer at
+    <speed>, and measures how far behind the recorded pace the
+    DolphinConnection's callbacks fall. The highest speed without a
+    growing lag is what one connection can take of this traffic.
+    :param speed: playback speed, None for as fast as possible
+    :param path: trace file to use, a temporary one by default
+    :return: dict of messages per second, callback lag percentiles in
+             microseconds and the server's replay statistics
+    '''
+    directory = None
+    if path is None:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "replay.trace")
+    addrs = [0x80000000 + 4 * i for i in range(subscriptions)]
+    frames = int(seconds * rate)
+    with TraceRecorder(path) as recorder:
+        for frame in range(frames):
+            for addr in addrs:
+                recorder.mem(addr, frame, timestamp=frame / rate)
+    server = ReplayServer(path, speed=speed, binary=binary)
+    server.start()
+    conn = DolphinConnection(*server.address(), dispatch=dispatch,
+                             binary=binary)
+    conn.connect()
+    # (frame, monotonic time) of every callback
+    received = []
+
+    def callback(val):
+        received.append((val, time.monotonic()))
+    try:
+        for addr in addrs:
+            conn.subscribe32(addr, callback)
+        while not server.stats():
+            gevent.sleep(0.01)
+        server.wait()
+        expected = frames * subscriptions
+        deadline = time.monotonic() + 10.0
+        while len(received) < expected and time.monotonic() < deadline:
+            gevent.sleep(0.01)
+        replay = server.stats()[0]
+    finally:
+        conn.disconnect()
+        server.stop()
+        server.trace.close()
+        os.remove(path)
+        if directory is not None:
+            os.rmdir(directory)
+    lags = []
+    if speed is not None:
+        lags = [int((now - replay["started"] - frame / rate / speed) * 1e6)
+                for frame, now in received]
+    elapsed = received[-1][1] - replay["started"] if received else 0.0
+    return {
+        "speed": speed,
+        "binary": binary,
+        "dispatch": DispatchMode.names[dispatch],
+        "messages": len(received),
+        "msgsPerSec": len(received) / elapsed if elapsed else 0.0,
+        "lagUs": _percentiles(lags),
+        "replay": replay,
+    }
+
+
+# name -> benchWorkload arguments
+WORKLOADS = {
+    "idle":      dict(subscriptions=1000, rate=1.0),
+    "frame":     dict(subscriptions=64, rate=60.0),
+    "blocks":    dict(subscriptions=16, multiSize=256, rate=60.0),
+    "flood":     dict(subscriptions=4, rate=None),
+    "floodMulti": dict(subscriptions=4, multiSize=256, rate=None),
+}
+
+
+def runAll(duration=2.0, report=print):
+    '''
+    Runs all benchmarks and workloads, reporting each result as a line
+    through <report>.
+    :return: dict of all results
+    '''
+    results = {
+        "python": platform.python_version(),
+        "gevent": gevent.__version__,
+        "recv": {}, "parse": {}, "framing": {}, "dispatch": {},
+        "workloads": {}, "imports": {},
+    }
+    for name, statement in sorted(IMPORTS.items()):
+        result = benchImport(statement)
+        results["imports"][name] = result
+        report("import   %-8s %7.1f ms, %6.0f kB, %3d modules%s" % (
+            name, result["seconds"] * 1000, result["peakBytes"] / 1024,
+            result["modules"], ", gevent" if result["gevent"] else ""))
+    for size in (4, 64, 256, 1024):
+        rate = benchRecv(lines=max(20000, 2000000 // size), size=size)
+        results["recv"][size] = rate
+        report("recv     MEM_MULTI %4d bytes: %10.0f lines/s" % (size, rate))
+    for size in (16, 256):
+        rate = benchParse(size=size)
+        results["parse"][size] = rate
+        report("parse    mixed, MEM_MULTI %4d bytes: %10.0f lines/s" %
+               (size, rate))
+    for size in (16, 256, 1024):
+        for binary in (False, True):
+            name = "binary" if binary else "text"
+            rate, wire = benchFraming(binary, size=size)
+            results["framing"]["%s%d" % (name, size)] = {
+                "msgsPerSec": rate, "bytesPerMsg": wire}
+            report("framing  %-6s MEM_MULTI %4d bytes: %10.0f msgs/s, "
+                   "%5.0f bytes/msg" % (name, size, rate, wire))
+    rate = benchEncode()
+    results["encode"] = rate
+    report("encode   gcButton: %10.0f cmds/s" % rate)
+    rate, sends = benchSend()
+    results["send"] = {"cmdsPerSec": rate, "sends": sends, "commands": 100000}
+    report("send     gcButton bursts of 8: %10.0f cmds/s, %d sends for 100000"
+           % (rate, sends))
+    for name in ("SPAWN", "BATCH", "POOL"):
+        rate = benchDispatch(getattr(DispatchMode, name))
+        results["dispatch"][name] = rate
+        report("dispatch %-5s: %10.0f msgs/s" % (name, rate))
+    results["triggers"] = {}
+    for trigger in (False, True):
+        rate, calls = benchTriggers(trigger)
+        name = "trigger" if trigger else "subscribe"
+        results["triggers"][name] = {"msgsPerSec": rate, "callbacks": calls}
+        report("triggers %-9s 1%% of values wanted: %10.0f msgs/s, "
+               "%d callbacks" % (name, rate, calls))
+    results["stalls"] = {}
+    for name in ("NONE", "BLOCK", "DROP_OLDEST", "COALESCE"):
+        result = benchStall(getattr(Overflow, name, None))
+        results["stalls"][name] = result
+        report("stall    %-11s 0.2 s: peak %8.0f kB, %6d callbacks, "
+               "%5.2f s" % (name, result["peakBytes"] / 1024,
+                            result["callbacks"], result["seconds"]))
+    written, scanned = benchTrace()
+    results["trace"] = {"writtenPerSec": written, "scannedPerSec": scanned}
+    report("trace    64 byte records: %10.0f written/s, %10.0f scanned/s" %
+           (written, scanned))
+    perSub = benchSubscriptionMemory()
+    results["bytesPerSubscription"] = perSub
+    report("memory   %10.0f bytes per subscription" % perSub)
+    for name, kwargs in sorted(WORKLOADS.items()):
+        for binary in (False, True):
+            result = benchWorkload(duration=duration, binary=binary,
+                                   **kwargs)
+            key = name + ("Binary" if binary else "")
+            results["workloads"][key] = result
+            report("workload %-16s %10.0f msgs/s, latency p50 %6d us, "
+                   "p99 %6d us, %d sends" % (
+                       key, result["msgsPerSec"],
+                       result["latencyUs"].get("p50", 0),
+                       result["latencyUs"].get("p99", 0),
+                       result["send"]["sends"]))
+    results["replays"] = {}
+    for speed in (1.0, 10.0, 100.0, None):
+        for binary in (False, True):
+            result = benchReplay(speed, binary=binary)
+            key = "%s%s" % ("max" if speed is None else "%dx" % speed,
+                            "Binary" if binary else "")
+            results["replays"][key] = result
+            report("replay   %-16s %10.0f msgs/s, lag p50 %9d us, "
+                   "p99 %9d us" % (key, result["msgsPerSec"],
+                                   result["lagUs"].get("p50", 0),
+                                   result["lagUs"].get("p99", 0)))
+    return results
+
+
+def runBaseline(rev, report=print):
+    '''
+    Compares the receive loop and the parser with those at the git
+    revision <rev>, see benchBaseline(), reporting each result as a line
+    through <report>.
+    :return: dict of all results
+    '''
+    results = benchBaseline(rev)
+    for size, (before, after) in sorted(results["recv"].items()):
+        report("recv     MEM_MULTI %4d bytes: %10.0f -> %10.0f lines/s, "
+               "%4.1fx" % (size, before, after, after / before))
+    for size, (before, after) in sorted(results["parse"].items()):
+        report("parse    mixed, MEM_MULTI %4d bytes: %10.0f -> %10.0f "
+               "lines/s, %4.1fx" % (size, before, after, after / before))
+    results["baseline"] = rev
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON to FILE, - for stdout")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="seconds each workload runs")
+    parser.add_argument("--baseline", metavar="REV",
+                        help="only compare receiving and parsing with the "
+                             "package at git revision REV")
+    args = parser.parse_args()
+    toStdout = args.json == "-"
+    report = (lambda line: None) if toStdout else print
+    if args.baseline:
+        results = runBaseline(args.baseline, report)
+    else:
+        results = runAll(args.duration, report)
+    if args.json:
+        if toStdout:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        else:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ Created on 10.11.2015
 '''
 
 from enum import Enum
+from functools import lru_cache as _lru_cache
 
 
 class WiimoteButtons(Enum):
@@ -45,3 +46,30 @@ class GCPadSticks(Enum):
     DOWN  = ( 0, -1, 0, 0)
     LEFT  = (-1,  0, 0, 0)
     RIGHT = ( 1,  0, 0, 0)
+
+
+@_lru_cache(maxsize=1024)
+def combine(*buttons):
+    '''
+    Returns the bitmask of several GCPadButtons or WiimoteButtons members,
+    e.g. combine(GCPadButtons.A, GCPadButtons.B).
+    Results are cached, so combinations used over and over cost a lookup.
+    '''
+    mask = 0
+    for button in buttons:
+        mask |= button if isinstance(button, int) else button.value
+    return mask
+
+
+def buttonMask(buttons):
+    '''
+    Returns the bitmask of <buttons>, which is either a bitmask already, a
+    GCPadButtons or WiimoteButtons member, or an iterable of those.
+    '''
+    if isinstance(buttons, int):
+        return buttons
+    if isinstance(buttons, Enum):
+        return buttons.value
+    if buttons is None:
+        return 0
+    return combine(*buttons)
@@ -0,0 +1,259 @@
+'''
+Coalescing layer on top of the DolphinConnection subscriptions.
+
+Only the latest value per address and size is kept. Callbacks get the newest
+value once the previous callbacks are done, intermediate values are skipped,
+and snapshot() returns all current values without asking Dolphin.
+
+Values are stored right where they are parsed, by the predicate of a
+trigger that never matches (see triggers.py), so storing one does not
+cost a dispatched callback.
+'''
+
+from __future__ import print_function, division
+
+from array import array
+
+import gevent
+from gevent.event import Event
+
+from .triggers import Predicate
+
+
+class CoalescingStore(object):
+    def __init__(self, connection):
+        '''
+        Creating a new CoalescingStore for subscriptions made through the
+        given DolphinConnection.
+        Values are kept per address and size. Those of 8, 16 and 32 bit
+        subscriptions are kept in one array, MEM_MULTI data as bytes.
+        Callbacks are run one after another on a single greenlet, and each
+        callback only ever gets the latest value. The greenlet stops once
+        nothing is subscribed anymore, see close().
+        '''
+        self._conn = connection
+        # (addr, size) -> slot
+        self._slots = {}
+        # addr -> sizes subscribed there
+        self._sizes = {}
+        # per slot: callback, Listener of the connection, and a generation
+        # to tell values of an earlier subscription apart
+        self._callbacks = []
+        self._listeners = []
+        self._generations = []
+        self._values = array("L")
+        # slot -> latest MEM_MULTI data
+        self._multi = {}
+        self._seen = bytearray()
+        # slots of removed subscriptions, to be reused
+        self._free = []
+        self._dirty = {}
+        self._wakeup = Event()
+        self._deliverer = None
+
+    def subscribe8(self, addr, callback=None):
+        '''
+        Subscribes to 8 bits of data at the given address.
+        The given callback, if any, gets called with the latest value as
+        parameter whenever it changed.
+        Returns the Listener, see unsubscribe().
+        '''
+        return self._subscribe(addr, 1, callback)
+
+    def subscribe16(self, addr, callback=None):
+        '''
+        Subscribes to 16 bits of data at the given address.
+        The given callback, if any, gets called with the latest value as
+        parameter whenever it changed.
+        Returns the Listener, see unsubscribe().
+        '''
+        return self._subscribe(addr, 2, callback)
+
+    def subscribe32(self, addr, callback=None):
+        '''
+        Subscribes to 32 bits of data at the given address.
+        The given callback, if any, gets called with the latest value as
+        parameter whenever it changed.
+        Returns the Listener, see unsubscribe().
+        '''
+        if addr % 4 != 0:
+            raise ValueError("Read address must be whole word; " +
+                             "multiple of 4")
+        return self._subscribe(addr, 4, callback)
+
+    def subscribeMulti(self, size, addr, callback=None):
+        '''
+        Subscribes to <size> bytes of data starting at the given address.
+        The given callback, if any, gets called with the latest data as
+        bytes whenever it changed.
+        Returns the Listener, see unsubscribe().
+        '''
+        return self._subscribe(addr, size, callback, True)
+
+    def unsubscribe(self, listener):
+        '''
+        Removes a subscription, given as the Listener returned by
+        subscribe8() and the like, and forgets its value.
+        Returns False if it was unsubscribed already.
+        '''
+        key = (listener.addr, listener.size)
+        slot = self._slots.get(key)
+        if slot is None or self._listeners[slot] is not listener:
+            return False
+        self._conn.unsubscribe(listener)
+        del self._slots[key]
+        sizes = self._sizes[listener.addr]
+        sizes.remove(listener.size)
+        if not sizes:
+            del self._sizes[listener.addr]
+        self._clear(slot)
+        self._callbacks[slot] = None
+        self._listeners[slot] = None
+        self._free.append(slot)
+        if not self._slots:
+            self._stop()
+        return True
+
+    def close(self):
+        '''
+        Unsubscribes everything and stops the greenlet running the
+        callbacks. The store can still be used afterwards.
+        '''
+        for listener in list(self._listeners):
+            if listener is not None:
+                self.unsubscribe(listener)
+        self._stop()
+
+    def get(self, addr, default=None, size=None):
+        '''
+        Returns the latest value received for the given address, or
+        <default> if nothing was received yet.
+        :param size: size in bytes of the subscription, only needed if there
+                     are several at <addr>
+        '''
+        if size is None:
+            sizes = self._sizes.get(addr)
+            if not sizes:
+                return default
+            if len(sizes) > 1:
+                raise ValueError("Several subscriptions at 0x%x, the size "
+                                 "is needed." % addr)
+            size = sizes[0]
+        slot = self._slots.get((addr, size))
+        if slot is None or not self._seen[slot]:
+            return default
+        return self._multi.get(slot, self._values[slot])
+
+    def snapshot(self):
+        '''
+        Returns a dict of all subscribed (address, size) pairs and their
+        latest values. Those without any value received yet map to None.
+        No command is sent to Dolphin.
+        '''
+        values = self._values
+        seen = self._seen
+        multi = self._multi
+        return {key: multi.get(slot, values[slot]) if seen[slot] else None
+                for key, slot in self._slots.items()}
+
+    ######################################
+    # private methods below
+
+    def _subscribe(self, addr, size, callback, multi=False):
+        slot = self._slots.get((addr, size))
+        if slot is not None:
+            # replaces the earlier subscription of the same memory
+            self._conn.unsubscribe(self._listeners[slot])
+            self._clear(slot)
+        else:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._callbacks)
+                self._callbacks.append(None)
+                self._listeners.append(None)
+                self._generations.append(0)
+                self._values.append(0)
+                self._seen.append(0)
+            self._slots[(addr, size)] = slot
+            self._sizes.setdefault(addr, []).append(size)
+        self._callbacks[slot] = callback
+        generation = self._generations[slot]
+        if multi:
+            def store(data):
+                self._updateMulti(slot, generation, data)
+                return False
+            predicate = Predicate("store(0x%x)" % addr, lambda size: store,
+                                  multi=True)
+            listener = self._conn.triggerMulti(size, addr, predicate, None)
+        else:
+            def store(val):
+                self._update(slot, generation, val)
+                return False
+            predicate = Predicate("store(0x%x)" % addr, lambda size: store)
+            listener = self._conn.trigger(size * 8, addr, predicate, None)
+        self._listeners[slot] = listener
+        return listener
+
+    def _clear(self, slot):
+        # forgets the value of a slot, values still on their way for it
+        # get dropped
+        self._generations[slot] += 1
+        self._seen[slot] = 0
+        self._multi.pop(slot, None)
+        self._dirty.pop(slot, None)
+
+    def _update(self, slot, generation, val):
+        if self._generations[slot] != generation:
+            return
+        self._values[slot] = val
+        self._changed(slot)
+
+    def _updateMulti(self, slot, generation, data):
+        if self._generations[slot] != generation:
+            return
+        # with binary framing data is a view into the receive buffer's copy
+        # of a whole read, which would stay alive as long as the value
+        self._multi[slot] = bytes(data)
+        self._changed(slot)
+
+    def _changed(self, slot):
+        self._seen[slot] = 1
+        if self._callbacks[slot] is None:
+            return
+        self._dirty[slot] = None
+        self._wakeup.set()
+        if self._deliverer is None:
+            self._deliverer = gevent.spawn(self._deliver)
+
+    def _stop(self):
+        # the deliverer ends once it wakes up
+        if self._deliverer is not None:
+            self._deliverer = None
+            self._wakeup.set()
+
+    def _deliver(self):
+        me = gevent.getcurrent()
+        while True:
+            self._wakeup.wait()
+            if self._deliverer is not me:
+                return
+            self._wakeup.clear()
+            while self._dirty and self._deliverer is me:
+                # values keep getting overwritten while callbacks run, so
+                # a slot gets delivered at most once per pass, with the
+                # value it has when its turn comes
+                dirty = self._dirty
+                self._dirty = {}
+                for slot in dirty:
+                    callback = self._callbacks[slot]
+                    if callback is None:
+                        # unsubscribed meanwhile
+                        continue
+                    val = self._multi.get(slot, self._values[slot])
+                    try:
+                        callback(val)
+                    except Exception as e:
+                        # logged with _logCallbackError and counted like
+                        # the errors of any other callback
+                        self._conn._onListenerError(e)
@@ -0,0 +1,498 @@
+'''
+Implementation of the own DolphinConnection Protocol
+(see https://github.com/ProjectRevoTPP/dolphin).
+
+Is based on virtual coroutines using gevent. Uses gevent's sockets
+without patching the socket module, see dolphinWatch.patch() for that.
+
+@author: Felk
+'''
+
+from __future__ import print_function, division
+
+import gevent
+import time
+import random
+from gevent import socket
+
+from .dispatch import (DispatchMode, Overflow, Dispatcher, BatchDispatcher,
+                       PoolDispatcher)
+from .protocol import (BaseConnection, LineBuffer, FrameBuffer, Framing,
+                       FRAMING_REQUEST, DisconnectReason, logger,
+                       _logCallbackError)
+from .request import Request
+
+
+class DolphinConnection(BaseConnection):
+    def __init__(self, host="localhost", port=6000, readSize=16384,
+                 dispatch=DispatchMode.SPAWN, poolSize=4, flushSize=16384,
+                 reconnect=False, reconnectDelay=0.05, reconnectMaxDelay=10.0,
+                 binary=False, handshakeTimeout=0.5, highWatermark=None,
+                 lowWatermark=None, overflow=Overflow.BLOCK):
+        '''
+        Creating a new DolphinConnection instance,
+        pointing to the DolphinConnection Server specified by host and port.
+        The connection must be established explicitly with connect().
+
+        host and port can be overwritten, followed by another connect()
+        call to reconnect.
+        :param readSize: size of the preallocated receive buffer, i.e. the
+                         maximum number of bytes read from the socket at once
+        :param dispatch: DispatchMode of the MEM and MEM_MULTI callbacks.
+                         SPAWN runs each one in its own greenlet, BATCH runs
+                         all callbacks of one recv on a single worker
+                         greenlet, POOL on <poolSize> workers.
+                         BATCH and POOL keep the order per address.
+        :param flushSize: outgoing commands are buffered and sent at the
+                          end of the current event loop iteration, or as
+                          soon as this many bytes are buffered
+        :param reconnect: whether to reconnect automatically after the
+                          connection got lost or closed by the peer.
+                          All subscriptions get sent again in one go right
+                          after reconnecting, before onConnect is called.
+                          An onConnect subscribing again gets the restored
+                          Listeners back, nothing is subscribed twice.
+        :param reconnectDelay: seconds to wait before the first reconnect
+                               attempt. Doubles with every failed attempt,
+                               up to <reconnectMaxDelay>, and gets jittered
+                               by +-50%.
+        :param binary: whether to ask the server for binary framing right
+                       after connecting. Falls back to text if the server
+                       does not agree within <handshakeTimeout> seconds.
+                       With binary framing subscribeMulti callbacks get
+                       memoryviews of the raw memory instead of bytes.
+        :param highWatermark: number of callbacks dispatched but not done
+                              at which the connection is under
+                              backpressure, None for no limit. See
+                              dispatch.py and onBackpressure().
+        :param lowWatermark: number at which backpressure ends, by
+                             default half of <highWatermark>
+        :param overflow: Overflow policy under backpressure: BLOCK stops
+                         reading from the socket, DROP_OLDEST (BATCH and
+                         POOL only) drops the oldest callbacks not started
+                         yet, COALESCE keeps only the latest value per
+                         address waiting. With BLOCK, callbacks must not
+                         wait for reads, those would never arrive, and
+                         <highWatermark> is no hard bound: everything
+                         parsed from one recv gets dispatched before
+                         reading stops, so up to <readSize> bytes worth of
+                         messages more may be pending.
+        '''
+        BaseConnection.__init__(self, host, port, flushSize)
+        self._sock = None
+        self._readSize = readSize
+        if dispatch == DispatchMode.SPAWN:
+            self._dispatcher = Dispatcher(_logCallbackError)
+        elif dispatch == DispatchMode.BATCH:
+            self._dispatcher = BatchDispatcher(_logCallbackError)
+        elif dispatch == DispatchMode.POOL:
+            self._dispatcher = PoolDispatcher(_logCallbackError, poolSize)
+        else:
+            raise ValueError("dispatch must be a DispatchMode.")
+        self._bpFunc = None
+        if highWatermark is not None:
+            self._dispatcher.limit(highWatermark, lowWatermark, overflow,
+                                   self._onBackpressure)
+        self._flushing = False
+        self._reconnect = reconnect
+        self._reconnectDelay = reconnectDelay
+        self._reconnectMaxDelay = reconnectMaxDelay
+        self._binary = binary
+        self._handshakeTimeout = handshakeTimeout
+        self._reconnector = None
+        self._wantConnected = False
+        self._metricsExporter = None
+        self._resubscribeOnConnect = False
+        self._lostAt = None
+        self._reconnectStats = {"reconnects": 0, "attempts": 0,
+                                "lastResubscribeTime": None,
+                                "maxResubscribeTime": 0.0}
+
+    def connect(self):
+        '''
+        Tries to establish a new connection to the server. Disconnects any existing
+        connection first.
+        If it succeeds, the onConnect callback will be called.
+        If it fails, the onDisconnect callback will be called.
+        With binary framing enabled, this also waits for the server to
+        agree to it, see framing().
+        '''
+        self.disconnect()
+        self._wantConnected = True
+        self._connected = True
+        self._framing = Framing.TEXT
+        try:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.connect((self.host, self.port))
+            pending = b""
+            if self._binary:
+                pending = self._negotiate()
+            logger.info("DolphinConnection connection to %s:%d established! " +
+                        "Ready for work!", self.host, self.port)
+            gevent.spawn(self._recv, pending)
+            if self._resubscribeOnConnect:
+                self._resubscribeOnConnect = False
+                self.resubscribe()
+                self._resubscribed()
+            if self._cFunc:
+                self._cFunc(self)
+        except socket.error:
+            logger.info("DolphinConnection connection to %s:%d failed.",
+                        self.host, self.port)
+            self._disconnect(DisconnectReason.CONNECTION_NOT_ESTABLISHED)
+
+    def disconnect(self):
+        '''
+        Disconnects an existing socket connection from the server, if any.
+        The onDisconnect callback will be called with CONNECTION_CLOSED_BY_HOST
+        Also stops reconnecting.
+        '''
+        self._wantConnected = False
+        BaseConnection.disconnect(self)
+
+    def reconnectStats(self):
+        '''
+        Returns a dict of counters of the automatic reconnect: successful
+        reconnects, connection attempts, and the last and maximum time in
+        seconds from losing the connection until all subscriptions were
+        sent again.
+        '''
+        return dict(self._reconnectStats)
+
+    def enableMetrics(self, metrics=None, interval=None):
+        '''
+        Starts measuring this connection, see metrics.Metrics.
+        Returns the Metrics, which are either the given ones, e.g. to
+        share them between connections, or new ones.
+        While disabled, measuring costs next to nothing.
+        :param interval: seconds between calls of the metrics' export(),
+                         None to not export periodically
+        '''
+        metrics = BaseConnection.enableMetrics(self, metrics)
+        if self._metricsExporter is not None:
+            self._metricsExporter.kill()
+            self._metricsExporter = None
+        if interval is not None:
+            self._metricsExporter = gevent.spawn(self._exportMetrics,
+                                                 metrics, interval)
+        return metrics
+
+    def disableMetrics(self):
+        '''
+        Stops measuring this connection and exporting periodically.
+        '''
+        BaseConnection.disableMetrics(self)
+        if self._metricsExporter is not None:
+            self._metricsExporter.kill()
+            self._metricsExporter = None
+
+    def dispatchStats(self):
+        '''
+        Returns a dict of callback dispatch counters: messages dispatched,
+        currently queued and the maximum queued so far, callbacks that
+        raised, and the mean and maximum latency in seconds between
+        receiving a message and starting its callback.
+        With a highWatermark also the callbacks pending, dropped and
+        coalesced, how often backpressure started, whether it is on, and
+        the seconds reading was blocked.
+        '''
+        return self._dispatcher.stats()
+
+    def onBackpressure(self, func):
+        '''
+        Sets the callback that will be called with the connection and True
+        when it comes under backpressure, see the highWatermark parameter,
+        and with False when that is over.
+        Callback is initially None, and can again be assigned to None.
+        '''
+        if func is not None and not hasattr(func, '__call__'):
+            raise ValueError("onBackpressure callback must be callable.")
+        self._bpFunc = func
+
+    def isBackpressured(self):
+        '''
+        Returns whether more callbacks are pending than the watermarks
+        allow, see the highWatermark parameter.
+        '''
+        return self._dispatcher.backpressured()
+
+    def flush(self):
+        '''
+        Sends all buffered commands now instead of at the end of the current
+        event loop iteration. If another greenlet is already sending, that
+        one sends the rest too, and this returns right away.
+        '''
+        self._flushScheduled = False
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self._out and self._connected:
+                data = self._out
+                self._out = bytearray()
+                self._sock.sendall(data)
+                self._sendStats["sends"] += 1
+                if self._metrics is not None:
+                    self._metrics._sent(len(data))
+        except socket.error:
+            logger.warning("DolphinConnection connection lost.")
+            self._disconnect(DisconnectReason.CONNECTION_LOST)
+        finally:
+            self._flushing = False
+
+    def subscribe8(self, addr, callback):
+        '''
+        Sends a command to send back 8 bytes of data at the given address,
+        repeating each time the value changes.
+        The given callback function gets called with the returned value as
+        parameter.
+        Returns a Listener, see unsubscribe().
+        '''
+        return self._subscribe(8, addr, callback)
+
+    def subscribe16(self, addr, callback):
+        '''
+        Sends a command to send back 16 bytes of data at the given address,
+        repeating each time the value changes.
+        The given callback function gets called with the returned value as
+        parameter.
+        Returns a Listener, see unsubscribe().
+        '''
+        return self._subscribe(16, addr, callback)
+
+    def subscribe32(self, addr, callback):
+        '''
+        Sends a command to send back 32 bytes of data at the given address,
+        repeating each time the value changes.
+        The given callback function gets called with the returned value as
+        parameter.
+        Returns a Listener, see unsubscribe().
+        '''
+        if addr % 4 != 0:
+            raise ValueError("Read address must be whole word; " +
+                             "multiple of 4")
+        return self._subscribe(32, addr, callback)
+
+    def subscribeMulti(self, size, addr, callback):
+        '''
+        Sends a command to send back <size> bytes of data starting at the
+        given address,
+        repeating each time any value changes. Useful for strings or arrays.
+        The given callback function gets called with the returned values as
+        a bytes object as parameter, or as a memoryview with binary framing.
+        Use util.ndarray() to get a NumPy view on it without copying.
+        Older versions passed a list of ints instead, use list(data) where
+        one is still needed.
+        Several subscriptions of the same or overlapping memory share one
+        subscription on the server. Those get bytes cut out of it instead.
+        Returns a Listener, see unsubscribe().
+        '''
+        return self._subscribeMulti(size, addr, callback)
+
+    def subscribeSchema(self, addr, schema, callback):
+        '''
+        Subscribes to the structure described by <schema> at the given
+        address.
+        The given callback function gets called with a record of the
+        structure and a list of the names of the fields that changed as
+        parameters. Updates that change nothing are dropped.
+        Returns a Listener, see unsubscribe().
+        '''
+        return self._subscribeMulti(schema.size, addr,
+                                    schema.watch(callback))
+
+    def load(self, filename, timeout=None):
+        '''
+        Tells Dolphin to load the savestate located at <filename>.
+        This function will block until feedback as arrived
+        and will then return true if it succeded, else false.
+        CAUTION: Will permanently block if dolphin was paused and no
+                 timeout is given :(
+        :param timeout: seconds after which DolphinTimeout gets raised
+        '''
+        return self._load(filename, timeout).get()
+
+    def loadAsync(self, filename, timeout=None):
+        '''
+        Tells Dolphin to load the savestate located at <filename>, without
+        waiting for the feedback.
+        Returns a Request, whose get() waits for the feedback and returns
+        true if loading succeeded, else false. Several loads can be
+        outstanding at once, feedback is matched to them in order.
+        :param timeout: seconds after which the Request fails with
+                        DolphinTimeout, None to wait forever
+        '''
+        return self._load(filename, timeout)
+
+    ######################################
+    # private methods below
+
+    def _disconnect(self, reason):
+        if not self._connected:
+            return
+        BaseConnection._disconnect(self, reason)
+        if self._reconnect and self._wantConnected and reason in (
+                DisconnectReason.CONNECTION_LOST,
+                DisconnectReason.CONNECTION_CLOSED_BY_PEER):
+            self._lostAt = time.monotonic()
+            if self._reconnector is None:
+                self._reconnector = gevent.spawn(self._reconnectLoop)
+
+    def _reconnectLoop(self):
+        delay = self._reconnectDelay
+        try:
+            while self._wantConnected and not self._connected:
+                gevent.sleep(delay * random.uniform(0.5, 1.5))
+                if not self._wantConnected or self._connected:
+                    break
+                self._reconnectStats["attempts"] += 1
+                self._resubscribeOnConnect = True
+                self.connect()
+                self._resubscribeOnConnect = False
+                delay = min(delay * 2, self._reconnectMaxDelay)
+        finally:
+            self._reconnector = None
+
+    def _exportMetrics(self, metrics, interval):
+        while True:
+            gevent.sleep(interval)
+            try:
+                metrics.export()
+            except Exception as e:
+                logger.error("Exception raised by metrics exporter",
+                             exc_info=e)
+
+    def _resubscribed(self):
+        stats = self._reconnectStats
+        stats["reconnects"] += 1
+        if self._lostAt is not None:
+            elapsed = time.monotonic() - self._lostAt
+            stats["lastResubscribeTime"] = elapsed
+            stats["maxResubscribeTime"] = max(stats["maxResubscribeTime"],
+                                              elapsed)
+        logger.info("DolphinConnection reconnected, %d subscriptions " +
+                    "restored.", len(self._callbacks))
+
+    def _sendRest(self, data):
+        try:
+            self._sock.sendall(data)
+        except socket.error:
+            return False
+        if self._metrics is not None:
+            self._metrics._sent(len(data))
+        return True
+
+    def _close(self):
+        try:
+            self._sock.close()
+        except:
+            pass
+
+    def _newRequest(self, callback=None, timeout=None):
+        return Request(callback, timeout)
+
+    def _scheduleFlush(self):
+        gevent.spawn(self.flush)
+
+    def _dispatch(self, addr, callback, val):
+        self._dispatcher.dispatch(addr, callback, val)
+
+    def _onListenerError(self, e):
+        self._dispatcher.errors += 1
+        BaseConnection._onListenerError(self, e)
+
+    def _onBackpressure(self, active):
+        if active:
+            logger.info("DolphinConnection callbacks can't keep up, %d "
+                        "pending.", self._dispatcher.pending)
+        else:
+            logger.debug("DolphinConnection callbacks caught up.")
+        if self._bpFunc:
+            self._bpFunc(self, active)
+
+    def _negotiate(self):
+        # Asks the server for binary framing and waits for it to agree.
+        # Lines arriving before the answer are processed as usual.
+        # Returns the data received after the answer.
+        sock = self._sock
+        sock.sendall(FRAMING_REQUEST + b"\n")
+        buf = bytearray()
+        deadline = time.monotonic() + self._handshakeTimeout
+        try:
+            while True:
+                end = buf.find(b"\n")
+                while end >= 0:
+                    line = bytes(buf[:end]).strip()
+                    del buf[:end + 1]
+                    if line == FRAMING_REQUEST:
+                        self._framing = Framing.BINARY
+                        logger.debug("DolphinConnection uses binary framing.")
+                        return bytes(buf)
+                    self._process(line)
+                    end = buf.find(b"\n")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                data = sock.recv(4096)
+                if not data:
+                    raise socket.error("Connection closed during handshake.")
+                buf += data
+        except socket.timeout:
+            pass
+        finally:
+            sock.settimeout(None)
+        logger.info("DolphinConnection server does not support binary " +
+                    "framing, using text.")
+        return bytes(buf)
+
+    def _recv(self, pending=b""):
+        """Listen for incoming data from Dolphin"""
+        # Data is read straight into a preallocated chunk, without
+        # allocating anything per read.
+        chunk = bytearray(self._readSize)
+        view = memoryview(chunk)
+        binary = self._framing == Framing.BINARY
+        buffer = FrameBuffer() if binary else LineBuffer()
+        # bound to this socket, a reconnect while this greenlet waits in
+        # throttle() gets a receive greenlet of its own
+        sock = self._sock
+        data = pending
+        while self._connected and self._sock is sock:
+            if data:
+                metrics = self._metrics
+                if metrics is not None:
+                    start = time.perf_counter()
+                messages = buffer.feed(data)
+                self._dispatcher.begin()
+                if binary:
+                    for kind, payload in messages:
+                        self._processFrame(kind, payload)
+                else:
+                    for line in messages:
+                        self._process(line)
+                if metrics is not None:
+                    metrics._received(len(data), len(messages), binary,
+                                      time.perf_counter() - start)
+                self._dispatcher.flush()
+                # waits for the callbacks if they can't keep up, so the
+                # socket buffers fill and Dolphin has to wait
+                self._dispatcher.throttle()
+                if self._sock is not sock:
+                    return
+            try:
+                n = sock.recv_into(view)
+                if not n:
+                    if self._sock is sock:
+                        logger.info("DolphinConnection connection closed "
+                                    "by peer.")
+                        self._disconnect(
+                            DisconnectReason.CONNECTION_CLOSED_BY_PEER)
+                    return
+            except socket.error:
+                if self._connected and self._sock is sock:
+                    # not just the socket closed by disconnect()
+                    logger.warning("DolphinConnection connection lost.")
+                    self._disconnect(DisconnectReason.CONNECTION_LOST)
+                return
+            data = view[:n]
@@ -0,0 +1,387 @@
+'''
+Strategies for running the callbacks of incoming MEM and MEM_MULTI
+messages.
+
+SPAWN runs every callback in a greenlet of its own. This is the simplest
+and the default, but it creates and tears down a greenlet per message.
+BATCH collects the callbacks of everything received in one recv and runs
+them one after another on a single worker greenlet. POOL does the same on
+a fixed number of workers, picked by address. Both preserve the order of
+messages for the same address. What gets dispatched between begin() and
+flush(), i.e. while a recv gets processed, is handed to the workers at
+once by flush(). Anything dispatched outside of that, like the current
+value for a listener joining a subscription, is handed over right away.
+
+Without limits, callbacks that can't keep up let the dispatched messages
+pile up without end. limit() bounds them: once <high> callbacks are
+pending, i.e. dispatched but not done, the dispatcher is under
+backpressure until no more than <low> are pending again. What happens
+meanwhile is the Overflow policy:
+
+BLOCK stops reading from the socket, so Dolphin has to wait instead.
+Everything received in the current recv still gets dispatched, so the
+pending callbacks may exceed <high> by that much.
+DROP_OLDEST drops the oldest callbacks not started yet, to keep no more
+than <high> pending. Only for BATCH and POOL.
+COALESCE only keeps the latest value for each address and callback that
+is still waiting, so there are no more pending callbacks than
+subscriptions. BATCH and POOL only notice backpressure once a recv got
+dispatched, so its messages may all still be pending.
+'''
+
+from __future__ import print_function, division
+
+import time
+from collections import deque
+
+import gevent
+import gevent.event
+
+from .util import enum
+
+DispatchMode = enum(
+    SPAWN = 1,
+    BATCH = 2,
+    POOL  = 3,
+)
+
+Overflow = enum(
+    BLOCK       = 1,
+    DROP_OLDEST = 2,
+    COALESCE    = 3,
+)
+
+
+class Dispatcher(object):
+    '''
+    Runs callbacks one greenlet each. Base class of the other dispatchers.
+    :param onError: called with the exception if a callback raises
+    '''
+    def __init__(self, onError):
+        self._onError = onError
+        self.dispatched = 0
+        self.queued = 0
+        self.maxQueued = 0
+        self.pending = 0
+        self.errors = 0
+        self.latencyTotal = 0.0
+        self.latencyMax = 0.0
+        self.dropped = 0
+        self.coalesced = 0
+        self.backpressures = 0
+        self.blockedTime = 0.0
+        self._high = None
+        self._low = None
+        self._overflow = Overflow.BLOCK
+        self._onChange = None
+        self._backpressured = False
+        self._coalescing = False
+        # dispatched callbacks are collected until flush()
+        self._collecting = False
+        # (addr, callback) -> (callback, latest value) while coalescing
+        self._latest = {}
+        self._relieved = gevent.event.Event()
+        self._relieved.set()
+
+    def limit(self, high, low=None, overflow=Overflow.BLOCK, onChange=None):
+        '''
+        Bounds the number of pending callbacks, see above.
+        :param high: number of pending callbacks at which backpressure
+                     starts, None for no limit
+        :param low: number at which it ends, by default half of <high>
+        :param overflow: Overflow policy while under backpressure
+        :param onChange: called with True when backpressure starts and
+                         with False when it ends
+        '''
+        if overflow not in (Overflow.BLOCK, Overflow.DROP_OLDEST,
+                            Overflow.COALESCE):
+            raise ValueError("overflow must be an Overflow.")
+        if overflow == Overflow.DROP_OLDEST and type(self) is Dispatcher:
+            raise ValueError("DROP_OLDEST needs DispatchMode BATCH or POOL.")
+        if high is not None:
+            if high < 1:
+                raise ValueError("high must be at least 1.")
+            if low is None:
+                low = high // 2
+            if not 0 <= low < high:
+                raise ValueError("low must be between 0 and high.")
+        self._high = high
+        self._low = low
+        self._overflow = overflow
+        self._onChange = onChange
+        self._coalescing = (self._backpressured and
+                            overflow == Overflow.COALESCE)
+        if self._backpressured and (high is None or self.pending <= low):
+            self._setBackpressure(False)
+
+    def dispatch(self, addr, callback, val):
+        '''
+        Schedules callback(val) for a message received for addr.
+        Can be called from anywhere. Between begin() and flush() the
+        callbacks are only collected, otherwise they get scheduled at once.
+        '''
+        if self._coalescing or self._latest:
+            callback, val = self._coalesce(addr, callback, val)
+            if callback is None:
+                return
+        self._enqueued(1)
+        gevent.spawn(self._run, callback, val, time.perf_counter())
+
+    def begin(self):
+        '''
+        Collects what gets dispatched until the next flush().
+        Called before the lines of a recv get processed.
+        '''
+        self._collecting = True
+
+    def flush(self):
+        '''
+        Hands everything dispatched since begin() to the workers.
+        Called once after all lines of a recv have been processed.
+        '''
+        self._collecting = False
+
+    def throttle(self):
+        '''
+        Waits until the backpressure is over if the policy is BLOCK.
+        Called before reading from the socket again.
+        '''
+        if self._backpressured and self._overflow == Overflow.BLOCK:
+            start = time.perf_counter()
+            self._relieved.wait()
+            self.blockedTime += time.perf_counter() - start
+
+    def backpressured(self):
+        '''
+        Returns whether the dispatcher is under backpressure.
+        '''
+        return self._backpressured
+
+    def stats(self):
+        '''
+        Returns a dict of counters: messages dispatched, currently queued and
+        the maximum queued so far, callbacks that raised, and the mean and
+        maximum latency in seconds between receiving a message and starting
+        its callback. With limits also callbacks pending, dropped and
+        coalesced, how often backpressure started, whether it is on, and
+        the seconds reads were blocked.
+        '''
+        done = self.dispatched - self.queued
+        stats = {
+            "dispatched": self.dispatched,
+            "queued": self.queued,
+            "maxQueued": self.maxQueued,
+            "errors": self.errors,
+            "latencyMean": self.latencyTotal / done if done else 0.0,
+            "latencyMax": self.latencyMax,
+        }
+        if self._high is not None:
+            stats.update({
+                "pending": self.pending,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "backpressures": self.backpressures,
+                "backpressured": self._backpressured,
+                "blockedTime": self.blockedTime,
+            })
+        return stats
+
+    def _enqueued(self, n):
+        self.dispatched += n
+        self.queued += n
+        self.pending += n
+        high = self._high
+        if high is not None and self.pending >= high:
+            if not self._backpressured:
+                self._setBackpressure(True)
+            if (self._overflow == Overflow.DROP_OLDEST and
+                    self.pending > high):
+                self._drop(self.pending - high)
+        if self.queued > self.maxQueued:
+            self.maxQueued = self.queued
+
+    def _setBackpressure(self, active):
+        self._backpressured = active
+        self._coalescing = active and self._overflow == Overflow.COALESCE
+        if active:
+            self.backpressures += 1
+            self._relieved.clear()
+        else:
+            self._relieved.set()
+        if self._onChange is not None:
+            try:
+                self._onChange(active)
+            except Exception as e:
+                self._onError(e)
+
+    def _coalesce(self, addr, callback, val):
+        # returns what to dispatch instead, (None, None) if a callback
+        # waiting already gets the value. Metrics wrap callbacks anew for
+        # every message, __wrapped__ is the callback itself.
+        # A callback coalesced under an earlier backpressure may still be
+        # waiting after it ended, values of its key go to it until it ran,
+        # or they would overtake it.
+        key = (addr, getattr(callback, "__wrapped__", callback))
+        latest = self._latest
+        if key in latest:
+            latest[key] = (callback, val)
+            self.coalesced += 1
+            return None, None
+        if not self._coalescing:
+            return callback, val
+        latest[key] = (callback, val)
+        return self._runLatest, key
+
+    def _runLatest(self, key):
+        callback, val = self._latest.pop(key)
+        callback(val)
+
+    def _drop(self, n):
+        raise NotImplementedError
+
+    def _run(self, callback, val, queuedAt):
+        latency = time.perf_counter() - queuedAt
+        self.latencyTotal += latency
+        if latency > self.latencyMax:
+            self.latencyMax = latency
+        self.queued -= 1
+        try:
+            callback(val)
+        except Exception as e:
+            self.errors += 1
+            self._onError(e)
+        self.pending -= 1
+        if self._backpressured and self.pending <= self._low:
+            self._setBackpressure(False)
+
+
+class _LaneDispatcher(Dispatcher):
+    # Runs callbacks on worker greenlets, each working off a lane: a deque
+    # of (batch, queuedAt), every batch a deque of (callback, val). The
+    # first batch of a lane may be running, only the worker removes it.
+    def __init__(self, onError, size):
+        Dispatcher.__init__(self, onError)
+        self._lanes = [deque() for _ in range(size)]
+        self._wakes = [gevent.event.Event() for _ in range(size)]
+        # callbacks not started yet per lane
+        self._waiting = [0] * size
+        self._workers = None
+
+    def _put(self, batches):
+        queuedAt = time.perf_counter()
+        n = 0
+        for i, batch in enumerate(batches):
+            if batch:
+                n += len(batch)
+                self._waiting[i] += len(batch)
+                self._lanes[i].append((batch, queuedAt))
+                self._wakes[i].set()
+        if not n:
+            return
+        if self._workers is None:
+            self._workers = [gevent.spawn(self._work, i)
+                             for i in range(len(self._lanes))]
+        self._enqueued(n)
+
+    def _work(self, i):
+        lane = self._lanes[i]
+        wake = self._wakes[i]
+        waiting = self._waiting
+        while True:
+            while lane:
+                batch, queuedAt = lane[0]
+                while batch:
+                    callback, val = batch.popleft()
+                    waiting[i] -= 1
+                    self._run(callback, val, queuedAt)
+                lane.popleft()
+            wake.clear()
+            wake.wait()
+
+    def _drop(self, n):
+        # drops the <n> oldest callbacks not started yet, always from the
+        # lane with the most of them, so no address loses all its values
+        waiting = self._waiting
+        lanes = range(len(waiting))
+        dropped = 0
+        while dropped < n:
+            i = max(lanes, key=waiting.__getitem__)
+            if not waiting[i]:
+                break
+            _firstWaiting(self._lanes[i])[0].popleft()
+            waiting[i] -= 1
+            dropped += 1
+        self.dropped += dropped
+        self.queued -= dropped
+        self.pending -= dropped
+
+
+class BatchDispatcher(_LaneDispatcher):
+    '''
+    Runs the callbacks of each recv in order on one worker greenlet.
+    '''
+    def __init__(self, onError):
+        _LaneDispatcher.__init__(self, onError, 1)
+        self._batch = deque()
+
+    def dispatch(self, addr, callback, val):
+        if self._coalescing or self._latest:
+            callback, val = self._coalesce(addr, callback, val)
+            if callback is None:
+                return
+        self._batch.append((callback, val))
+        if not self._collecting:
+            self.flush()
+
+    def flush(self):
+        self._collecting = False
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = deque()
+        self._put((batch,))
+
+
+class PoolDispatcher(_LaneDispatcher):
+    '''
+    Runs the callbacks of each recv on a fixed number of worker greenlets.
+    All messages for one address go to the same worker, in order.
+    :param size: number of worker greenlets
+    '''
+    def __init__(self, onError, size=4):
+        _LaneDispatcher.__init__(self, onError, size)
+        self._batches = [deque() for _ in range(size)]
+
+    def dispatch(self, addr, callback, val):
+        if self._coalescing or self._latest:
+            callback, val = self._coalesce(addr, callback, val)
+            if callback is None:
+                return
+        # hashing a tuple mixes the bits, plain addresses are mostly aligned
+        batches = self._batches
+        batches[hash((addr,)) % len(batches)].append((callback, val))
+        if not self._collecting:
+            self.flush()
+
+    def flush(self):
+        self._collecting = False
+        batches = self._batches
+        if not any(batches):
+            return
+        self._batches = [deque() for _ in batches]
+        self._put(batches)
+
+
+def _firstWaiting(lane):
+    # returns the first (batch, queuedAt) of <lane> with callbacks not
+    # started yet, or None. Emptied batches behind the first one, which
+    # may be running, get removed.
+    if not lane:
+        return None
+    if lane[0][0]:
+        return lane[0]
+    while len(lane) > 1:
+        if lane[1][0]:
+            return lane[1]
+        del lane[1]
+    return None
@@ -0,0 +1,269 @@
+'''
+Playing back pad inputs on time.
+
+InputScheduler keeps the state of every emulated pad and sends it to
+Dolphin when it changes, and again shortly before Dolphin would hand the
+pad back to the real controller (after roughly half a second). Inputs are
+scheduled at absolute times on the monotonic clock, so delays don't add
+up, and all pads sent at the same time go out in one batch.
+
+    inputs = InputScheduler(dolphin)
+    inputs.start()
+    inputs.play([
+        (0,  Pad.GC, 0, GCPadButtons.A, None),
+        (10, Pad.GC, 0, GCPadButtons.NONE, GCPadSticks.UP),
+        (40, Pad.GC, 0, GCPadButtons.NONE, GCPadSticks.NONE),
+    ], fps=60)
+
+Inputs for the same pad arriving faster than <minInterval> are coalesced,
+only the latest state gets sent, so any number of set() calls per second
+never builds up a backlog.
+'''
+
+from __future__ import print_function, division
+
+import time
+import heapq
+import itertools
+
+import gevent
+import gevent.event
+
+from .buttons import GCPadSticks, buttonMask
+from .metrics import Histogram
+from .protocol import DolphinNotConnected, logger
+from .util import enum
+
+Pad = enum(
+    GC  = 1,
+    WII = 2,
+)
+
+_neutralSticks = (0.0, 0.0, 0.0, 0.0)
+_neutral = (0, _neutralSticks)
+
+
+def stickPositions(sticks):
+    '''
+    Returns the (stickX, stickY, substickX, substickY) tuple of <sticks>,
+    which is either a GCPadSticks member or a tuple of 2 or 4 positions.
+    '''
+    if sticks is None:
+        return _neutralSticks
+    if isinstance(sticks, GCPadSticks):
+        sticks = sticks.value
+    if len(sticks) == 2:
+        sticks = tuple(sticks) + (0.0, 0.0)
+    return tuple(float(v) for v in sticks)
+
+
+class InputScheduler(object):
+    def __init__(self, connection, refresh=0.4, minInterval=1 / 60):
+        '''
+        Creating a new InputScheduler for a DolphinConnection. Nothing gets
+        sent until start() got called.
+        :param refresh: seconds after which a pad state other than neutral
+                        gets sent again, to keep Dolphin from handing the
+                        pad back to the real controller
+        :param minInterval: minimum seconds between two sends for the same
+                            pad, changes in between are coalesced
+        '''
+        self._conn = connection
+        self._refresh = refresh
+        self._minInterval = minInterval
+        # (due, seq, (pad, index), buttons, sticks)
+        self._queue = []
+        self._seq = itertools.count()
+        # (pad, index) -> (buttons, sticks)
+        self._states = {}
+        # (pad, index) -> (state, monotonic time) of the last send
+        self._sent = {}
+        # (pad, index) -> time the current unsent state was due
+        self._dueSince = {}
+        self._wake = gevent.event.Event()
+        self._runner = None
+        self.lateness = Histogram()
+        self._stats = {"inputs": 0, "coalesced": 0, "sends": 0,
+                       "refreshes": 0, "writes": 0, "errors": 0}
+
+    def start(self):
+        '''
+        Starts playing back the scheduled inputs.
+        '''
+        if self._runner is None:
+            self._runner = gevent.spawn(self._run)
+
+    def stop(self):
+        '''
+        Stops playing back. Scheduled inputs stay scheduled.
+        '''
+        if self._runner is not None:
+            self._runner.kill()
+            self._runner = None
+
+    def set(self, pad, index, buttons=None, sticks=None, at=None):
+        '''
+        Schedules a pad state.
+        :param pad: Pad.GC or Pad.WII
+        :param index: 0-3, index of the pad
+        :param buttons: buttons held, see buttons.buttonMask(). None keeps
+                        the current ones.
+        :param sticks: GCPad stick positions, see stickPositions(). None
+                       keeps the current ones.
+        :param at: time.monotonic() time to apply it at, None for now
+        '''
+        if pad not in (Pad.GC, Pad.WII):
+            raise ValueError("pad must be a Pad.")
+        if at is None:
+            at = time.monotonic()
+        if buttons is not None:
+            buttons = buttonMask(buttons)
+        if sticks is not None:
+            sticks = stickPositions(sticks)
+        queue = self._queue
+        wake = not queue or at < queue[0][0]
+        heapq.heappush(queue, (at, next(self._seq), (pad, index),
+                               buttons, sticks))
+        self._stats["inputs"] += 1
+        if wake:
+            self._wake.set()
+
+    def release(self, pad, index, at=None):
+        '''
+        Schedules the neutral state for a pad, after which it is handed
+        back to the real controller.
+        '''
+        self.set(pad, index, 0, _neutralSticks, at)
+
+    def play(self, timeline, start=None, fps=None):
+        '''
+        Schedules a timeline of (offset, pad, index, buttons, sticks)
+        tuples, see set().
+        :param start: time.monotonic() time the offsets are relative to,
+                      None for now
+        :param fps: if given, offsets are frame numbers at this rate,
+                    otherwise seconds
+        Returns the time.monotonic() time of the last input.
+        '''
+        if start is None:
+            start = time.monotonic()
+        scale = 1 / fps if fps else 1
+        end = start
+        for offset, pad, index, buttons, sticks in timeline:
+            end = start + offset * scale
+            self.set(pad, index, buttons, sticks, end)
+        return end
+
+    def clear(self):
+        '''
+        Drops all scheduled inputs that are not due yet.
+        '''
+        del self._queue[:]
+
+    def state(self, pad, index):
+        '''
+        Returns the current (buttons, sticks) state of a pad.
+        '''
+        return self._states.get((pad, index), _neutral)
+
+    def stats(self):
+        '''
+        Returns a dict of counters: inputs scheduled, inputs coalesced into
+        a later one before being sent, state sends, refresh sends, batched
+        writes, sends that failed, inputs still scheduled, and percentiles
+        of the lateness of sends in seconds.
+        '''
+        stats = dict(self._stats)
+        stats["scheduled"] = len(self._queue)
+        stats["lateness"] = self.lateness.snapshot()
+        return stats
+
+    ######################################
+    # private methods below
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            self._apply(now)
+            wakeAt = self._send(now)
+            queue = self._queue
+            if queue and queue[0][0] < wakeAt:
+                wakeAt = queue[0][0]
+            timeout = None
+            if wakeAt != float("inf"):
+                timeout = max(0.0, wakeAt - time.monotonic())
+            self._wake.wait(timeout)
+
+    def _apply(self, now):
+        # applies all due inputs to the pad states
+        queue = self._queue
+        states = self._states
+        dueSince = self._dueSince
+        while queue and queue[0][0] <= now:
+            due, _, key, buttons, sticks = heapq.heappop(queue)
+            old = states.get(key, _neutral)
+            new = (old[0] if buttons is None else buttons,
+                   old[1] if sticks is None else sticks)
+            if key in dueSince:
+                self._stats["coalesced"] += 1
+            else:
+                dueSince[key] = due
+            states[key] = new
+
+    def _send(self, now):
+        # sends all pads that changed or need a refresh in one batch and
+        # returns when the next send may be due
+        sends = []
+        wakeAt = float("inf")
+        for key, state in self._states.items():
+            last = self._sent.get(key)
+            if last is None:
+                lastState, lastTime = _neutral, float("-inf")
+            else:
+                lastState, lastTime = last
+            if state != lastState:
+                earliest = lastTime + self._minInterval
+                if now >= earliest:
+                    due = max(self._dueSince.get(key, now), earliest)
+                    sends.append((key, state, now - due, False))
+                    if state != _neutral:
+                        wakeAt = min(wakeAt, now + self._refresh)
+                else:
+                    wakeAt = min(wakeAt, earliest)
+                continue
+            # changed back before it got sent
+            self._dueSince.pop(key, None)
+            if state != _neutral:
+                refreshAt = lastTime + self._refresh
+                if now >= refreshAt:
+                    sends.append((key, state, now - refreshAt, True))
+                    wakeAt = min(wakeAt, now + self._refresh)
+                else:
+                    wakeAt = min(wakeAt, refreshAt)
+        if not sends:
+            return wakeAt
+        conn = self._conn
+        try:
+            with conn.batch():
+                for (pad, index), (buttons, sticks), _, _ in sends:
+                    if pad == Pad.GC:
+                        conn.gcButton(index, buttons, *sticks)
+                    else:
+                        conn.wiiButton(index, buttons)
+        except DolphinNotConnected:
+            # keep the states unsent and try again later
+            self._stats["errors"] += len(sends)
+            logger.debug("InputScheduler could not send, not connected.")
+            return min(wakeAt, now + self._refresh)
+        stats = self._stats
+        stats["writes"] += 1
+        for key, state, late, refresh in sends:
+            self._sent[key] = (state, now)
+            self._dueSince.pop(key, None)
+            self.lateness.record(late)
+            if refresh:
+                stats["refreshes"] += 1
+            else:
+                stats["sends"] += 1
+        return wakeAt
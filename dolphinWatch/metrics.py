@@ -0,0 +1,300 @@
+'''
+Opt-in instrumentation of a connection: counters, latency histograms and
+the callback time spent per address.
+
+Nothing is measured until metrics get enabled on a connection:
+
+    metrics = dolphin.enableMetrics()
+    ...
+    print(metrics.prometheus())
+    print(metrics.hotAddresses(5))
+
+Exporters are plain functions called with snapshot() by export(), e.g. to
+push the numbers somewhere periodically.
+'''
+
+from __future__ import print_function, division
+
+import re
+import time
+
+# counter name -> help text
+COUNTERS = {
+    "bytesIn":         "Bytes received.",
+    "bytesOut":        "Bytes sent.",
+    "recvs":           "Receive calls that returned data.",
+    "sends":           "Send calls.",
+    "linesParsed":     "Text lines parsed.",
+    "framesParsed":    "Binary frames parsed.",
+    "callbacks":       "Callbacks dispatched.",
+    "callbackErrors":  "Callbacks that raised an exception.",
+    "unknownCommands": "Incoming lines with an unknown command.",
+    "noRecipient":     "Incoming values nobody subscribed to.",
+    "feedbacks":       "SUCCESS and FAIL feedbacks received.",
+}
+
+
+class Histogram(object):
+    '''
+    Histogram of durations in the manner of HdrHistogram: exact below
+    2**<precision> microseconds, above that the buckets grow with the
+    value, so the relative error stays below 2**-<precision> while
+    recording is a few integer operations.
+    '''
+    def __init__(self, precision=5):
+        self._bits = precision
+        self._sub = 1 << precision
+        self._counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        '''
+        Adds a duration in seconds.
+        '''
+        us = int(seconds * 1e6)
+        if us < 2 * self._sub:
+            index = max(us, 0)
+        else:
+            shift = us.bit_length() - self._bits - 1
+            index = shift * self._sub + (us >> shift)
+        counts = self._counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+
+    def percentile(self, p):
+        '''
+        Returns the duration in seconds below which <p> percent of the
+        recorded durations are, or None if nothing was recorded.
+        '''
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * p / 100)))
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if seen >= rank:
+                return min(self._middle(index) / 1e6, self.max)
+        return self.max
+
+    def mean(self):
+        '''
+        Returns the mean duration in seconds, or None if nothing was
+        recorded.
+        '''
+        return self.total / self.count if self.count else None
+
+    def snapshot(self):
+        '''
+        Returns a dict of count, sum, min, max, mean and the 50th, 90th,
+        99th and 99.9th percentile, all in seconds.
+        '''
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+        }
+
+    def reset(self):
+        '''
+        Forgets all recorded durations.
+        '''
+        self.__init__(self._bits)
+
+    def _middle(self, index):
+        if index < 2 * self._sub:
+            return index
+        shift = index // self._sub - 1
+        top = index - shift * self._sub
+        return (top << shift) + (1 << shift) // 2
+
+
+class Metrics(object):
+    '''
+    Counters and histograms of one connection.
+    counters is a dict of the names in COUNTERS to their values.
+    parseTime measures the time spent splitting and parsing each received
+    chunk, callbackTime the run time of each callback, feedbackRtt the time
+    from sending a LOAD to its feedback and readRtt the same for reads.
+    '''
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.parseTime = Histogram()
+        self.callbackTime = Histogram()
+        self.feedbackRtt = Histogram()
+        self.readRtt = Histogram()
+        # addr -> [callbacks, seconds spent in them]
+        self.addresses = {}
+        self._exporters = []
+        self.started = time.time()
+
+    def histograms(self):
+        '''
+        Returns a dict of all histograms by name.
+        '''
+        return {
+            "parseTime": self.parseTime,
+            "callbackTime": self.callbackTime,
+            "feedbackRtt": self.feedbackRtt,
+            "readRtt": self.readRtt,
+        }
+
+    def hotAddresses(self, n=10):
+        '''
+        Returns the <n> addresses whose callbacks took the most time, as
+        a list of (address, callbacks, seconds) tuples.
+        '''
+        hot = sorted(self.addresses.items(), key=lambda item: -item[1][1])
+        return [(addr, calls, seconds) for addr, (calls, seconds) in hot[:n]]
+
+    def snapshot(self):
+        '''
+        Returns all counters, histogram snapshots and the callback time
+        per address as one dict.
+        '''
+        snapshot = dict(self.counters)
+        for name, histogram in self.histograms().items():
+            snapshot[name] = histogram.snapshot()
+        snapshot["addresses"] = {
+            "0x%08x" % addr: {"callbacks": calls, "seconds": seconds}
+            for addr, (calls, seconds) in self.addresses.items()}
+        snapshot["uptime"] = time.time() - self.started
+        return snapshot
+
+    def reset(self):
+        '''
+        Sets all counters back to 0 and forgets all measurements.
+        Exporters stay.
+        '''
+        exporters = self._exporters
+        self.__init__()
+        self._exporters = exporters
+
+    def addExporter(self, func):
+        '''
+        Adds a function that gets called with snapshot() on every
+        export().
+        '''
+        if not hasattr(func, '__call__'):
+            raise ValueError("exporter must be callable.")
+        self._exporters.append(func)
+
+    def removeExporter(self, func):
+        '''
+        Removes an exporter added with addExporter().
+        '''
+        self._exporters.remove(func)
+
+    def export(self):
+        '''
+        Calls all exporters with a snapshot.
+        '''
+        if self._exporters:
+            snapshot = self.snapshot()
+            for func in self._exporters:
+                func(snapshot)
+
+    def prometheus(self, prefix="dolphinwatch", labels=None):
+        '''
+        Returns all metrics in the Prometheus text exposition format.
+        Histograms are exported as summaries.
+        :param labels: dict of labels added to every sample, e.g. to tell
+                       instances apart
+        '''
+        lines = []
+        for name, text in COUNTERS.items():
+            metric = "%s_%s_total" % (prefix, _snake(name))
+            lines.append("# HELP %s %s" % (metric, text))
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s%s %d" % (metric, _labels(labels),
+                                      self.counters[name]))
+        for name, histogram in self.histograms().items():
+            metric = "%s_%s_seconds" % (prefix, _snake(name))
+            lines.append("# TYPE %s summary" % metric)
+            for q, p in ((0.5, 50), (0.9, 90), (0.99, 99), (0.999, 99.9)):
+                value = histogram.percentile(p)
+                lines.append("%s%s %s" % (
+                    metric, _labels(labels, quantile=q),
+                    "NaN" if value is None else repr(value)))
+            lines.append("%s_sum%s %r" % (metric, _labels(labels),
+                                          histogram.total))
+            lines.append("%s_count%s %d" % (metric, _labels(labels),
+                                            histogram.count))
+        metric = "%s_address_callback_seconds_total" % prefix
+        lines.append("# TYPE %s counter" % metric)
+        for addr, (calls, seconds) in sorted(self.addresses.items()):
+            lines.append("%s%s %r" % (
+                metric, _labels(labels, addr="0x%08x" % addr), seconds))
+        metric = "%s_address_callbacks_total" % prefix
+        lines.append("# TYPE %s counter" % metric)
+        for addr, (calls, seconds) in sorted(self.addresses.items()):
+            lines.append("%s%s %d" % (
+                metric, _labels(labels, addr="0x%08x" % addr), calls))
+        return "\n".join(lines) + "\n"
+
+    def _received(self, size, messages, binary, seconds):
+        # one chunk of <size> bytes with <messages> lines or frames parsed
+        # in <seconds>
+        counters = self.counters
+        counters["bytesIn"] += size
+        counters["recvs"] += 1
+        counters["framesParsed" if binary else "linesParsed"] += messages
+        self.parseTime.record(seconds)
+
+    def _sent(self, size):
+        self.counters["bytesOut"] += size
+        self.counters["sends"] += 1
+
+    def _measure(self, addr, callback):
+        # wraps a callback to count it and its run time for addr
+        def measured(val):
+            start = time.perf_counter()
+            try:
+                callback(val)
+            except Exception:
+                self.counters["callbackErrors"] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                self.callbackTime.record(elapsed)
+                stats = self.addresses.get(addr)
+                if stats is None:
+                    stats = self.addresses[addr] = [0, 0.0]
+                stats[0] += 1
+                stats[1] += elapsed
+        measured.__wrapped__ = callback
+        return measured
+
+    def _timeRequest(self, histogram, request):
+        # records the time until request is done in histogram
+        start = time.perf_counter()
+        request._link(lambda _: histogram.record(time.perf_counter() - start))
+
+
+def _snake(name):
+    return re.sub(r"([A-Z])", r"_\1", name).lower()
+
+
+def _labels(labels, **extra):
+    if extra:
+        labels = dict(labels or {}, **extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace(
+        "\\", "\\\\").replace('"', '\\"')) for key, value in
+        sorted(labels.items()))
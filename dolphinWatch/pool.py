@@ -0,0 +1,310 @@
+'''
+Managing many Dolphin instances at once.
+'''
+
+from __future__ import print_function, division
+
+import gevent
+from gevent.queue import Queue
+
+from .connection import DolphinConnection
+from .protocol import logger
+
+# put into a PoolStream's queue on closing it, behind the updates
+_end = object()
+
+
+class DolphinPool(object):
+    def __init__(self, addresses, **kwargs):
+        '''
+        Creating a new DolphinPool of one DolphinConnection per (host, port)
+        tuple in <addresses>. Further keyword arguments are passed on to
+        the connections.
+        The pool takes over the onConnect and onDisconnect callbacks of its
+        connections, use the pool's instead.
+        Connections can be accessed by index, e.g. pool[2].subscribe8(...)
+        to route a subscription to the third instance.
+        '''
+        self.connections = [DolphinConnection(host, port, **kwargs)
+                            for host, port in addresses]
+        self._cFunc = None
+        self._dcFunc = None
+        # open PoolStreams of subscribeAll()
+        self._streams = set()
+        for index, conn in enumerate(self.connections):
+            conn.onConnect(lambda conn, index=index:
+                           self._onConnect(index, conn))
+            conn.onDisconnect(lambda conn, reason, index=index:
+                              self._onDisconnect(index, conn, reason))
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __getitem__(self, index):
+        return self.connections[index]
+
+    def __iter__(self):
+        return iter(self.connections)
+
+    def connect(self):
+        '''
+        Connects all instances concurrently and waits until every attempt
+        succeeded or failed.
+        Returns a list of whether each instance is connected now.
+        '''
+        gevent.joinall([gevent.spawn(conn.connect)
+                        for conn in self.connections])
+        return [conn.isConnected() for conn in self.connections]
+
+    def disconnect(self):
+        '''
+        Disconnects all instances.
+        '''
+        for conn in self.connections:
+            conn.disconnect()
+
+    def connected(self):
+        '''
+        Returns the indices of the currently connected instances.
+        '''
+        return [index for index, conn in enumerate(self.connections)
+                if conn.isConnected()]
+
+    def onConnect(self, func):
+        '''
+        Sets the callback that will be called after a connection to any
+        instance has been successfully established, with the index and the
+        DolphinConnection as parameters.
+        '''
+        if not hasattr(func, '__call__'):
+            raise ValueError("onConnect callback must be callable.")
+        self._cFunc = func
+
+    def onDisconnect(self, func):
+        '''
+        Sets the callback that will be called after a connection attempt to
+        any instance fails, or its connection gets closed or lost, with the
+        index, the DolphinConnection and a DisconnectReason as parameters.
+        '''
+        if not hasattr(func, '__call__'):
+            raise ValueError("onDisconnect callback must be callable.")
+        self._dcFunc = func
+
+    def broadcast(self, method, *args, **kwargs):
+        '''
+        Calls the DolphinConnection method named <method> with the given
+        arguments on all connected instances.
+        Commands only get buffered and are sent at the end of the event loop
+        iteration, so this does not need a greenlet per instance.
+        Returns a list with the result of each instance, the raised exception
+        for those that failed, and None for those that are not connected.
+        '''
+        results = []
+        for conn in self.connections:
+            if not conn.isConnected():
+                results.append(None)
+                continue
+            try:
+                results.append(getattr(conn, method)(*args, **kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def broadcastWait(self, method, *args, **kwargs):
+        '''
+        Like broadcast(), but for blocking methods like load(). They are run
+        in parallel, one greenlet per instance, and this waits for all of
+        them.
+        '''
+        def call(conn):
+            try:
+                return getattr(conn, method)(*args, **kwargs)
+            except Exception as e:
+                return e
+        greenlets = [gevent.spawn(call, conn) if conn.isConnected() else None
+                     for conn in self.connections]
+        gevent.joinall([g for g in greenlets if g is not None])
+        return [g.value if g is not None else None for g in greenlets]
+
+    def pause(self):
+        '''
+        Pauses all instances, see DolphinConnection.pause().
+        '''
+        return self.broadcast("pause")
+
+    def resume(self):
+        '''
+        Resumes all instances, see DolphinConnection.resume().
+        '''
+        return self.broadcast("resume")
+
+    def reset(self):
+        '''
+        Resets all instances, see DolphinConnection.reset().
+        '''
+        return self.broadcast("reset")
+
+    def speed(self, s):
+        '''
+        Sets the emulation speed of all instances, see
+        DolphinConnection.speed().
+        '''
+        return self.broadcast("speed", s)
+
+    def volume(self, v):
+        '''
+        Sets the audio level of all instances, see DolphinConnection.volume().
+        '''
+        return self.broadcast("volume", v)
+
+    def save(self, filename):
+        '''
+        Makes all instances save a savestate to <filename>, see
+        DolphinConnection.save().
+        '''
+        return self.broadcast("save", filename)
+
+    def load(self, filename, timeout=None):
+        '''
+        Makes all instances load the savestate at <filename> in parallel and
+        waits for all of them, see DolphinConnection.load().
+        '''
+        return self.broadcastWait("load", filename, timeout)
+
+    def wiiButton(self, wiimoteIndex, buttonstates):
+        '''
+        Sends the Wiimote buttonstates to all instances, see
+        DolphinConnection.wiiButton().
+        '''
+        return self.broadcast("wiiButton", wiimoteIndex, buttonstates)
+
+    def gcButton(self, gcpadIndex, buttonstates, stickX=0.0, stickY=0.0,
+                 substickX=0.0, substickY=0.0):
+        '''
+        Sends the GCPad buttonstates to all instances, see
+        DolphinConnection.gcButton().
+        '''
+        return self.broadcast("gcButton", gcpadIndex, buttonstates,
+                              stickX, stickY, substickX, substickY)
+
+    def subscribeAll(self, method, *args, **kwargs):
+        '''
+        Subscribes to the same data on all instances and merges the updates
+        into one stream. <method> is the name of a subscribe method, e.g.
+        "subscribe32", and <args> its arguments without the callback.
+        Instances connecting later, or again, get subscribed as they
+        connect.
+        Returns a PoolStream of (index, value) tuples, which can be iterated
+        over. close() it to unsubscribe everywhere.
+        :param maxsize: number of updates the PoolStream keeps for a consumer
+                        that can't keep up, the oldest get dropped beyond
+        '''
+        stream = PoolStream(self, method, args, kwargs.pop("maxsize", 1024))
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s" %
+                            ", ".join(kwargs))
+        self._streams.add(stream)
+        for index in self.connected():
+            stream._subscribe(index, self.connections[index])
+        return stream
+
+    ######################################
+    # private methods below
+
+    def _onConnect(self, index, conn):
+        logger.debug("DolphinPool instance %d connected.", index)
+        for stream in list(self._streams):
+            stream._subscribe(index, conn)
+        if self._cFunc:
+            self._cFunc(index, conn)
+
+    def _onDisconnect(self, index, conn, reason):
+        logger.debug("DolphinPool instance %d disconnected.", index)
+        for stream in list(self._streams):
+            stream._unsubscribe(index)
+        if self._dcFunc:
+            self._dcFunc(index, conn, reason)
+
+
+class PoolStream(object):
+    '''
+    The updates of one subscription on all instances of a DolphinPool,
+    merged into (index, value) tuples. Iterating over it, or get(), waits
+    for the next one.
+    Keeps at most <maxsize> updates. If the consumer can't keep up, the
+    oldest get dropped and counted in <dropped>.
+    '''
+    def __init__(self, pool, method, args, maxsize):
+        self._pool = pool
+        self._method = method
+        self._args = args
+        # bounded by _put, so the end marker always fits
+        self._queue = Queue()
+        self._maxsize = maxsize
+        self._closed = False
+        # index -> Listener on that instance
+        self._listeners = {}
+        self.dropped = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    next = __next__
+
+    def __len__(self):
+        return self._queue.qsize() - self._closed
+
+    def get(self, block=True, timeout=None):
+        '''
+        Returns the next (index, value) tuple, see gevent.queue.Queue.get().
+        Raises StopIteration once the stream got closed and the updates
+        received before are through.
+        '''
+        item = self._queue.get(block, timeout)
+        if item is _end:
+            # ends every other waiting get() as well
+            self._queue.put_nowait(item)
+            raise StopIteration
+        return item
+
+    def close(self):
+        '''
+        Unsubscribes on all instances. Iterating ends after the updates
+        received so far.
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self._pool._streams.discard(self)
+        for index in list(self._listeners):
+            self._unsubscribe(index)
+        self._queue.put_nowait(_end)
+
+    ######################################
+    # private methods below
+
+    def _subscribe(self, index, conn):
+        if index in self._listeners:
+            return
+        callback = lambda val: self._put((index, val))
+        self._listeners[index] = getattr(conn, self._method)(
+            *(self._args + (callback,)))
+
+    def _unsubscribe(self, index):
+        # a lost instance gets subscribed anew once connected again
+        listener = self._listeners.pop(index, None)
+        if listener is not None:
+            self._pool.connections[index].unsubscribe(listener)
+
+    def _put(self, item):
+        if self._closed:
+            # dispatched before unsubscribing
+            return
+        queue = self._queue
+        if self._maxsize and queue.qsize() >= self._maxsize:
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(item)
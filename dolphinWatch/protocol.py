@@ -0,0 +1,988 @@
+'''
+The parts of the DolphinWatch protocol that don't depend on how the
+socket is driven: encoding of all commands, parsing of incoming lines and
+matching answers to outstanding requests.
+DolphinConnection (gevent) and AsyncDolphinConnection (asyncio) are both
+built on BaseConnection.
+'''
+
+from __future__ import print_function, division
+
+import socket
+import struct
+import logging
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+
+from .buttons import buttonMask
+from .util import enum, typeSize, decode
+from .metrics import Metrics
+from .subscriptions import SubscriptionRegistry
+from .trace import TraceRecorder
+
+logger = logging.getLogger("dolphinWatch")
+logger_verbose = logging.getLogger("dolphinWatch.verbose")
+
+DisconnectReason = enum(
+    CONNECTION_CLOSED_BY_PEER  = 1,
+    CONNECTION_CLOSED_BY_HOST  = 2,
+    CONNECTION_LOST            = 3,
+    CONNECTION_NOT_ESTABLISHED = 4,
+)
+
+_log_translation = {
+    1: 20,
+    2: 40,
+    3: 30,
+    4: 20,
+    5: 10,
+}
+
+Framing = enum(
+    TEXT   = 1,
+    BINARY = 2,
+)
+
+# Sent by the client right after connecting to ask for binary framing. A
+# server supporting it answers with the same line and sends binary frames
+# from then on. Commands sent to the server stay text either way.
+FRAMING_REQUEST = b"FRAMING BINARY"
+
+# binary frame types, see FrameBuffer
+FRAME_TEXT      = 0  # payload: one text line without the line ending
+FRAME_MEM       = 1  # payload: u32 address, u32 value
+FRAME_MEM_MULTI = 2  # payload: u32 address, raw memory
+
+_frameHeader = struct.Struct(">BI")
+_memFrame = struct.Struct(">II")
+_addrField = struct.Struct(">I")
+
+# decimal byte token -> value, a lot cheaper than int() for MEM_MULTI data
+_byteValues = {str(v).encode(): v for v in range(256)}
+# and the other way round, for WRITE_MULTI
+_byteTokens = {v: token for token, v in _byteValues.items()}
+
+
+# Button commands get sent over and over with the same few states, so
+# their encoded bytes are cached. The stick positions are part of the key
+# as they are, which keeps the output the same as formatting every time.
+@lru_cache(maxsize=4096)
+def _gcButtonCmd(index, buttons, stickX, stickY, substickX, substickY):
+    return b"BUTTONSTATES_GC %d %d %f %f %f %f" % (
+        index, buttonMask(buttons), stickX, stickY, substickX, substickY)
+
+
+@lru_cache(maxsize=1024)
+def _wiiButtonCmd(index, buttons):
+    return b"BUTTONSTATES_WII %d %d" % (index, buttonMask(buttons))
+
+
+class DolphinNotConnected(socket.error):
+    pass
+
+
+class DolphinTimeout(Exception):
+    pass
+
+
+class DolphinRequestCancelled(Exception):
+    pass
+
+
+def _verboseLine(line):
+    dstrlist = []
+    for part in line.split(b" "):
+        try:
+            dstrlist.append("{:02X}".format(int(part)))
+        except ValueError:
+            dstrlist.append(part.decode(errors="replace"))
+    return " ".join(dstrlist)
+
+
+def _logCallbackError(e):
+    if isinstance(e, DolphinNotConnected):
+        logger.debug("Exception raised to dolphin callback", exc_info=e)
+    else:
+        logger.error("Exception raised to dolphin callback", exc_info=e)
+
+
+class LineBuffer(object):
+    '''
+    Splits incoming data into lines.
+    Only newly arrived bytes are scanned for a line ending, so a line
+    spanning many reads is not rescanned over and over, and all complete
+    lines are split off in one go.
+    '''
+    def __init__(self):
+        self._buf = bytearray()
+        self._scanned = 0
+
+    def feed(self, data):
+        '''
+        Appends <data> and returns a list of all lines completed by it, as
+        bytes without the line ending.
+        '''
+        buf = self._buf
+        buf += data
+        end = buf.rfind(b"\n", self._scanned)
+        if end < 0:
+            self._scanned = len(buf)
+            return []
+        with memoryview(buf) as complete:
+            lines = complete[:end].tobytes().split(b"\n")
+        del buf[:end + 1]
+        self._scanned = len(buf)
+        return [line.strip() for line in lines]
+
+
+class FrameBuffer(object):
+    '''
+    Splits incoming data into binary frames. Every frame is a 1 byte frame
+    type and a big-endian u32 payload length, followed by the payload.
+    '''
+    def __init__(self):
+        self._buf = bytearray()
+        self._need = _frameHeader.size
+
+    def feed(self, data):
+        '''
+        Appends <data> and returns a list of (frame type, payload) tuples of
+        all frames completed by it. The payloads are memoryviews into one
+        immutable copy of the data, so they stay valid after the next feed.
+        '''
+        buf = self._buf
+        buf += data
+        size = len(buf)
+        if size < self._need:
+            return []
+        chunk = bytes(buf)
+        view = memoryview(chunk)
+        unpack = _frameHeader.unpack_from
+        header = _frameHeader.size
+        frames = []
+        pos = 0
+        while True:
+            if size - pos < header:
+                self._need = header
+                break
+            kind, length = unpack(chunk, pos)
+            end = pos + header + length
+            if end > size:
+                # don't copy the buffer again until the frame is complete
+                self._need = end - pos
+                break
+            frames.append((kind, view[pos + header:end]))
+            pos = end
+        del buf[:pos]
+        return frames
+
+
+class RequestQueue(object):
+    '''
+    FIFO queues of outstanding requests, keyed by whatever identifies the
+    answer, e.g. an address.
+    Dolphin answers requests in the order they were sent, but the answers
+    don't say which request they belong to, so every answer is matched to
+    the oldest request in its queue.
+    '''
+    def __init__(self):
+        self._queues = {}
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def __contains__(self, key):
+        return key in self._queues
+
+    def push(self, key, request):
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(request)
+        return request
+
+    def pop(self, key):
+        '''
+        Removes and returns the oldest request for key, or None.
+        '''
+        queue = self._queues.get(key)
+        if not queue:
+            return None
+        request = queue.popleft()
+        if not queue:
+            del self._queues[key]
+        return request
+
+    def drain(self):
+        '''
+        Removes and returns all outstanding requests.
+        '''
+        queues = self._queues
+        self._queues = {}
+        return [request for queue in queues.values() for request in queue]
+
+
+class BaseConnection(object):
+    '''
+    Command surface and protocol handling shared by all backends.
+    Subclasses connect, move the bytes, and create the Requests.
+    '''
+    def __init__(self, host, port, flushSize):
+        self.host = host
+        self.port = port
+        self._connected = False
+        self._cFunc = None
+        self._dcFunc = None
+        # start address of a subscription on the server -> (function the
+        # values get dispatched to or None, command to subscribe again)
+        self._callbacks = {}
+        # start address -> function testing the predicates of triggers,
+        # called right away instead of dispatched
+        self._checks = {}
+        self._registry = SubscriptionRegistry(self, self._onListenerError)
+        self._sep = b"\n"
+        self._framing = Framing.TEXT
+        self._out = bytearray()
+        self._flushSize = flushSize
+        self._flushScheduled = False
+        self._sendStats = {"commands": 0, "bytes": 0, "sends": 0}
+        self._reads = RequestQueue()
+        self._blockReads = {}
+        self._feedbacks = RequestQueue()
+        self._metrics = None
+        self._recorder = None
+
+    def isConnected(self):
+        '''
+        Returns whether the DolphinConnection instance is connected to the
+        corresponding server defined by host and port.
+        '''
+        return self._connected
+
+    def disconnect(self):
+        '''
+        Disconnects an existing socket connection from the server, if any.
+        The onDisconnect callback will be called with CONNECTION_CLOSED_BY_HOST
+        '''
+        if self._connected:
+            logger.info("DolphinConnection connection closed by host.")
+            self._disconnect(DisconnectReason.CONNECTION_CLOSED_BY_HOST)
+        else:
+            logger.info("DolphinConnection connection is already closed.")
+
+    def _disconnect(self, reason):
+        if not self._connected:
+            return
+        self._connected = False
+        if self._out and reason == DisconnectReason.CONNECTION_CLOSED_BY_HOST:
+            # commands issued right before disconnecting still get sent,
+            # like they did before buffering
+            if self._sendRest(bytes(self._out)):
+                self._sendStats["sends"] += 1
+        del self._out[:]
+        for request in self._reads.drain():
+            request._fail(DolphinNotConnected("DolphinConnection lost its " +
+                                              "connection."))
+        blockReads = self._blockReads
+        self._blockReads = {}
+        for _, requests in blockReads.values():
+            for _, request in requests:
+                request._fail(DolphinNotConnected("DolphinConnection lost " +
+                                                  "its connection."))
+        for request in self._feedbacks.drain():
+            request._resolve(False)
+        self._registry.disconnected()
+        self._close()
+        if self._dcFunc:
+            self._dcFunc(self, reason)
+
+    def framing(self):
+        '''
+        Returns the Framing of the data sent by the server on the current
+        connection.
+        '''
+        return self._framing
+
+    def resubscribe(self):
+        '''
+        Sends the commands of all registered subscriptions again, all in one
+        send. Use this after reconnecting to restore them on the server.
+        '''
+        self._registry.forget()
+        for func, cmd in list(self._callbacks.values()):
+            if cmd:
+                self._cmd(cmd)
+        self._registry.resubscribed()
+        self.flush()
+
+    def unsubscribe(self, listener):
+        '''
+        Removes a subscription, given as the Listener returned by
+        subscribe8() and the like. Dolphin only gets told once nobody else
+        is subscribed to that memory.
+        Returns False if it was unsubscribed already.
+        '''
+        return self._registry.remove(listener)
+
+    def trigger(self, mode, addr, predicate, callback):
+        '''
+        Subscribes to <mode> bits of data at the given address, like
+        subscribe8() and the like, but only calls <callback> for values
+        <predicate> matches. Predicates are made by the functions in
+        triggers.py, e.g. below(20, edge=True). They are tested as soon as
+        a value arrives, values they don't match are never dispatched.
+        Returns a Listener, see unsubscribe().
+        '''
+        if mode not in (8, 16, 32):
+            raise ValueError("mode must be 8, 16 or 32.")
+        return self._registry.add(addr, mode // 8, False, callback,
+                                  predicate)
+
+    def triggerMulti(self, size, addr, predicate, callback):
+        '''
+        Subscribes to <size> bytes of data starting at the given address,
+        like subscribeMulti(), but only calls <callback> with the bytes
+        <predicate> matches, e.g. pattern(b"GAME OVER").
+        Returns a Listener, see unsubscribe().
+        '''
+        return self._registry.add(addr, size, True, callback, predicate)
+
+    def subscriptionStats(self):
+        '''
+        Returns a dict of the number of subscriptions, of distinct
+        (address, size) pairs among them, and of subscriptions on the
+        server serving all of them, see subscriptions.py.
+        '''
+        return self._registry.stats()
+
+    def onConnect(self, func):
+        '''
+        Sets the callback that will be called after a connection
+        has been successfully established.
+        Callback is initially None, and can again be assigned to None.
+        '''
+        if not hasattr(func, '__call__'):
+            raise ValueError("onDisconnect callback must be callable.")
+        self._cFunc = func
+
+    def onDisconnect(self, func):
+        '''
+        Sets the callback that will be called after a connection attempt fails,
+        an active connection gets closed or the connection gets lost.
+        A DisconnectReason enum will be the parameter.
+        Callback is initially None, and can again be assigned to None.
+        '''
+        if not hasattr(func, '__call__'):
+            raise ValueError("onDisconnect callback must be callable.")
+        self._dcFunc = func
+
+    @contextmanager
+    def batch(self):
+        '''
+        Context manager to send the commands issued inside it in a batch.
+        All of them are guaranteed to be executed at once in Dolphin.
+
+            with dolphin.batch():
+                dolphin.write8(0x80001234, 1)
+                dolphin.write8(0x80001235, 2)
+        '''
+        self.startBatch()
+        try:
+            yield self
+        finally:
+            self.endBatch()
+
+    def startBatch(self):
+        '''
+        Call this function to send following commands in a batch.
+        All following commands are guaranteed to be executed at once in
+        Dolphin. Is done by not executing anything until endBatch() is
+        called. Prefer the batch() context manager.
+        '''
+        self._sep = b";"
+
+    def endBatch(self):
+        '''
+        Ends the batch started with startBatch().
+        All buffered commands gets executed now and no more buffering is done.
+        '''
+        self._sep = b"\n"
+        self._cmd(b"")
+
+    def sendStats(self):
+        '''
+        Returns a dict of counters of the outgoing side: commands issued,
+        bytes and send calls made to the socket, and how many send calls
+        were saved by buffering.
+        '''
+        stats = dict(self._sendStats)
+        stats["saved"] = stats["commands"] - stats["sends"]
+        return stats
+
+    def enableMetrics(self, metrics=None):
+        '''
+        Starts measuring this connection, see metrics.Metrics.
+        Returns the Metrics, which are either the given ones, e.g. to
+        share them between connections, or new ones.
+        While disabled, measuring costs next to nothing.
+        '''
+        if metrics is None:
+            metrics = Metrics()
+        self._metrics = metrics
+        self._dispatch = self._dispatchMeasured
+        return metrics
+
+    def disableMetrics(self):
+        '''
+        Stops measuring this connection.
+        '''
+        self._metrics = None
+        self.__dict__.pop("_dispatch", None)
+
+    def metrics(self):
+        '''
+        Returns the Metrics of this connection, or None if disabled.
+        '''
+        return self._metrics
+
+    def startRecording(self, recorder, **kwargs):
+        '''
+        Starts recording all incoming MEM and MEM_MULTI values, right from
+        the receive path, to a trace file. <recorder> is either a
+        trace.TraceRecorder or the path of the trace file, with further
+        keyword arguments passed on to the TraceRecorder.
+        Returns the TraceRecorder.
+        '''
+        if not isinstance(recorder, TraceRecorder):
+            recorder = TraceRecorder(recorder, **kwargs)
+        self.stopRecording()
+        self._recorder = recorder
+        return recorder
+
+    def stopRecording(self):
+        '''
+        Stops recording and closes the trace file, if recording.
+        '''
+        recorder = self._recorder
+        self._recorder = None
+        if recorder is not None:
+            recorder.close()
+
+    def volume(self, v):
+        '''
+        Sets Dolphin's Audio.
+        :param v: 0-100, audio level
+        '''
+        self._cmd(b"VOLUME %d" % v)
+
+    def speed(self,s):
+        '''
+        Sets Dolphin's emulation speed.
+        :param s: speed as float, 1.0 being normal speed, 0.5 being half speed, etc.
+        '''
+        self._cmd(b"SPEED %f" % s)
+
+    def write(self, mode, addr, val):
+        '''
+        Sends a command to write <mode> bytes of data to the given address.
+        <mode> must be 8, 16 or 32.
+        '''
+        self._cmd(b"WRITE %d %d %d" % (mode, addr, val))
+
+    def writeMulti(self, addr, vals):
+        '''
+        Sends a command to write the bytes <vals>, starting at address <addr>.
+        '''
+        try:
+            data = b" ".join(map(_byteTokens.__getitem__, vals))
+        except KeyError:
+            data = b" ".join(b"%d" % v for v in vals)
+        self._cmd(b"WRITE_MULTI %d %s" % (addr, data))
+
+    def read(self, mode, addr, callback=None, timeout=None):
+        '''
+        Sends a command to send back <mode> bytes of data at the given address.
+        The given callback function, if any, gets called with the returned
+        value as parameter.
+        Returns a Request resolving to the value.
+        Any number of reads can be outstanding, also for the same address;
+        answers are matched to them in order. While a read is outstanding,
+        values arriving for that address go to it instead of a subscription.
+        Answers don't tell their size, so reading an address subscribed to
+        with another <mode>, e.g. read8() while subscribe32() is active,
+        raises ValueError. Use that subscription's values instead.
+        <mode> must be 8, 16 or 32.
+        :param timeout: seconds after which the Request fails with
+                        DolphinTimeout, None to wait forever
+        '''
+        subscription = self._callbacks.get(addr)
+        if subscription and subscription[1].startswith(b"SUBSCRIBE ") and \
+                subscription[1] != b"SUBSCRIBE %d %d" % (mode, addr):
+            raise ValueError("Can't read %d bits at 0x%x, it is subscribed "
+                             "to with another size." % (mode, addr))
+        self._cmd(b"READ %d %d" % (mode, addr))
+        request = self._reads.push(addr, self._newRequest(callback, timeout))
+        if self._metrics is not None:
+            self._metrics._timeRequest(self._metrics.readRtt, request)
+        return request
+
+    def readBlock(self, size, addr, callback=None, timeout=None):
+        '''
+        Sends a command to send back <size> bytes of data starting at the
+        given address, once.
+        The given callback function, if any, gets called with the returned
+        values as a bytes object as parameter, like those of
+        subscribeMulti(), not the list of ints older versions passed.
+        Returns a Request resolving to the bytes.
+        DolphinWatch has no command to read a block once, so this subscribes
+        and unsubscribes again after the first answer. Block reads of the
+        same address share one subscription. A subscribeMulti() on that
+        address gets restored afterwards.
+        :param timeout: seconds after which the Request fails with
+                        DolphinTimeout, None to wait forever
+        '''
+        pending = self._blockReads.get(addr)
+        if pending is None or size > pending[0]:
+            self._cmd(b"SUBSCRIBE_MULTI %d %d" % (size, addr))
+            requests = pending[1] if pending else []
+            pending = self._blockReads[addr] = (size, requests)
+        request = self._newRequest(callback, timeout)
+        pending[1].append((size, request))
+        if self._metrics is not None:
+            self._metrics._timeRequest(self._metrics.readRtt, request)
+        return request
+
+    def readMany(self, fields, gap=16, maxSize=1024, timeout=None):
+        '''
+        Reads many values at once with as few block reads as possible.
+        Fields closer together than <gap> bytes get merged into the same
+        block read, as long as the block stays below <maxSize> bytes.
+        Returns a Request resolving to a list of all values, in the order
+        of <fields>.
+        :param fields: list of (addr, kind) tuples. <kind> is a big-endian
+                       type name from util.TYPES, e.g. "u16" or "f32", or a
+                       byte count to get the raw bytes.
+        :param timeout: seconds after which the Request fails with
+                        DolphinTimeout, None to wait forever
+        '''
+        result = self._newRequest(timeout=timeout)
+        if not fields:
+            result._resolve([])
+            return result
+        order = sorted(range(len(fields)), key=lambda i: fields[i][0])
+        blocks = []
+        for i in order:
+            addr, kind = fields[i]
+            end = addr + typeSize(kind)
+            if blocks and addr <= blocks[-1][1] + gap and \
+                    end - blocks[-1][0] <= maxSize:
+                block = blocks[-1]
+                block[1] = max(block[1], end)
+                block[2].append(i)
+            else:
+                blocks.append([addr, end, [i]])
+        values = [None] * len(fields)
+        remaining = [len(blocks)]
+
+        def done(request, start, indices):
+            exception, data = request._outcome()
+            if exception is not None:
+                result._fail(exception)
+                return
+            for i in indices:
+                addr, kind = fields[i]
+                values[i] = decode(kind, data, addr - start)
+            remaining[0] -= 1
+            if not remaining[0]:
+                result._resolve(values)
+        for start, end, indices in blocks:
+            request = self.readBlock(end - start, start, timeout=timeout)
+            request._link(lambda r, s=start, i=indices: done(r, s, i))
+        return result
+
+    def _subscribe(self, mode, addr, callback):
+        '''
+        Subscribes <callback> to <mode> bits of data at the given address,
+        see subscriptions.SubscriptionRegistry.
+        Returns the Listener.
+        '''
+        return self._registry.add(addr, mode // 8, False, callback)
+
+    def _subscribeMulti(self, size, addr, callback):
+        '''
+        Subscribes <callback> to <size> bytes of data starting at the given
+        address, see subscriptions.SubscriptionRegistry.
+        Returns the Listener.
+        '''
+        return self._registry.add(addr, size, True, callback)
+
+    def _unSubscribe(self, addr):
+        '''
+        Removes all 8, 16 and 32 bit subscriptions of the given address.
+        '''
+        for listener in self._registry.listeners(addr):
+            if not listener.multi:
+                self._registry.remove(listener)
+
+    def _unSubscribeMulti(self, size, addr, callback):
+        '''
+        Removes the subscriptions of bytes starting at the given address,
+        only those of <size> bytes and to <callback> unless they are None.
+        '''
+        for listener in self._registry.listeners(addr):
+            if (listener.multi and size in (None, listener.size) and
+                    callback in (None, listener.callback)):
+                self._registry.remove(listener)
+
+    def write8(self, addr, val):
+        '''
+        Sends a command to write 8 bytes of data to the given address.
+        '''
+        self.write(8, addr, val)
+
+    def write16(self, addr, val):
+        '''
+        Sends a command to write 16 bytes of data to the given address.
+        '''
+        self.write(16, addr, val)
+
+    def write32(self, addr, val):
+        '''
+        Sends a command to write 32 bytes of data to the given address.
+        '''
+        self.write(32, addr, val)
+
+    def read8(self, addr, callback=None, timeout=None):
+        '''
+        Sends a command to send back 8 bytes of data at the given address.
+        The given callback function, if any, gets called with the returned
+        value as parameter. Returns a Request, see read().
+        '''
+        return self.read(8, addr, callback, timeout)
+
+    def read16(self, addr, callback=None, timeout=None):
+        '''
+        Sends a command to send back 16 bytes of data at the given address.
+        The given callback function, if any, gets called with the returned
+        value as parameter. Returns a Request, see read().
+        '''
+        return self.read(16, addr, callback, timeout)
+
+    def read32(self, addr, callback=None, timeout=None):
+        '''
+        Sends a command to send back 32 bytes of data at the given address.
+        The given callback function, if any, gets called with the returned
+        value as parameter. Returns a Request, see read().
+        '''
+        if addr % 4 != 0:
+            raise ValueError("Read32 address must be whole word; " +
+                             "multiple of 4")
+        return self.read(32, addr, callback, timeout)
+
+    def wiiButton(self, wiimoteIndex, buttonstates):
+        '''
+        Sends 16 bit of data representing some buttonstates of the Wiimote.
+        NOTE: The real or emulated wiimote dolphin uses gets hijacked for only
+              roughly half a second.
+              After this time that wiimote handled by dolphin starts to send
+              it's buttonstates again.
+        :param wiimoteIndex: 0-3, index of the wiimote to emulate.
+        :param buttonstates: bitmask of the buttonstates,
+            see http://wiibrew.org/wiki/Wiimote#Buttons for more info.
+            Can also be a WiimoteButtons member or a list of them.
+        '''
+        try:
+            cmd = _wiiButtonCmd(wiimoteIndex, buttonstates)
+        except TypeError:
+            # unhashable, e.g. a list of buttons
+            cmd = _wiiButtonCmd(wiimoteIndex, buttonMask(buttonstates))
+        self._cmd(cmd)
+
+    def gcButton(self, gcpadIndex, buttonstates, stickX=0.0, stickY=0.0,
+                 substickX=0.0, substickY=0.0):
+        '''
+        Sends 16 bit of data and 2 floats representing some buttonstates of
+        the GCPad.
+        NOTE: The real or emulated gcpad dolphin uses gets hijacked for only
+              roughly half a second.
+              After this time that gcpad handled by dolphin starts to send
+              it's buttonstates again.
+        :param gcpadIndex: 0-3, index of the gcpad to emulate.
+        :param buttonstates: bitmask of the buttonstates,
+            see http://pastebin.com/raw.php?i=4txWae07 for more info.
+            Can also be a GCPadButtons member or a list of them.
+        :param stickX: between -1.0 and 1.0, x-position of the main stick,
+                       0 is neutral
+        :param stickY: between -1.0 and 1.0, y-position of the main stick,
+                       0 is neutral
+        :param substickX: between -1.0 and 1.0, x-position of the c-stick,
+                          0 is neutral
+        :param substickY: between -1.0 and 1.0, y-position of the c-stick,
+                          0 is neutral
+        '''
+        try:
+            cmd = _gcButtonCmd(gcpadIndex, buttonstates, stickX, stickY,
+                               substickX, substickY)
+        except TypeError:
+            # unhashable, e.g. a list of buttons
+            cmd = _gcButtonCmd(gcpadIndex, buttonMask(buttonstates),
+                               stickX, stickY, substickX, substickY)
+        self._cmd(cmd)
+
+    def pause(self):
+        '''
+        Tells Dolphin to pause the current emulation.
+        Resume with resume()
+        '''
+        self._cmd(b"PAUSE")
+
+    def resume(self):
+        '''
+        Tells Dolphin to resume the current emulation.
+        '''
+        self._cmd(b"RESUME")
+
+    def reset(self):
+        '''
+        Tells Dolphin to push the reset button.
+        '''
+        self._cmd(b"RESET")
+
+    def save(self, filename):
+        '''
+        Tells Dolphin to make a savestate and save it to <filename>.
+        '''
+        if any(c in filename for c in "?\"<>|"):
+            raise ValueError("filename must not contain any of the " +
+                             "following: :?\"<> | ")
+        self._cmd(b"SAVE %s" % filename.encode())
+
+    def stop(self):
+        '''
+        Stops the current emulation. DolphinWatch does NOT support starting a
+        new game then.
+        To change the game, use insert() to insert a new iso and then reset().
+        '''
+        self._cmd(b"STOP")
+
+    def insert(self, filename):
+        '''
+        Inserts up a new game (iso).
+        :param filename: The file (iso e.g.) to be loaded. Relative do dolphin.
+        CAUTION: Running games can crash if the iso changes while running.
+        To change a game, pause, then insert, and after a bit reset the game.
+        '''
+        if any(c in filename for c in "?\"<>|"):
+            raise ValueError("filename must not contain any of the " +
+                             "following: ?\"<> | ")
+        self._cmd(b"INSERT %s" % filename.encode())
+
+    def _load(self, filename, timeout=None):
+        if any(c in filename for c in "?\"<>|"):
+            raise ValueError("filename must not contain any of the " +
+                             "following: ?\"<> | ")
+        self._cmd(b"LOAD %s" % filename.encode())
+        request = self._feedbacks.push(None, self._newRequest(timeout=timeout))
+        if self._metrics is not None:
+            self._metrics._timeRequest(self._metrics.feedbackRtt, request)
+        return request
+
+    ######################################
+    # private methods below
+
+    # to be implemented by the backends
+
+    def _close(self):
+        raise NotImplementedError
+
+    def _sendRest(self, data):
+        # best-effort send right before closing, returns whether it worked
+        raise NotImplementedError
+
+    def _newRequest(self, callback=None, timeout=None):
+        raise NotImplementedError
+
+    def _scheduleFlush(self):
+        raise NotImplementedError
+
+    def _dispatch(self, addr, callback, val):
+        raise NotImplementedError
+
+    def _onListenerError(self, e):
+        # a listener sharing its feed raised. The registry catches it so
+        # the others still get called, count it like any callback error.
+        if self._metrics is not None:
+            self._metrics.counters["callbackErrors"] += 1
+        _logCallbackError(e)
+
+    def _dispatchMeasured(self, addr, callback, val):
+        # replaces _dispatch while metrics are enabled
+        metrics = self._metrics
+        metrics.counters["callbacks"] += 1
+        type(self)._dispatch(self, addr, metrics._measure(addr, callback),
+                             val)
+
+    def _cmd(self, cmd):
+        if not self._connected:
+            raise DolphinNotConnected("DolphinConnection is not connected and " +
+                                      "therefore cannot perform actions!")
+        out = self._out
+        out += cmd
+        out += self._sep
+        stats = self._sendStats
+        stats["commands"] += 1
+        stats["bytes"] += len(cmd) + 1
+        if len(out) >= self._flushSize:
+            self.flush()
+        elif not self._flushScheduled:
+            self._flushScheduled = True
+            self._scheduleFlush()
+        return True
+
+    def _process(self, line):
+        if logger_verbose.isEnabledFor(logging.DEBUG):
+            logger_verbose.debug("Received: %s", _verboseLine(line))
+        command, _, args = line.partition(b" ")
+        handler = self._handlers.get(command)
+        if handler:
+            handler(self, args)
+        else:
+            if self._metrics is not None:
+                self._metrics.counters["unknownCommands"] += 1
+            logger.warning("Unknown incoming DolphinWatch command: %s",
+                           line.decode(errors="replace"))
+
+    def _processFrame(self, kind, payload):
+        if logger_verbose.isEnabledFor(logging.DEBUG):
+            logger_verbose.debug("Received frame %d: %s", kind,
+                                 payload.hex(" "))
+        if kind == FRAME_MEM:
+            addr, val = _memFrame.unpack_from(payload)
+            self._onMemValue(addr, val)
+        elif kind == FRAME_MEM_MULTI:
+            self._onMemData(_addrField.unpack_from(payload)[0], payload[4:])
+        elif kind == FRAME_TEXT:
+            self._process(payload.tobytes())
+        else:
+            logger.warning("Unknown incoming DolphinWatch frame type: %d",
+                           kind)
+
+    def _onMem(self, args):
+        addr, val = args.split(b" ", 1)
+        self._onMemValue(int(addr), int(val))
+
+    def _onMemValue(self, addr, val):
+        if self._recorder is not None:
+            self._recorder.mem(addr, val)
+        if addr in self._reads:
+            request = self._reads.pop(addr)
+            if request._resolve(val) and request.callback:
+                self._dispatch(addr, request.callback, val)
+            return
+        callback = self._callbacks.get(addr)
+        if callback:
+            if self._checks:
+                check = self._checks.get(addr)
+                if check is not None:
+                    check(val)
+            if callback[0] is not None:
+                self._dispatch(addr, callback[0], val)
+        elif self._registry.recentlyRemoved(addr):
+            logger.debug("Late value for removed subscription at 0x%x, "
+                         "value 0x%x", addr, val)
+        else:
+            if self._metrics is not None:
+                self._metrics.counters["noRecipient"] += 1
+            logger.warning("No recipient for address 0x%x, value 0x%x",
+                           addr, val)
+
+    def _onMemMulti(self, args):
+        addr, _, data = args.partition(b" ")
+        addr = int(addr)
+        data = data.split()
+        try:
+            data = bytes(map(_byteValues.__getitem__, data))
+        except KeyError:
+            data = bytes(map(int, data))
+        self._onMemData(addr, data)
+
+    def _onMemData(self, addr, data):
+        if self._recorder is not None:
+            self._recorder.memMulti(addr, data)
+        if addr in self._blockReads:
+            self._onBlockRead(addr, data)
+            return
+        callback = self._callbacks.get(addr)
+        if callback:
+            if self._checks:
+                check = self._checks.get(addr)
+                if check is not None:
+                    check(data)
+            if callback[0] is not None:
+                self._dispatch(addr, callback[0], data)
+        elif self._registry.recentlyRemoved(addr):
+            logger.debug("Late data for removed subscription at 0x%x",
+                         addr)
+        else:
+            if self._metrics is not None:
+                self._metrics.counters["noRecipient"] += 1
+            logger.warning("No recipient for address 0x%x, data %s",
+                           addr, list(data))
+
+    def _onBlockRead(self, addr, data):
+        size, requests = self._blockReads[addr]
+        waiting = []
+        for wanted, request in requests:
+            if wanted > len(data):
+                # answer to an earlier, smaller subscription
+                waiting.append((wanted, request))
+                continue
+            value = bytes(data[:wanted])
+            if request._resolve(value) and request.callback:
+                self._dispatch(addr, request.callback, value)
+        if waiting:
+            self._blockReads[addr] = (size, waiting)
+            return
+        del self._blockReads[addr]
+        # the server keeps SUBSCRIBE and SUBSCRIBE_MULTI apart, only a
+        # MULTI feed got replaced by the block read
+        subscription = self._callbacks.get(addr)
+        if subscription and subscription[1].startswith(b"SUBSCRIBE_MULTI "):
+            self._cmd(subscription[1])
+        else:
+            self._cmd(b"UNSUBSCRIBE_MULTI %d" % addr)
+
+    def _onFail(self, args):
+        self._onFeedback(False)
+
+    def _onSuccess(self, args):
+        self._onFeedback(True)
+
+    def _onFeedback(self, success):
+        if self._metrics is not None:
+            self._metrics.counters["feedbacks"] += 1
+        request = self._feedbacks.pop(None)
+        if request is not None:
+            request._resolve(success)
+        else:
+            logger.warning("Unexpected feedback from Dolphin: %s",
+                           "SUCCESS" if success else "FAIL")
+
+    def _onLog(self, args):
+        level, _, msg = args.partition(b" ")
+        level = int(level)
+        if self._recorder is not None and self._recorder.logs:
+            self._recorder.log(level, msg)
+        level = _log_translation[level]
+        if logger.isEnabledFor(level):
+            logger.log(level, msg.decode(errors="replace"))
+
+    # incoming command word -> handler, called with the rest of the line
+    _handlers = {
+        b"MEM":       _onMem,
+        b"MEM_MULTI": _onMemMulti,
+        b"FAIL":      _onFail,
+        b"SUCCESS":   _onSuccess,
+        b"LOG":       _onLog,
+    }
@@ -0,0 +1,63 @@
+'''
+gevent futures for commands Dolphin answers, like READ and LOAD.
+They get matched to the answers by the RequestQueues of BaseConnection.
+'''
+
+from __future__ import print_function, division
+
+import gevent
+from gevent.event import AsyncResult
+
+from .protocol import DolphinTimeout, DolphinRequestCancelled
+
+
+class Request(AsyncResult):
+    '''
+    AsyncResult of a command that gets answered by Dolphin.
+    Use get() to wait for the answer, or rawlink() to get notified.
+    '''
+    def __init__(self, callback=None, timeout=None):
+        AsyncResult.__init__(self)
+        self.callback = callback
+        self._timer = None
+        if timeout is not None:
+            self._timer = gevent.get_hub().loop.timer(timeout)
+            self._timer.start(self._expire)
+
+    def cancel(self):
+        '''
+        Cancels the request. Waiters get a DolphinRequestCancelled
+        exception and the answer, once it arrives, is discarded.
+        Returns False if the request was already done.
+        '''
+        return self._fail(DolphinRequestCancelled("Request was cancelled."))
+
+    def _resolve(self, value):
+        # the answer still gets consumed if the request is already done,
+        # so the answers of later requests stay matched correctly
+        if self.ready():
+            return False
+        self._stopTimer()
+        self.set(value)
+        return True
+
+    def _fail(self, exception):
+        if self.ready():
+            return False
+        self._stopTimer()
+        self.set_exception(exception)
+        return True
+
+    def _link(self, func):
+        self.rawlink(func)
+
+    def _outcome(self):
+        return self.exception, self.value
+
+    def _expire(self):
+        self._fail(DolphinTimeout("Dolphin did not answer in time."))
+
+    def _stopTimer(self):
+        if self._timer is not None:
+            self._timer.close()
+            self._timer = None
@@ -0,0 +1,390 @@
+'''
+Keeping track of savestates in one directory, for frequent saving and
+rolling back without blocking.
+
+SaveStateManager saves and loads through a DolphinConnection and returns
+Requests instead of waiting. Dolphin does not answer SAVE, so a save is
+done once its file got written and stopped changing. The manager keeps
+an index of its states with metadata next to them, written in the
+background at most once per event loop iteration, deletes the least
+recently used ones above a number or size limit, and learns which state
+usually gets loaded after which one, to read that file into the OS cache
+ahead of time.
+
+    states = SaveStateManager(dolphin, "/tmp/states", maxStates=50)
+    states.save("checkpoint", frame=1234).get()
+    ...
+    states.load("checkpoint").rawlink(onRolledBack)
+
+The directory must be the same for Dolphin and this process, so both
+have to run on the same machine.
+'''
+
+from __future__ import print_function, division
+
+import os
+import json
+import time
+from collections import Counter
+
+import gevent
+
+from .protocol import logger
+from .request import Request
+
+INDEX_FILENAME = "dolphinWatch-states.json"
+
+# seconds a save waits for its file at most, also without a timeout.
+# Dolphin does not answer SAVE, a failed save would be waited for forever.
+SAVE_DEADLINE = 60.0
+
+
+class SaveState(object):
+    '''
+    A savestate known to a SaveStateManager.
+    metadata is a dict of whatever was passed to save(), followers counts
+    which states got loaded right after this one.
+    '''
+    def __init__(self, name, path, size=0, created=None, lastUsed=None,
+                 loads=0, pinned=False, metadata=None, followers=None):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.created = created
+        self.lastUsed = lastUsed
+        self.loads = loads
+        self.pinned = pinned
+        self.metadata = metadata or {}
+        self.followers = Counter(followers or {})
+
+    def __repr__(self):
+        return "SaveState(%r, size=%d, loads=%d%s)" % (
+            self.name, self.size, self.loads,
+            ", pinned" if self.pinned else "")
+
+    def _toDict(self):
+        return {
+            "size": self.size,
+            "created": self.created,
+            "lastUsed": self.lastUsed,
+            "loads": self.loads,
+            "pinned": self.pinned,
+            "metadata": self.metadata,
+            "followers": dict(self.followers),
+        }
+
+
+class SaveStateManager(object):
+    def __init__(self, connection, directory, maxStates=None, maxBytes=None,
+                 timeout=10.0, pollInterval=0.05, prefetch=True):
+        '''
+        Creating a new SaveStateManager for a DolphinConnection, keeping
+        its savestates in <directory>. An index of earlier runs found there
+        gets loaded.
+        :param maxStates: number of states above which the least recently
+                          used ones get deleted, None for no limit
+        :param maxBytes: same for the total size of the files
+        :param timeout: default seconds after which save() and load()
+                        Requests fail with DolphinTimeout, None to wait
+                        forever for loads and SAVE_DEADLINE for saves
+        :param pollInterval: seconds between checks whether a save is done
+        :param prefetch: whether to prefetch the state most likely loaded
+                         next after every load, see prefetch()
+        '''
+        self._conn = connection
+        self.directory = os.path.abspath(directory)
+        self.maxStates = maxStates
+        self.maxBytes = maxBytes
+        self.timeout = timeout
+        self.pollInterval = pollInterval
+        self.autoPrefetch = prefetch
+        self._states = {}
+        # name -> number of outstanding loads, those don't get evicted
+        self._loading = Counter()
+        self._last = None
+        # greenlet writing the index, and whether it changed since
+        self._indexWriter = None
+        self._indexChanged = False
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._readIndex()
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, name):
+        return name in self._states
+
+    def __getitem__(self, name):
+        return self._states[name]
+
+    def states(self):
+        '''
+        Returns all known SaveStates, most recently used first.
+        '''
+        return sorted(self._states.values(),
+                      key=lambda state: -(state.lastUsed or 0))
+
+    def save(self, name, timeout=None, pin=False, **metadata):
+        '''
+        Tells Dolphin to save a savestate named <name>, replacing an older
+        one of that name. Keyword arguments are kept as its metadata.
+        Returns a Request resolving to the SaveState once the file is
+        written completely.
+        :param timeout: seconds after which the Request fails with
+                        DolphinTimeout, defaults to the manager's, and to
+                        SAVE_DEADLINE if that is None too
+        :param pin: whether to protect the state from being evicted
+        '''
+        path = self._path(name)
+        before = _stat(path)
+        self._conn.save(path)
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            timeout = SAVE_DEADLINE
+        request = Request(timeout=timeout)
+        gevent.spawn(self._watchSave, request, name, path, before, pin,
+                     metadata)
+        return request
+
+    def load(self, name, timeout=None):
+        '''
+        Tells Dolphin to load the savestate named <name>.
+        Returns a Request resolving to whether loading succeeded, see
+        DolphinConnection.loadAsync().
+        :param timeout: seconds after which the Request fails with
+                        DolphinTimeout, defaults to the manager's
+        '''
+        state = self._states.get(name)
+        if state is None:
+            raise ValueError("Unknown savestate: %s" % name)
+        request = self._conn.loadAsync(
+            state.path, self.timeout if timeout is None else timeout)
+        self._loading[name] += 1
+        # called on the hub, the index and prefetching don't belong there
+        request._link(lambda request: gevent.spawn(self._onLoaded, name,
+                                                   request))
+        return request
+
+    def pin(self, name, pinned=True):
+        '''
+        Protects the savestate named <name> from being evicted, or stops
+        protecting it.
+        '''
+        self._states[name].pinned = pinned
+        self._writeIndex()
+
+    def remove(self, name):
+        '''
+        Deletes the savestate named <name> and its file.
+        '''
+        state = self._states.pop(name)
+        for other in self._states.values():
+            other.followers.pop(name, None)
+        if self._last == name:
+            self._last = None
+        try:
+            os.remove(state.path)
+        except OSError as e:
+            logger.warning("Could not delete savestate %s: %s", state.path,
+                           e)
+        self._writeIndex()
+
+    def evict(self):
+        '''
+        Deletes the least recently used savestates, except pinned ones and
+        ones being loaded, until the limits hold again. This happens after
+        every save anyway, sparing the state just saved even if the limits
+        then still don't hold.
+        Returns the names of the deleted states.
+        '''
+        return self._evict(None)
+
+    def predict(self, name=None):
+        '''
+        Returns the name of the state that most often got loaded right after
+        the one named <name>, by default the last loaded one, or None if
+        there is none yet.
+        '''
+        state = self._states.get(self._last if name is None else name)
+        if state is None or not state.followers:
+            return None
+        return state.followers.most_common(1)[0][0]
+
+    def flush(self):
+        '''
+        Waits until the index on disk holds all changes made so far. It
+        gets written in the background anyway, this is for before the
+        process ends or another manager reads it.
+        '''
+        while self._indexWriter is not None:
+            self._indexWriter.join()
+
+    def prefetch(self, name):
+        '''
+        Reads the file of the savestate named <name> into the operating
+        system's cache in a background thread, so Dolphin loading it does
+        not have to wait for the disk.
+        Returns the thread's AsyncResult.
+        '''
+        return gevent.get_hub().threadpool.spawn(_warm,
+                                                 self._states[name].path)
+
+    ######################################
+    # private methods below
+
+    def _path(self, name):
+        if not _validName(name):
+            raise ValueError("name must be a plain filename, not the "
+                             "index's.")
+        return os.path.join(self.directory, name)
+
+    def _watchSave(self, request, name, path, before, pinned, metadata):
+        # the file is written once it exists, differs from before the save
+        # and did not change for one poll interval
+        last = before
+        while not request.ready():
+            gevent.sleep(self.pollInterval)
+            current = _stat(path)
+            if (current is not None and current[0] > 0 and
+                    current != before and current == last):
+                break
+            last = current
+        else:
+            return
+        state = self._states.get(name)
+        if state is None:
+            state = self._states[name] = SaveState(name, path)
+        state.size = current[0]
+        state.created = state.lastUsed = time.time()
+        state.pinned = state.pinned or pinned
+        state.metadata.update(metadata)
+        self._evict(name)
+        self._writeIndex()
+        request._resolve(state)
+
+    def _evict(self, keep):
+        # evict(), but never deleting the state named <keep>, which was
+        # just saved
+        evicted = []
+        if self.maxStates is None and self.maxBytes is None:
+            return evicted
+        count = len(self._states)
+        size = sum(state.size for state in self._states.values())
+        for state in sorted(self._states.values(),
+                            key=lambda state: state.lastUsed or 0):
+            if ((self.maxStates is None or count <= self.maxStates) and
+                    (self.maxBytes is None or size <= self.maxBytes)):
+                break
+            if (state.pinned or self._loading[state.name] or
+                    state.name == keep):
+                continue
+            count -= 1
+            size -= state.size
+            evicted.append(state.name)
+            self.remove(state.name)
+        if evicted:
+            logger.debug("Evicted savestates: %s", ", ".join(evicted))
+        return evicted
+
+    def _onLoaded(self, name, request):
+        self._loading[name] -= 1
+        if not self._loading[name]:
+            del self._loading[name]
+        if not request.successful() or not request.value:
+            return
+        state = self._states.get(name)
+        if state is None:
+            # got removed meanwhile
+            return
+        state.loads += 1
+        state.lastUsed = time.time()
+        previous = self._states.get(self._last)
+        if previous is not None:
+            previous.followers[name] += 1
+        self._last = name
+        self._writeIndex()
+        if self.autoPrefetch:
+            following = self.predict(name)
+            if following is not None:
+                self.prefetch(following)
+
+    def _readIndex(self):
+        path = os.path.join(self.directory, INDEX_FILENAME)
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except (IOError, OSError):
+            return
+        except ValueError as e:
+            logger.warning("Ignoring broken savestate index %s: %s", path, e)
+            return
+        for name, info in index.get("states", {}).items():
+            if not _validName(name):
+                # remove() would delete whatever it points to
+                logger.warning("Ignoring savestate %r of index %s, not a "
+                               "plain filename.", name, path)
+                continue
+            state = SaveState(name, self._path(name), **info)
+            # states deleted behind our back are forgotten
+            if os.path.exists(state.path):
+                self._states[name] = state
+        self._last = index.get("last")
+
+    def _writeIndex(self):
+        # changes made within one loop iteration, e.g. by an eviction,
+        # get written at once, in the threadpool like prefetch()
+        self._indexChanged = True
+        if self._indexWriter is None:
+            self._indexWriter = gevent.spawn(self._indexLoop)
+
+    def _indexLoop(self):
+        path = os.path.join(self.directory, INDEX_FILENAME)
+        try:
+            while self._indexChanged:
+                self._indexChanged = False
+                text = json.dumps({
+                    "last": self._last,
+                    "states": {name: state._toDict()
+                               for name, state in self._states.items()},
+                })
+                gevent.get_hub().threadpool.apply(_replace, (path, text))
+        except (IOError, OSError) as e:
+            logger.warning("Could not write savestate index %s: %s", path, e)
+        finally:
+            self._indexWriter = None
+
+
+def _validName(name):
+    # a plain filename, and neither the index nor its temporary file,
+    # which share the directory
+    return bool(isinstance(name, str) and name and
+                name not in (os.curdir, os.pardir) and
+                not any(sep in name for sep in "/\\") and
+                not name.startswith(INDEX_FILENAME))
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _replace(path, text):
+    # written to a temporary file and renamed, so a crash never leaves
+    # a half written file
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+def _warm(path):
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while f.read(1 << 20):
+                pass
@@ -0,0 +1,238 @@
+'''
+Declarative memory layouts.
+
+A Schema describes a structure in emulated memory: named fields at fixed
+offsets, with big-endian types from util.TYPES, raw byte strings, arrays
+and nested schemas. Each schema compiles to a single struct.Struct, and
+unpacks to lightweight record objects with __slots__.
+
+Example:
+
+    Pokemon = Schema("Pokemon", [
+        ("species", 0x00, "u16"),
+        ("level",   0x04, "u8"),
+        ("moves",   0x08, Array("u16", 4)),
+        ("nickname", 0x10, 10),
+    ])
+    Party = Schema("Party", [
+        ("count",   0x00, "u32"),
+        ("members", 0x04, Array(Pokemon, 6)),
+    ])
+
+    def partyChanged(party, changed):
+        print(changed, party.members[0].level)
+    dolphin.subscribeSchema(0x80401234, Party, partyChanged)
+'''
+
+from __future__ import print_function, division
+
+import struct
+
+from .util import TYPES
+
+_dtypes = {
+    "u8":  ">u1",
+    "s8":  ">i1",
+    "u16": ">u2",
+    "s16": ">i2",
+    "u32": ">u4",
+    "s32": ">i4",
+    "f32": ">f4",
+    "f64": ">f8",
+}
+
+
+class Array(object):
+    def __init__(self, kind, count):
+        '''
+        An array of <count> consecutive elements of type <kind>, which can
+        be anything a Schema field can be.
+        Unpacks to a tuple.
+        '''
+        self.kind = kind
+        self.count = count
+        self.size = _size(kind) * count
+
+
+class Schema(object):
+    def __init__(self, name, fields, size=None):
+        '''
+        Creating a new Schema.
+        :param name: name of the generated record class
+        :param fields: list of (name, offset, kind) tuples. <kind> is a type
+                       name from util.TYPES, a byte count for raw bytes, an
+                       Array or another Schema. Fields must not overlap.
+        :param size: total size in bytes, defaults to the end of the last
+                     field
+        '''
+        self.name = name
+        self.fields = sorted(fields, key=lambda field: field[1])
+        end = 0
+        for fieldName, offset, kind in self.fields:
+            if offset < end:
+                raise ValueError("Field %s of %s overlaps the previous field."
+                                 % (fieldName, name))
+            end = offset + _size(kind)
+        if size is None:
+            size = end
+        elif size < end:
+            raise ValueError("Fields of %s exceed its size." % name)
+        self.size = size
+        self.names = tuple(field[0] for field in self.fields)
+        self.record = type(name, (_Record,), {"__slots__": self.names})
+        fmt = []
+        self._fieldOf = []
+        self._build = self._compile(fmt, 0, self._fieldOf)
+        self._struct = struct.Struct(">" + "".join(fmt))
+
+    def unpack(self, data, offset=0):
+        '''
+        Unpacks the structure from <data> starting at <offset> into a new
+        record.
+        '''
+        return self._build(self._struct.unpack_from(data, offset), 0)[0]
+
+    def dtype(self):
+        '''
+        Returns the equivalent NumPy structured dtype, e.g. to view many
+        structures at once with numpy.frombuffer(). Requires numpy.
+        '''
+        import numpy
+        return numpy.dtype(_dtype(self))
+
+    def watch(self, callback):
+        '''
+        Returns a subscribeMulti callback that unpacks the data and calls
+        <callback> with the record and a list of the names of the fields
+        that changed since the previous call. Unchanged data is dropped
+        without unpacking anything.
+        '''
+        return _Watcher(self, callback)
+
+    def _compile(self, fmt, pos, fieldOf=None):
+        # Appends the struct format of all fields to fmt and returns a
+        # function building the record from the flat unpacked tuple,
+        # starting at some index and returning the index after it.
+        # fieldOf gets the field name of each flat value appended.
+        builders = []
+        base = pos
+        for fieldName, offset, kind in self.fields:
+            if offset + base > pos:
+                fmt.append("%dx" % (offset + base - pos))
+            start = len(fmt)
+            builders.append(_compileKind(kind, fmt, offset + base))
+            if fieldOf is not None:
+                fieldOf.extend([fieldName] * _values(fmt[start:]))
+            pos = offset + base + _size(kind)
+        if base + self.size > pos:
+            fmt.append("%dx" % (base + self.size - pos))
+        record = self.record
+
+        def build(values, i):
+            rec = record.__new__(record)
+            for name, builder in zip(self.names, builders):
+                value, i = builder(values, i)
+                setattr(rec, name, value)
+            return rec, i
+        return build
+
+
+class _Record(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
+class _Watcher(object):
+    __slots__ = ("_schema", "_callback", "_data", "_values")
+
+    def __init__(self, schema, callback):
+        self._schema = schema
+        self._callback = callback
+        self._data = None
+        self._values = None
+
+    def __call__(self, data):
+        if data == self._data:
+            return
+        # a memoryview may point into a buffer that gets reused
+        self._data = bytes(data)
+        schema = self._schema
+        values = schema._struct.unpack_from(data)
+        if self._values is None:
+            changed = list(schema.names)
+        else:
+            changed = []
+            fieldOf = schema._fieldOf
+            for i, (old, new) in enumerate(zip(self._values, values)):
+                if old != new and fieldOf[i] not in changed:
+                    changed.append(fieldOf[i])
+        self._values = values
+        if changed:
+            self._callback(schema._build(values, 0)[0], changed)
+
+
+def _size(kind):
+    if isinstance(kind, int):
+        return kind
+    if isinstance(kind, (Array, Schema)):
+        return kind.size
+    return TYPES[kind].size
+
+
+def _values(fmt):
+    # number of values unpacked by a list of struct format codes
+    return sum(1 for code in fmt if not code.endswith("x"))
+
+
+def _compileKind(kind, fmt, pos):
+    if isinstance(kind, int):
+        fmt.append("%ds" % kind)
+        return _single
+    if isinstance(kind, Schema):
+        return kind._compile(fmt, pos)
+    if isinstance(kind, Array):
+        elemSize = _size(kind.kind)
+        builders = [_compileKind(kind.kind, fmt, pos + i * elemSize)
+                    for i in range(kind.count)]
+
+        def build(values, i):
+            elems = []
+            for builder in builders:
+                value, i = builder(values, i)
+                elems.append(value)
+            return tuple(elems), i
+        return build
+    fmt.append(TYPES[kind].format[1:])
+    return _single
+
+
+def _single(values, i):
+    return values[i], i + 1
+
+
+def _dtype(kind):
+    if isinstance(kind, int):
+        return "V%d" % kind
+    if isinstance(kind, Schema):
+        return {
+            "names": list(kind.names),
+            "formats": [_dtype(field[2]) for field in kind.fields],
+            "offsets": [field[1] for field in kind.fields],
+            "itemsize": kind.size,
+        }
+    if isinstance(kind, Array):
+        return (_dtype(kind.kind), (kind.count,))
+    return _dtypes[kind]
@@ -0,0 +1,509 @@
+'''
+Subscriptions shared between any number of listeners.
+
+Dolphin keeps one subscription per address, and its values don't say who
+asked for them. The SubscriptionRegistry of a connection maps all
+listeners onto as few subscriptions on the server, called feeds here, as
+possible:
+
+- listeners of the same address and size share one entry,
+- entries whose memory overlaps get served by one SUBSCRIBE_MULTI
+  spanning all of them, cut into the pieces each entry wants,
+- SUBSCRIBE and UNSUBSCRIBE only get sent when a feed starts, changes or
+  ends.
+
+Listeners of one address get called one after another, with the values
+as they would get them from a subscription of their own. Values of an
+entry shared or merged with others only get passed on if that entry's
+part changed. A listener joining an existing feed gets the last value,
+or the server gets asked for it again if none is known. The same
+callback subscribed to the same memory again keeps its one Listener, like
+earlier versions replaced a subscription of the same address.
+
+Listeners with a predicate, made by trigger() and triggerMulti(), are not
+dispatched to. Their predicates get tested right when a value arrives,
+and only the callbacks of those matching get dispatched, see triggers.py.
+'''
+
+from __future__ import print_function, division
+
+import bisect
+from collections import OrderedDict
+
+# number of removed feed starts remembered, see recentlyRemoved()
+RETIRED_STARTS = 256
+
+
+class Listener(object):
+    '''
+    A subscription made with subscribe8() and the like, returned by them
+    to be passed to unsubscribe().
+    addr and size give the memory it watches, multi whether it gets bytes
+    instead of an int, predicate the Predicate of a trigger, or None.
+    '''
+    __slots__ = ("addr", "size", "multi", "callback", "predicate", "_test",
+                 "_entry")
+
+    def __init__(self, addr, size, multi, callback, predicate=None):
+        self.addr = addr
+        self.size = size
+        self.multi = multi
+        self.callback = callback
+        self.predicate = predicate
+        self._test = None
+        if predicate is not None:
+            self._test = predicate._compile(size)
+        self._entry = None
+
+    def __repr__(self):
+        return "Listener(0x%08x, %d%s%s)" % (
+            self.addr, self.size, ", multi" if self.multi else "",
+            "" if self.predicate is None else ", %r" % self.predicate)
+
+    def active(self):
+        '''
+        Returns whether the listener is still subscribed.
+        '''
+        return self._entry is not None
+
+
+class SubscriptionRegistry(object):
+    def __init__(self, connection, onError):
+        '''
+        Creating a new SubscriptionRegistry, keeping the subscriptions of
+        <connection> and sending the commands through it.
+        :param onError: called with the exception raised by a listener that
+                        shares its feed with others
+        '''
+        self._conn = connection
+        self._onError = onError
+        # (addr, size) -> _Entry
+        self._entries = {}
+        # start address -> _Feed
+        self._feeds = {}
+        # sorted start addresses of the feeds
+        self._starts = []
+        # the largest feed, to know how far back overlapping ones start
+        self._maxSize = 0
+        # start addresses of recently removed feeds, oldest first
+        self._retired = OrderedDict()
+
+    def __len__(self):
+        return sum(len(entry.listeners) for entry in self._entries.values())
+
+    def add(self, addr, size, multi, callback, predicate=None):
+        '''
+        Adds a listener for <size> bytes at <addr>, called with the value
+        as int, or as bytes if <multi>.
+        Adding the same callback for the same memory again, e.g. by
+        subscribing in onConnect on every reconnect, returns the Listener
+        it already has instead of calling it twice for every value.
+        :param predicate: a triggers.Predicate, the listener only gets
+                          called for values it matches
+        Returns the Listener.
+        '''
+        if predicate is not None and predicate.multi != multi:
+            raise ValueError("%r tests %s." % (
+                predicate, "bytes" if predicate.multi else "numbers"))
+        entry = self._entries.get((addr, size))
+        if entry is not None:
+            for listener in entry.listeners:
+                if (listener.multi == multi and
+                        listener.callback == callback and
+                        _samePredicate(listener.predicate, predicate)):
+                    if not entry.feed.sent:
+                        # not subscribed on the current connection yet
+                        self._replace([entry.feed], [entry.feed.entries],
+                                      True)
+                    return listener
+        listener = Listener(addr, size, multi, callback, predicate)
+        if entry is not None:
+            # someone watches this already, the server needs nothing new
+            # unless the feed has to switch to MEM_MULTI
+            entry.listeners.append(listener)
+            listener._entry = entry
+            old = [entry.feed]
+        else:
+            entry = _Entry(addr, size)
+            entry.listeners.append(listener)
+            listener._entry = entry
+            self._entries[(addr, size)] = entry
+            old = self._overlapping(addr, addr + size)
+        group = [entry]
+        for feed in old:
+            group.extend(other for other in feed.entries if other is not entry)
+        if not self._replace(old, [group], True):
+            self._initial(listener)
+        return listener
+
+    def remove(self, listener):
+        '''
+        Removes <listener>. Returns False if it was removed already.
+        '''
+        entry = listener._entry
+        if entry is None:
+            return False
+        listener._entry = None
+        entry.listeners.remove(listener)
+        feed = entry.feed
+        if entry.listeners:
+            self._replace([feed], [feed.entries], False)
+            return True
+        del self._entries[(entry.addr, entry.size)]
+        self._replace([feed], _clusters([other for other in feed.entries
+                                         if other is not entry]), False)
+        return True
+
+    def listeners(self, addr=None):
+        '''
+        Returns all Listeners, or only those of <addr>.
+        '''
+        return [listener for entry in self._entries.values()
+                if addr is None or entry.addr == addr
+                for listener in entry.listeners]
+
+    def stats(self):
+        '''
+        Returns a dict of the number of listeners, of distinct (addr, size)
+        entries, and of subscriptions on the server they are served by.
+        '''
+        return {
+            "listeners": len(self),
+            "entries": len(self._entries),
+            "feeds": len(self._feeds),
+        }
+
+    def recentlyRemoved(self, addr):
+        '''
+        Returns whether a subscription on the server starting at <addr> got
+        removed lately, so values for it may still be on their way.
+        '''
+        return addr in self._retired
+
+    def forget(self):
+        '''
+        Forgets the last values of all entries, so they get passed on even
+        if unchanged, e.g. after subscribing everything again.
+        '''
+        for entry in self._entries.values():
+            entry.last = None
+
+    def disconnected(self):
+        '''
+        Forgets the last values, and that the feeds are subscribed on the
+        server, after the connection ended. A listener added to a feed
+        then sends its command again, e.g. when subscribing again in
+        onConnect after connecting anew.
+        '''
+        self.forget()
+        for feed in self._feeds.values():
+            feed.sent = False
+            feed.answered = False
+
+    def resubscribed(self):
+        '''
+        Marks all feeds as subscribed on the server again, after their
+        commands got sent again.
+        '''
+        for feed in self._feeds.values():
+            feed.sent = True
+
+    ######################################
+    # private methods below
+
+    def _overlapping(self, start, end):
+        starts = self._starts
+        first = bisect.bisect_left(starts, start - self._maxSize + 1)
+        last = bisect.bisect_left(starts, end)
+        return [self._feeds[s] for s in starts[first:last]
+                if self._feeds[s].end > start]
+
+    def _replace(self, old, groups, raises):
+        # swaps the feeds in <old> for ones serving the entry lists in
+        # <groups>, and sends only the commands of what changed. Returns
+        # whether a subscribe command got sent.
+        conn = self._conn
+        new = [_Feed(group, conn, self._onError) for group in groups if group]
+        oldByStart = {feed.start: feed for feed in old}
+        newByStart = {feed.start: feed for feed in new}
+        cmds = []
+        for feed in old:
+            successor = newByStart.get(feed.start)
+            if successor is None or successor.multi != feed.multi:
+                cmds.append(feed.uncmd())
+            del self._feeds[feed.start]
+            del self._starts[bisect.bisect_left(self._starts, feed.start)]
+            conn._callbacks.pop(feed.start, None)
+            conn._checks.pop(feed.start, None)
+            if feed.start not in newByStart:
+                retired = self._retired
+                retired.pop(feed.start, None)
+                retired[feed.start] = True
+                if len(retired) > RETIRED_STARTS:
+                    retired.popitem(last=False)
+        for feed in new:
+            self._retired.pop(feed.start, None)
+            self._feeds[feed.start] = feed
+            bisect.insort(self._starts, feed.start)
+            self._maxSize = max(self._maxSize, feed.end - feed.start)
+            conn._callbacks[feed.start] = (feed.deliver, feed.cmd)
+            if feed.check is not None:
+                conn._checks[feed.start] = feed.check
+            predecessor = oldByStart.get(feed.start)
+            if (predecessor is None or predecessor.cmd != feed.cmd or
+                    not predecessor.sent):
+                cmds.append(feed.cmd)
+            else:
+                feed.answered = predecessor.answered
+        sent = raises or conn._connected
+        if sent:
+            for cmd in cmds:
+                conn._cmd(cmd)
+        for feed in new:
+            feed.sent = sent or feed.cmd not in cmds
+        return any(feed.cmd in cmds for feed in new)
+
+    def _initial(self, listener):
+        # a listener joining an existing feed gets the current value, which
+        # the server only sends on subscribing
+        entry = listener._entry
+        if listener.predicate is not None and entry.checked is not None:
+            # also tells an edge trigger whether its condition holds already
+            _fire(self._conn, (listener,), entry.checked, self._onError)
+        elif listener.predicate is None and entry.last is not None:
+            self._conn._dispatch(listener.addr, listener.callback,
+                                 _convert(listener, entry.last))
+        elif entry.feed.answered and self._conn._connected:
+            # subscribing again makes the server send it, the other
+            # entries drop it as unchanged
+            self._conn._cmd(entry.feed.cmd)
+        # otherwise the answer to subscribing is still to come
+
+
+class _Entry(object):
+    # the listeners of one (addr, size)
+    __slots__ = ("addr", "size", "listeners", "last", "checked", "feed")
+
+    def __init__(self, addr, size):
+        self.addr = addr
+        self.size = size
+        self.listeners = []
+        # the last value passed on, as int for MEM feeds and bytes for
+        # MEM_MULTI feeds, None if unknown
+        self.last = None
+        # the same for the last value the triggers were tested with
+        self.checked = None
+        self.feed = None
+
+
+class _Feed(object):
+    # one subscription on the server, serving the entries within it
+    __slots__ = ("entries", "start", "end", "multi", "cmd", "sent",
+                 "answered", "deliver", "check", "_callback")
+
+    def __init__(self, entries, conn, onError):
+        entries = tuple(sorted(entries,
+                               key=lambda entry: (entry.addr, entry.size)))
+        self.entries = entries
+        self.start = entries[0].addr
+        self.end = max(entry.addr + entry.size for entry in entries)
+        size = self.end - self.start
+        # plain SUBSCRIBE only for a single entry of ints
+        self.multi = (len(entries) > 1 or size not in (1, 2, 4) or
+                      any(listener.multi for listener in entries[0].listeners))
+        if self.multi:
+            self.cmd = b"SUBSCRIBE_MULTI %d %d" % (size, self.start)
+        else:
+            self.cmd = b"SUBSCRIBE %d %d" % (size * 8, self.start)
+        # whether the command got sent on the current connection
+        self.sent = False
+        # whether the server sent anything for this command yet
+        self.answered = False
+        for entry in entries:
+            entry.feed = self
+            entry.last = _recast(entry.last, entry.size, self.multi)
+            entry.checked = _recast(entry.checked, entry.size, self.multi)
+        self._callback = None
+        self.deliver = self._deliverer(onError)
+        self.check = self._checker(conn, onError)
+
+    def uncmd(self):
+        if self.multi:
+            return b"UNSUBSCRIBE_MULTI %d" % self.start
+        return b"UNSUBSCRIBE %d" % self.start
+
+    def _deliverer(self, onError):
+        # returns the function the feed's values get dispatched to, None if
+        # there are only triggers. The common case of a single listener is
+        # a method, which takes less memory than a closure.
+        feed = self
+        plain = [tuple(listener for listener in entry.listeners
+                       if listener.predicate is None)
+                 for entry in self.entries]
+        if not any(plain):
+            return None
+        entries = self.entries
+        if len(entries) == 1:
+            entry = entries[0]
+            listeners = plain[0]
+            if len(listeners) == 1:
+                self._callback = listeners[0].callback
+                if self.multi:
+                    return self._deliverData
+                return self._deliverValue
+            if not self.multi:
+                def deliver(val):
+                    # a late MEM_MULTI of a replaced subscription
+                    if not isinstance(val, int):
+                        return
+                    feed.answered = True
+                    if val == entry.last:
+                        return
+                    entry.last = val
+                    _fanOut(listeners, val, onError)
+                return deliver
+        parts = [(entry, entry.addr - self.start,
+                  entry.addr - self.start + entry.size, listeners)
+                 for entry, listeners in zip(entries, plain) if listeners]
+
+        def deliver(data):
+            # a late MEM of a replaced subscription
+            if isinstance(data, int):
+                return
+            feed.answered = True
+            for entry, begin, end, listeners in parts:
+                if end > len(data):
+                    # a late answer of a smaller subscription
+                    continue
+                raw = bytes(data[begin:end])
+                if raw == entry.last:
+                    continue
+                entry.last = raw
+                _fanOut(listeners, raw, onError)
+        return deliver
+
+    def _checker(self, conn, onError):
+        # returns the function testing the triggers' predicates, called
+        # right when a value arrives, or None if there are no triggers
+        feed = self
+        parts = []
+        for entry in self.entries:
+            triggers = tuple(listener for listener in entry.listeners
+                             if listener.predicate is not None)
+            if triggers:
+                parts.append((entry, entry.addr - self.start,
+                              entry.addr - self.start + entry.size, triggers))
+        if not parts:
+            return None
+        if not self.multi:
+            entry, _, _, triggers = parts[0]
+
+            def check(val):
+                if not isinstance(val, int):
+                    return
+                feed.answered = True
+                if val == entry.checked:
+                    return
+                entry.checked = val
+                _fire(conn, triggers, val, onError)
+            return check
+
+        def check(data):
+            if isinstance(data, int):
+                return
+            feed.answered = True
+            for entry, begin, end, triggers in parts:
+                if end > len(data):
+                    continue
+                raw = data[begin:end]
+                if raw == entry.checked:
+                    continue
+                # only copied if it changed
+                raw = entry.checked = bytes(raw)
+                _fire(conn, triggers, raw, onError)
+        return check
+
+    def _deliverValue(self, val):
+        # a late MEM_MULTI of a replaced subscription
+        if not isinstance(val, int):
+            return
+        self.answered = True
+        # the server only sends changes by itself, an unchanged value is
+        # the answer to subscribing again after a merge got split up
+        entry = self.entries[0]
+        if val == entry.last:
+            return
+        entry.last = val
+        self._callback(val)
+
+    def _deliverData(self, data):
+        # passed on as is, binary framing passes memoryviews. Only the last
+        # value gets copied, for listeners joining later. A late MEM of a
+        # replaced subscription is dropped.
+        if isinstance(data, int):
+            return
+        self.answered = True
+        entry = self.entries[0]
+        if data == entry.last:
+            return
+        entry.last = bytes(data)
+        self._callback(data)
+
+
+def _samePredicate(a, b):
+    # predicates get made anew on every call of below() and the like
+    if a is None or b is None:
+        return a is b
+    return a is b or repr(a) == repr(b)
+
+
+def _convert(listener, raw):
+    if listener.multi or not isinstance(raw, bytes):
+        return raw
+    return int.from_bytes(raw, "big")
+
+
+def _recast(raw, size, multi):
+    # a value kept for an entry whose feed switches between MEM and
+    # MEM_MULTI
+    if isinstance(raw, int) and multi:
+        return raw.to_bytes(size, "big")
+    if isinstance(raw, bytes) and not multi:
+        return int.from_bytes(raw, "big")
+    return raw
+
+
+def _fire(conn, triggers, raw, onError):
+    # tests the triggers, and dispatches the callbacks of those matching
+    for trigger in triggers:
+        value = _convert(trigger, raw)
+        try:
+            matched = trigger._test(value)
+        except Exception as e:
+            onError(e)
+            continue
+        if matched:
+            conn._dispatch(trigger.addr, trigger.callback, value)
+
+
+def _fanOut(listeners, raw, onError):
+    # one raising listener must not keep the others from being called
+    for listener in listeners:
+        try:
+            listener.callback(_convert(listener, raw))
+        except Exception as e:
+            onError(e)
+
+
+def _clusters(entries):
+    # splits entries into groups of overlapping ones
+    groups = []
+    end = None
+    for entry in sorted(entries, key=lambda entry: entry.addr):
+        if end is None or entry.addr >= end:
+            groups.append([])
+            end = entry.addr + entry.size
+        else:
+            end = max(end, entry.addr + entry.size)
+        groups[-1].append(entry)
+    return groups
@@ -0,0 +1,663 @@
+'''
+A stand-in for the DolphinWatch server built into Dolphin, to test and
+benchmark against without a running emulator.
+
+It emulates a block of memory that clients can read, write and subscribe
+to, and speaks both the text and the binary framing. Savestates are kept
+in memory, and memory can be animated at a given update rate to generate
+load. Any command can be scripted with setHandler():
+
+    server = FakeDolphinServer()
+    server.start()
+    server.animate(0x80001234, 2, rate=60)
+    server.setHandler("LOAD", lambda args: "FAIL")
+    dolphin = DolphinConnection(*server.address(), binary=True)
+    dolphin.connect()
+    dolphin.subscribe16(0x80001234, print)
+
+ReplayServer instead serves a recorded trace (see trace.py) to every
+client that connects, at the recorded pace, faster, or as fast as
+possible, and measures how far behind the clients fall.
+'''
+
+from __future__ import print_function, division
+
+import time
+import bisect
+from collections import deque, Counter
+
+import gevent
+import gevent.event
+import gevent.lock
+from gevent import socket
+from gevent.server import StreamServer
+
+from .metrics import Histogram
+from .protocol import (LineBuffer, FRAMING_REQUEST, FRAME_TEXT, FRAME_MEM,
+                       FRAME_MEM_MULTI, logger, _frameHeader, _memFrame,
+                       _addrField, _byteTokens)
+from .trace import TraceReader, TraceKind, _u32
+
+
+def encodeMem(addr, val, binary=False):
+    '''
+    Returns a MEM message as sent by the server.
+    :param binary: whether to encode it as a binary frame instead of a line
+    '''
+    if binary:
+        return _frameHeader.pack(FRAME_MEM, _memFrame.size) + \
+            _memFrame.pack(addr, val)
+    return b"MEM %d %d\n" % (addr, val)
+
+
+def encodeMemMulti(addr, data, binary=False):
+    '''
+    Returns a MEM_MULTI message of the bytes <data> as sent by the server.
+    :param binary: whether to encode it as a binary frame instead of a line
+    '''
+    if binary:
+        return _frameHeader.pack(FRAME_MEM_MULTI, 4 + len(data)) + \
+            _addrField.pack(addr) + bytes(data)
+    return b"MEM_MULTI %d %s\n" % (addr, b" ".join(
+        map(_byteTokens.__getitem__, data)))
+
+
+def encodeLine(line, binary=False):
+    '''
+    Returns any other message, given as a line without the line ending, as
+    sent by the server.
+    :param binary: whether to encode it as a binary frame instead of a line
+    '''
+    if binary:
+        return _frameHeader.pack(FRAME_TEXT, len(line)) + line
+    return line + b"\n"
+
+
+class _ServerBase(object):
+    # listens, keeps track of the clients and of the commands they sent,
+    # subclasses create the clients and serve them
+    def __init__(self, host, port, binary, history):
+        self.binary = binary
+        self._clients = []
+        self._handlers = {}
+        self._history = deque(maxlen=history)
+        self._counts = Counter()
+        self._server = StreamServer((host, port), self._handle)
+
+    def start(self):
+        '''
+        Starts listening for clients.
+        '''
+        self._server.start()
+
+    def stop(self):
+        '''
+        Stops listening and closes all client connections.
+        '''
+        self._server.stop()
+        self.disconnectClients()
+
+    def disconnectClients(self):
+        '''
+        Closes all client connections, as if Dolphin dropped them, but keeps
+        listening.
+        '''
+        for client in list(self._clients):
+            client.close()
+
+    def address(self):
+        '''
+        Returns the (host, port) tuple the server listens on.
+        '''
+        return self._server.address[:2]
+
+    def clients(self):
+        '''
+        Returns the number of connected clients.
+        '''
+        return len(self._clients)
+
+    def setHandler(self, command, func):
+        '''
+        Replaces the handling of incoming <command>, e.g. "LOAD", by <func>,
+        called with the list of the command's arguments as strings. If it
+        returns a string, that gets sent back to the client as a line.
+        None as <func> restores the default handling.
+        '''
+        command = command.encode()
+        if func is None:
+            self._handlers.pop(command, None)
+        else:
+            self._handlers[command] = func
+
+    def received(self):
+        '''
+        Returns the most recently received commands, oldest first, as
+        strings.
+        '''
+        return [line.decode(errors="replace") for line in self._history]
+
+    def commandCounts(self):
+        '''
+        Returns a dict of how often each command was received.
+        '''
+        return {command.decode(): count
+                for command, count in self._counts.items()}
+
+    ######################################
+    # private methods below
+
+    def _handle(self, sock, address):
+        # like Dolphin, whose sockets send right away instead of waiting
+        # for more data to fill a packet
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = self._newClient(sock)
+        self._clients.append(client)
+        try:
+            self._serve(client)
+        finally:
+            self._clients.remove(client)
+            client.close()
+
+    def _newClient(self, sock):
+        raise NotImplementedError()
+
+    def _serve(self, client):
+        client.run()
+
+
+class FakeDolphinServer(_ServerBase):
+    def __init__(self, host="127.0.0.1", port=0, base=0x80000000,
+                 size=0x1800000, binary=True, loadDelay=0.0, history=1000,
+                 saveToDisk=False):
+        '''
+        Creating a new FakeDolphinServer. It listens once start() got
+        called.
+        :param port: port to listen on, 0 picks a free one, see address()
+        :param base: address of the first byte of the emulated memory
+        :param size: size of the emulated memory in bytes
+        :param binary: whether to agree to binary framing when a client
+                       asks for it
+        :param loadDelay: seconds a LOAD takes before it gets answered
+        :param history: number of received commands kept for received()
+        :param saveToDisk: whether SAVE and LOAD use files like Dolphin,
+                           instead of saveStates
+        '''
+        _ServerBase.__init__(self, host, port, binary, history)
+        self.memory = bytearray(size)
+        self.base = base
+        self.loadDelay = loadDelay
+        self.saveToDisk = saveToDisk
+        # filename -> memory contents, filled by SAVE
+        self.saveStates = {}
+        self._running = gevent.event.Event()
+        self._running.set()
+        self._animations = []
+
+    def stop(self):
+        '''
+        Stops listening, all animations and closes all client connections.
+        '''
+        self.stopAnimations()
+        _ServerBase.stop(self)
+
+    def read(self, addr, size):
+        '''
+        Returns <size> bytes of emulated memory starting at <addr>.
+        '''
+        offset = self._offset(addr, size)
+        return bytes(self.memory[offset:offset + size])
+
+    def write(self, addr, data):
+        '''
+        Writes the bytes <data> to emulated memory starting at <addr>, and
+        sends the changed values to all subscribed clients.
+        '''
+        offset = self._offset(addr, len(data))
+        self.memory[offset:offset + len(data)] = data
+        for client in self._clients:
+            client.changed(addr, addr + len(data))
+
+    def pause(self):
+        '''
+        Pauses the emulation like the PAUSE command: animations stop and
+        LOADs don't get answered until resume().
+        '''
+        self._running.clear()
+
+    def resume(self):
+        '''
+        Resumes the emulation like the RESUME command.
+        '''
+        self._running.set()
+
+    def isPaused(self):
+        '''
+        Returns whether the emulation is paused.
+        '''
+        return not self._running.is_set()
+
+    def animate(self, addr, size, rate=60.0, step=None):
+        '''
+        Changes <size> bytes of memory at <addr> <rate> times per second,
+        until stopAnimations() or stop() get called. Missed updates are
+        caught up on, so the average rate holds even if the event loop
+        lags.
+        :param rate: updates per second, None for as fast as possible
+        :param step: function called with the number of the update and
+                     returning the new bytes. Defaults to the number as
+                     big-endian integer.
+        '''
+        if step is None:
+            mask = (1 << 8 * size) - 1
+
+            def step(n):
+                return (n & mask).to_bytes(size, "big")
+        animation = gevent.spawn(self._animate, addr, rate, step)
+        self._animations.append(animation)
+        return animation
+
+    def stopAnimations(self):
+        '''
+        Stops all animations started by animate().
+        '''
+        gevent.killall(self._animations)
+        del self._animations[:]
+
+    ######################################
+    # private methods below
+
+    def _newClient(self, sock):
+        return _Client(self, sock)
+
+    def _offset(self, addr, size):
+        offset = addr - self.base
+        if offset < 0 or offset + size > len(self.memory):
+            raise ValueError("Address 0x%x is outside the emulated memory."
+                             % addr)
+        return offset
+
+    def _animate(self, addr, rate, step):
+        n = 0
+        start = time.monotonic()
+        while True:
+            self._running.wait()
+            if rate is None:
+                due = n + 100
+            else:
+                due = int((time.monotonic() - start) * rate) + 1
+            while n < due:
+                self.write(addr, step(n))
+                n += 1
+            if rate is None:
+                gevent.sleep(0)
+            else:
+                gevent.sleep(max(0.0, start + n / rate - time.monotonic()))
+
+    def _load(self, client, filename):
+        self._running.wait()
+        if self.loadDelay:
+            gevent.sleep(self.loadDelay)
+        if self.saveToDisk:
+            try:
+                with open(filename, "rb") as f:
+                    state = f.read()
+            except (IOError, OSError):
+                state = None
+        else:
+            state = self.saveStates.get(filename)
+        if state is None or len(state) != len(self.memory):
+            client.send(encodeLine(b"FAIL", client.binary))
+            return
+        self.write(self.base, state)
+        client.send(encodeLine(b"SUCCESS", client.binary))
+
+
+class ReplayServer(_ServerBase):
+    def __init__(self, trace, speed=1.0, host="127.0.0.1", port=0,
+                 binary=True, addrs=None, logs=True, loops=1,
+                 startDelay=0.1, chunkSize=65536, history=1000):
+        '''
+        Creating a new ReplayServer, serving the trace at the path <trace>,
+        or a TraceReader, to every client that connects. It listens once
+        start() got called.
+        Each client gets the whole trace, starting <startDelay> seconds
+        after it connected, which leaves it time to ask for binary framing.
+        Other commands are only recorded, see received().
+        :param speed: playback speed relative to the recording, e.g. 10 for
+                      ten times as fast. None sends as fast as possible.
+        :param addrs: only replay the MEM and MEM_MULTI records of these
+                      addresses
+        :param logs: whether to replay LOG records as well
+        :param loops: how often to play the trace, None for endlessly
+        :param chunkSize: bytes buffered at most before they get sent
+        '''
+        _ServerBase.__init__(self, host, port, binary, history)
+        if not isinstance(trace, TraceReader):
+            trace = TraceReader(trace)
+        self.trace = trace
+        self.speed = speed
+        self.addrs = addrs
+        self.logs = logs
+        self.loops = loops
+        self.startDelay = startDelay
+        self.chunkSize = chunkSize
+        self._replays = []
+
+    def stats(self):
+        '''
+        Returns a list with a dict for every client that connected so far,
+        in order of connecting: the time.monotonic() time the replay
+        started, the records and bytes sent, seconds it took, records per
+        second, whether the whole trace got sent, and how far behind the
+        recorded pace the replay fell.
+        "behind" is the delay of the last record sent in seconds, "lag"
+        percentiles of the delays of all of them. Both stay 0 for an
+        unlimited speed.
+        A record is late when the client does not read fast enough, so
+        sending blocks. The sockets buffer up to a few MB, a client that
+        falls behind by less only shows up as late once the buffers are
+        full.
+        '''
+        return [replay.snapshot() for replay in self._replays]
+
+    def wait(self, timeout=None):
+        '''
+        Waits until the replays to all clients connected so far are done
+        or got cut off, or <timeout> seconds passed.
+        Returns whether all are done.
+        '''
+        greenlets = [replay.greenlet for replay in self._replays]
+        gevent.joinall(greenlets, timeout=timeout)
+        return all(g.ready() for g in greenlets)
+
+    ######################################
+    # private methods below
+
+    def _newClient(self, sock):
+        return _ClientBase(self, sock)
+
+    def _serve(self, client):
+        replay = _Replay(self.speed)
+        self._replays.append(replay)
+        replay.greenlet = gevent.spawn_later(self.startDelay, self._replay,
+                                             client, replay)
+        try:
+            client.run()
+        finally:
+            replay.greenlet.kill()
+
+    def _replay(self, client, replay):
+        timeRange = self.trace.timeRange()
+        if timeRange is None:
+            replay.done = True
+            return
+        first, last = timeRange
+        kinds = (TraceKind.MEM, TraceKind.MEM_MULTI)
+        if self.logs:
+            kinds += (TraceKind.LOG,)
+        # LOG records keep their level in the address field, so the trace
+        # can't filter them by address
+        addrs = None if self.addrs is None else frozenset(self.addrs)
+        speed = self.speed
+        lag = replay.lag
+        start = replay.started = time.monotonic()
+        loop = 0
+        while self.loops is None or loop < self.loops:
+            offset = loop * (last - first) - first
+            for event in self.trace.events(kinds=kinds):
+                if client._closed:
+                    return
+                if addrs is not None and event.addr not in addrs and \
+                        event.kind != TraceKind.LOG:
+                    continue
+                if speed is not None:
+                    due = start + (event.time + offset) / speed
+                    now = time.monotonic()
+                    if due > now:
+                        # nothing is due before it, send what is buffered
+                        client.flush()
+                        gevent.sleep(max(0.0, due - time.monotonic()))
+                        now = max(due, time.monotonic())
+                    replay.behind = now - due
+                    lag.record(replay.behind)
+                data = _encodeEvent(event, client.binary)
+                client._out += data
+                replay.records += 1
+                replay.bytes += len(data)
+                if len(client._out) >= self.chunkSize:
+                    client.flush()
+            loop += 1
+            replay.loops = loop
+        client.flush()
+        replay.done = True
+        replay.ended = time.monotonic()
+
+
+class _Replay(object):
+    # progress of replaying a trace to one client
+    def __init__(self, speed):
+        self.speed = speed
+        self.greenlet = None
+        self.started = None
+        self.ended = None
+        self.records = 0
+        self.bytes = 0
+        self.loops = 0
+        self.done = False
+        self.behind = 0.0
+        self.lag = Histogram()
+
+    def snapshot(self):
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = (self.ended or time.monotonic()) - self.started
+        return {
+            "speed": self.speed,
+            "started": self.started,
+            "records": self.records,
+            "bytes": self.bytes,
+            "loops": self.loops,
+            "elapsed": elapsed,
+            "recordsPerSec": self.records / elapsed if elapsed else 0.0,
+            "done": self.done,
+            "behind": self.behind,
+            "lag": self.lag.snapshot(),
+        }
+
+
+def _encodeEvent(event, binary):
+    if event.kind == TraceKind.MEM:
+        return encodeMem(event.addr, _u32.unpack(event.data)[0], binary)
+    if event.kind == TraceKind.MEM_MULTI:
+        return encodeMemMulti(event.addr, event.data, binary)
+    # the address field holds the level
+    return encodeLine(b"LOG %d %s" % (event.addr, event.data), binary)
+
+
+class _ClientBase(object):
+    # one connected client: reads its commands and buffers what gets sent
+    # to it, only understands FRAMING
+    def __init__(self, server, sock):
+        self._server = server
+        self._sock = sock
+        self.binary = False
+        self._closed = False
+        self._out = bytearray()
+        self._flushScheduled = False
+        # several greenlets may flush, but only one may send at a time
+        self._sending = gevent.lock.Semaphore()
+
+    def run(self):
+        lines = LineBuffer()
+        while not self._closed:
+            try:
+                data = self._sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            for line in lines.feed(data):
+                for cmd in line.split(b";"):
+                    if cmd:
+                        self._command(cmd.strip())
+            self.flush()
+
+    def close(self):
+        self._closed = True
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+    def send(self, data):
+        self._out += data
+        if not self._flushScheduled:
+            self._flushScheduled = True
+            gevent.spawn(self.flush)
+
+    def flush(self):
+        self._flushScheduled = False
+        with self._sending:
+            if self._out and not self._closed:
+                data = self._out
+                self._out = bytearray()
+                try:
+                    self._sock.sendall(data)
+                except OSError:
+                    self.close()
+
+    def _command(self, line):
+        server = self._server
+        server._history.append(line)
+        command, _, args = line.partition(b" ")
+        server._counts[command] += 1
+        args = args.split()
+        try:
+            scripted = server._handlers.get(command)
+            if scripted:
+                answer = scripted([arg.decode() for arg in args])
+                if answer is not None:
+                    self.send(encodeLine(answer.encode(), self.binary))
+                return
+            handler = self._handlers.get(command)
+            if handler:
+                handler(self, *args)
+            else:
+                logger.debug("%s ignores command: %s",
+                             type(server).__name__,
+                             line.decode(errors="replace"))
+        except (ValueError, TypeError) as e:
+            logger.warning("%s got bad command %s: %s",
+                           type(server).__name__,
+                           line.decode(errors="replace"), e)
+
+    def _onFraming(self, mode):
+        if mode == FRAMING_REQUEST.split()[1] and self._server.binary:
+            # the answer itself is still a line
+            self.send(FRAMING_REQUEST + b"\n")
+            self.binary = True
+
+    _handlers = {
+        b"FRAMING":            _onFraming,
+    }
+
+
+class _Client(_ClientBase):
+    # a client of a FakeDolphinServer, with its subscriptions. Like in
+    # Dolphin, SUBSCRIBE and SUBSCRIBE_MULTI of the same address are two
+    # subscriptions, and subscribing again replaces the old one.
+    def __init__(self, server, sock):
+        _ClientBase.__init__(self, server, sock)
+        # (addr, multi) -> [size in bytes, multi, last sent data]
+        self._subs = {}
+        # sorted keys of _subs, to find the ones a write touches
+        self._keys = []
+        self._maxSize = 0
+
+    def changed(self, start, end):
+        keys = self._keys
+        first = bisect.bisect_left(keys, (start - self._maxSize + 1,))
+        last = bisect.bisect_left(keys, (end,))
+        for key in keys[first:last]:
+            sub = self._subs[key]
+            if key[0] + sub[0] > start:
+                self._update(key[0], sub)
+
+    def _update(self, addr, sub):
+        data = self._server.read(addr, sub[0])
+        if data == sub[2]:
+            return
+        sub[2] = data
+        if sub[1]:
+            self.send(encodeMemMulti(addr, data, self.binary))
+        else:
+            self.send(encodeMem(addr, int.from_bytes(data, "big"),
+                                self.binary))
+
+    def _onRead(self, mode, addr):
+        self._update(int(addr), [int(mode) // 8, False, None])
+
+    def _onSubscribe(self, mode, addr):
+        self._subscribe(int(addr), int(mode) // 8, False)
+
+    def _onSubscribeMulti(self, size, addr):
+        self._subscribe(int(addr), int(size), True)
+
+    def _subscribe(self, addr, size, multi):
+        key = (addr, multi)
+        if key not in self._subs:
+            bisect.insort(self._keys, key)
+        self._maxSize = max(self._maxSize, size)
+        sub = self._subs[key] = [size, multi, None]
+        self._update(addr, sub)
+
+    def _onUnsubscribe(self, addr):
+        self._unsubscribe(int(addr), False)
+
+    def _onUnsubscribeMulti(self, addr):
+        self._unsubscribe(int(addr), True)
+
+    def _unsubscribe(self, addr, multi):
+        key = (addr, multi)
+        if self._subs.pop(key, None) is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def _onWrite(self, mode, addr, val):
+        self._server.write(int(addr), int(val).to_bytes(int(mode) // 8, "big"))
+
+    def _onWriteMulti(self, addr, *vals):
+        self._server.write(int(addr), bytes(int(v) for v in vals))
+
+    def _onSave(self, *filename):
+        filename = b" ".join(filename).decode()
+        if self._server.saveToDisk:
+            with open(filename, "wb") as f:
+                f.write(self._server.memory)
+        else:
+            self._server.saveStates[filename] = bytes(self._server.memory)
+
+    def _onLoad(self, *filename):
+        filename = b" ".join(filename).decode()
+        gevent.spawn(self._server._load, self, filename)
+
+    def _onPause(self):
+        self._server.pause()
+
+    def _onResume(self):
+        self._server.resume()
+
+    _handlers = {
+        b"FRAMING":            _ClientBase._onFraming,
+        b"READ":               _onRead,
+        b"SUBSCRIBE":          _onSubscribe,
+        b"SUBSCRIBE_MULTI":    _onSubscribeMulti,
+        b"UNSUBSCRIBE":        _onUnsubscribe,
+        b"UNSUBSCRIBE_MULTI":  _onUnsubscribeMulti,
+        b"WRITE":              _onWrite,
+        b"WRITE_MULTI":        _onWriteMulti,
+        b"SAVE":               _onSave,
+        b"LOAD":               _onLoad,
+        b"PAUSE":              _onPause,
+        b"RESUME":             _onResume,
+    }
@@ -0,0 +1,346 @@
+'''
+Recording memory changes to a compact binary trace file, and reading them
+back.
+
+A trace is a file header followed by records, appended in the order they
+arrived. Every record is a big-endian header of
+
+    f64 time.monotonic() timestamp
+    u32 address, or the log level for LOG records
+    u8  TraceKind
+    u32 payload length
+
+followed by the payload: the raw memory for MEM_MULTI, the value as u32
+for MEM, and the message for LOG.
+
+    recorder = dolphin.startRecording("run.trace")
+    ...
+    dolphin.stopRecording()
+
+    for event in TraceReader("run.trace").events(addrs=[0x80401234]):
+        print(event.time, event.data)
+
+A record that got cut off, e.g. by a crash, ends the trace when reading.
+Records have to be in time order, and time.monotonic() starts over when
+the machine reboots, so a trace from before a reboot usually can't be
+continued.
+'''
+
+from __future__ import print_function, division
+
+import os
+import mmap
+import time
+import bisect
+import struct
+import threading
+from collections import namedtuple
+
+from .util import enum
+
+TraceKind = enum(
+    MEM       = 1,
+    MEM_MULTI = 2,
+    LOG       = 3,
+)
+
+MAGIC = b"DWTRACE\x00"
+VERSION = 1
+
+# magic, version, wall clock time and monotonic time at creation
+_fileHeader = struct.Struct(">8sHdd")
+_recordHeader = struct.Struct(">dIBI")
+_u32 = struct.Struct(">I")
+
+TraceEvent = namedtuple("TraceEvent", "time kind addr data")
+
+
+class TraceRecorder(object):
+    def __init__(self, path, bufferSize=1 << 20, syncInterval=1.0,
+                 logs=False):
+        '''
+        Creating a new TraceRecorder appending to the trace file at <path>,
+        which gets created if it doesn't exist yet. If the trace has
+        timestamps ahead of the clock, as after a reboot, a ValueError gets
+        raised instead. A record cut off at its end gets dropped.
+        Records are collected in memory and written by a thread of their
+        own, so writing never blocks the event loop. It writes once
+        <bufferSize> bytes are buffered or <syncInterval> seconds passed
+        since the last write, whatever comes first, also if nothing got
+        recorded meanwhile. Each write is followed by an fsync(), so a
+        crash loses at most the last <syncInterval> seconds.
+        :param logs: whether to record LOG messages as well
+        '''
+        self.path = path
+        self.logs = logs
+        self._bufferSize = bufferSize
+        self._syncInterval = syncInterval
+        self._buf = bytearray()
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_fileHeader.pack(MAGIC, VERSION, time.time(),
+                                              time.monotonic()))
+            self._file.flush()
+        else:
+            try:
+                self._continue()
+            except Exception:
+                self._file.close()
+                raise
+        self.records = 0
+        # guards _buf and the flags, the writer waits on it
+        self._wake = threading.Condition(threading.Lock())
+        # held while writing, so buffers taken in order get written in order
+        self._writing = threading.Lock()
+        self._due = False
+        self._closing = False
+        self._writer = threading.Thread(target=self._write,
+                                        name="TraceRecorder writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def mem(self, addr, val, timestamp=None):
+        '''
+        Records a MEM value.
+        '''
+        self._append(TraceKind.MEM, addr, _u32.pack(val & 0xffffffff),
+                     timestamp)
+
+    def memMulti(self, addr, data, timestamp=None):
+        '''
+        Records the raw bytes of a MEM_MULTI.
+        '''
+        self._append(TraceKind.MEM_MULTI, addr, data, timestamp)
+
+    def log(self, level, msg, timestamp=None):
+        '''
+        Records a LOG message given as bytes.
+        '''
+        self._append(TraceKind.LOG, level, msg, timestamp)
+
+    def flush(self, sync=True):
+        '''
+        Writes all buffered records to the file right away, and fsyncs it
+        unless <sync> is false. Blocks until done.
+        '''
+        with self._writing:
+            self._writeBuffered(sync)
+
+    def close(self):
+        '''
+        Writes everything buffered and closes the file. Blocks until done.
+        '''
+        with self._wake:
+            if self._closing:
+                return
+            self._closing = True
+            self._wake.notify()
+        self._writer.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ######################################
+    # private methods below
+
+    def _append(self, kind, addr, payload, timestamp):
+        header = _recordHeader.pack(
+            time.monotonic() if timestamp is None else timestamp,
+            addr, kind, len(payload))
+        with self._wake:
+            buf = self._buf
+            buf += header
+            buf += payload
+            if len(buf) >= self._bufferSize and not self._due:
+                self._due = True
+                self._wake.notify()
+        self.records += 1
+
+    def _continue(self):
+        # checks that the existing trace can be appended to, and drops a
+        # record cut off at its end
+        with TraceReader(self.path) as reader:
+            timeRange = reader.timeRange()
+            end = reader._end
+        if timeRange is not None and timeRange[1] > time.monotonic():
+            raise ValueError("%s has timestamps ahead of the clock, it was "
+                             "probably recorded before a reboot. Record to "
+                             "a new file." % self.path)
+        if end < self._file.tell():
+            self._file.truncate(end)
+
+    def _write(self):
+        # the writer thread
+        wake = self._wake
+        while True:
+            with wake:
+                if not self._due and not self._closing:
+                    wake.wait(self._syncInterval)
+                self._due = False
+                closing = self._closing
+            with self._writing:
+                self._writeBuffered(True)
+            if closing:
+                return
+
+    def _writeBuffered(self, sync):
+        # called holding _writing
+        with self._wake:
+            data = self._buf
+            self._buf = bytearray()
+        if data:
+            self._file.write(data)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+
+class TraceReader(object):
+    # a sparse index entry every this many records
+    _indexEvery = 4096
+
+    def __init__(self, path):
+        '''
+        Opening the trace file at <path> for reading. The file is memory
+        mapped, so only the parts read get loaded.
+        '''
+        self.path = path
+        self.wallStart, self.monotonicStart = _readHeader(path)
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = None
+        if size > _fileHeader.size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        self._index = None
+
+    def close(self):
+        '''
+        Unmaps and closes the file.
+        '''
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.events()
+
+    def events(self, addrs=None, start=None, end=None, kinds=None):
+        '''
+        Iterates the recorded TraceEvents, optionally only those for the
+        addresses in <addrs>, of the TraceKinds in <kinds> and with a
+        timestamp between <start> and <end>. Timestamps are
+        time.monotonic() times of the recording process, see
+        monotonicStart.
+        The data of each event is a bytes object.
+        '''
+        mm = self._map
+        if mm is None:
+            return
+        if addrs is not None:
+            addrs = frozenset(addrs)
+        if kinds is not None:
+            kinds = frozenset(kinds)
+        pos = self._seek(start) if start is not None else _fileHeader.size
+        size = len(mm)
+        unpack = _recordHeader.unpack_from
+        header = _recordHeader.size
+        while pos + header <= size:
+            timestamp, addr, kind, length = unpack(mm, pos)
+            dataPos = pos + header
+            pos = dataPos + length
+            if pos > size:
+                break
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                break
+            if addrs is not None and addr not in addrs:
+                continue
+            if kinds is not None and kind not in kinds:
+                continue
+            yield TraceEvent(timestamp, kind, addr, mm[dataPos:pos])
+
+    def values(self, addr, start=None, end=None):
+        '''
+        Iterates the (timestamp, value) pairs recorded for <addr>, with
+        the value as int for MEM and as bytes for MEM_MULTI.
+        '''
+        for event in self.events((addr,), start, end,
+                                 (TraceKind.MEM, TraceKind.MEM_MULTI)):
+            if event.kind == TraceKind.MEM:
+                yield event.time, _u32.unpack(event.data)[0]
+            else:
+                yield event.time, event.data
+
+    def timeRange(self):
+        '''
+        Returns the (first, last) timestamp of the trace, or None if it is
+        empty.
+        '''
+        self._buildIndex()
+        if not self._index:
+            return None
+        return self._index[0][0], self._lastTime
+
+    def _seek(self, start):
+        # offset of a record at or before the first one at <start>
+        self._buildIndex()
+        i = bisect.bisect_left(self._index, (start,)) - 1
+        if i < 0:
+            return _fileHeader.size
+        return self._index[i][1]
+
+    def _buildIndex(self):
+        # scans only the record headers, remembering the time and offset of
+        # every _indexEvery-th record
+        if self._index is not None:
+            return
+        index = []
+        self._lastTime = None
+        # offset after the last complete record
+        self._end = _fileHeader.size
+        mm = self._map
+        if mm is not None:
+            pos = _fileHeader.size
+            size = len(mm)
+            unpack = _recordHeader.unpack_from
+            header = _recordHeader.size
+            n = 0
+            while pos + header <= size:
+                timestamp, _, _, length = unpack(mm, pos)
+                if pos + header + length > size:
+                    break
+                if n % self._indexEvery == 0:
+                    index.append((timestamp, pos))
+                self._lastTime = timestamp
+                pos += header + length
+                n += 1
+            self._end = pos
+        self._index = index
+
+
+def _readHeader(path):
+    # returns the wall clock and monotonic start time of a trace file
+    with open(path, "rb") as f:
+        data = f.read(_fileHeader.size)
+    if len(data) < _fileHeader.size:
+        raise ValueError("%s is not a trace file." % path)
+    magic, version, wallStart, monotonicStart = _fileHeader.unpack(data)
+    if magic != MAGIC:
+        raise ValueError("%s is not a trace file." % path)
+    if version != VERSION:
+        raise ValueError("%s has unsupported trace version %d." %
+                         (path, version))
+    return wallStart, monotonicStart
@@ -0,0 +1,196 @@
+'''
+Predicates for triggers: subscriptions whose callback only gets called
+for values matching a condition.
+
+Predicates get evaluated right where a value is parsed, so values that
+don't match cost a few comparisons instead of a dispatched callback. All
+triggers of the same memory are tested one after another on the value
+decoded once, and merged subscriptions only test the triggers of the
+parts that changed.
+
+    dolphin.trigger(16, 0x80405678, below(20, edge=True), lowHealth)
+    dolphin.trigger(8, 0x80401000, bitsChanged(0x04), doorToggled)
+    dolphin.triggerMulti(16, 0x80402000, pattern(b"GAME OVER"), gameOver)
+
+Predicates on numbers test the value of trigger(), the pattern ones the
+bytes of triggerMulti(). Predicates that compare with earlier values keep
+them per trigger, so one predicate may be used for any number of
+triggers.
+'''
+
+from __future__ import print_function, division
+
+import operator
+
+_ops = {
+    "<":  operator.lt,
+    "<=": operator.le,
+    ">":  operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+class Predicate(object):
+    '''
+    A condition on the values of a trigger, made by the functions below.
+    multi tells whether it tests bytes instead of ints.
+    With <edge>, a trigger only fires when the condition becomes true,
+    not for every value it holds for. The first value after subscribing
+    then only tells whether it held already.
+    '''
+    def __init__(self, text, make, multi=False, edge=False):
+        self._text = text
+        self._make = make
+        self.multi = multi
+        self.edge = edge
+
+    def __repr__(self):
+        return "%s%s" % (self._text, ", edge" if self.edge else "")
+
+    def _compile(self, size):
+        # returns a new test function for values of <size> bytes, with
+        # its own state
+        test = self._make(size)
+        if not self.edge:
+            return test
+        held = [None]
+
+        def edgeTest(value):
+            result = test(value)
+            before = held[0]
+            held[0] = result
+            return result and before is False
+        return edgeTest
+
+
+def mask(bits, value=None, edge=False):
+    '''
+    Matches when the bits in <bits> of the value equal those of <value>,
+    by default when they are all set.
+    '''
+    if value is None:
+        value = bits
+    value &= bits
+    return Predicate("mask(0x%x, 0x%x)" % (bits, value),
+                     lambda size: lambda v: v & bits == value, edge=edge)
+
+
+def bitsChanged(bits):
+    '''
+    Matches when any of the bits in <bits> differs from the value before.
+    '''
+    def make(size):
+        last = [None]
+
+        def test(v):
+            before = last[0]
+            last[0] = v
+            return before is not None and (v ^ before) & bits != 0
+        return test
+    return Predicate("bitsChanged(0x%x)" % bits, make)
+
+
+def compare(op, threshold, signed=False, edge=False):
+    '''
+    Matches when the value compares to <threshold> as the operator <op>,
+    one of <, <=, >, >=, == and !=, says.
+    :param signed: whether the value is a two's complement number
+    '''
+    func = _ops.get(op)
+    if func is None:
+        raise ValueError("Unknown operator: %s" % op)
+
+    def make(size):
+        if signed:
+            return lambda v: func(_signed(v, size), threshold)
+        return lambda v: func(v, threshold)
+    return Predicate("compare(%r, %r)" % (op, threshold), make, edge=edge)
+
+
+def above(threshold, signed=False, edge=False):
+    '''
+    Matches values greater than <threshold>. With <edge> that is when the
+    value crosses it upwards.
+    '''
+    return compare(">", threshold, signed, edge)
+
+
+def below(threshold, signed=False, edge=False):
+    '''
+    Matches values less than <threshold>. With <edge> that is when the
+    value crosses it downwards.
+    '''
+    return compare("<", threshold, signed, edge)
+
+
+def between(low, high, signed=False, edge=False):
+    '''
+    Matches values from <low> to <high>, both included.
+    '''
+    def make(size):
+        if signed:
+            return lambda v: low <= _signed(v, size) <= high
+        return lambda v: low <= v <= high
+    return Predicate("between(%r, %r)" % (low, high), make, edge=edge)
+
+
+def delta(minimum, signed=False):
+    '''
+    Matches when the value moved by at least <minimum> since the last time
+    the trigger fired, or since the first value. Small steps that add up
+    fire as well.
+    '''
+    def make(size):
+        base = [None]
+
+        def test(v):
+            if signed:
+                v = _signed(v, size)
+            if base[0] is None:
+                base[0] = v
+                return False
+            if abs(v - base[0]) < minimum:
+                return False
+            base[0] = v
+            return True
+        return test
+    return Predicate("delta(%r)" % minimum, make)
+
+
+def pattern(data, offset=None, bitmask=None, edge=False):
+    '''
+    Matches bytes containing <data>, or with <data> at <offset> only.
+    :param bitmask: bytes as long as <data>, only the bits set in them get
+                    compared. Needs an offset.
+    '''
+    data = bytes(data)
+    if bitmask is not None:
+        bitmask = bytes(bitmask)
+        if offset is None:
+            raise ValueError("A pattern with a bitmask needs an offset.")
+        if len(bitmask) != len(data):
+            raise ValueError("bitmask must be as long as the pattern.")
+        data = bytes(a & b for a, b in zip(data, bitmask))
+    text = "pattern(%r%s)" % (data, "" if offset is None
+                              else ", offset=%d" % offset)
+
+    def make(size):
+        if offset is None:
+            return lambda v: data in (v if isinstance(v, bytes)
+                                      else bytes(v))
+        end = offset + len(data)
+        if end > size:
+            raise ValueError("Pattern does not fit into %d bytes." % size)
+        if bitmask is None:
+            return lambda v: v[offset:end] == data
+        return lambda v: bytes(a & b for a, b in
+                               zip(v[offset:end], bitmask)) == data
+    return Predicate(text, make, multi=True, edge=edge)
+
+
+def _signed(v, size):
+    if v >= 1 << (size * 8 - 1):
+        return v - (1 << (size * 8))
+    return v
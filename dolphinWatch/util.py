@@ -4,6 +4,8 @@ Created on 04.09.2015
 @author: Felk
 '''
 
+import struct
+
 
 # http://stackoverflow.com/a/1695250/3688648
 def enum(*sequential, **named):
@@ -11,3 +13,46 @@ def enum(*sequential, **named):
     reverse = dict((value, key) for key, value in enums.items())
     enums['names'] = reverse
     return type('Enum', (), enums)
+
+
+def ndarray(data, dtype="u1"):
+    '''
+    Returns a read-only NumPy array viewing the bytes of a MEM_MULTI
+    payload without copying them. Requires numpy to be installed.
+    :param dtype: element type, e.g. ">u2" for big-endian halfwords
+    '''
+    import numpy
+    return numpy.frombuffer(data, dtype)
+
+
+# Big-endian decoders for the value types found in Gamecube/Wii memory.
+TYPES = {
+    "u8":  struct.Struct(">B"),
+    "s8":  struct.Struct(">b"),
+    "u16": struct.Struct(">H"),
+    "s16": struct.Struct(">h"),
+    "u32": struct.Struct(">I"),
+    "s32": struct.Struct(">i"),
+    "f32": struct.Struct(">f"),
+    "f64": struct.Struct(">d"),
+}
+
+
+def typeSize(kind):
+    '''
+    Returns the size in bytes of a value type. <kind> is either a name
+    from TYPES or a byte count for raw bytes.
+    '''
+    if isinstance(kind, int):
+        return kind
+    return TYPES[kind].size
+
+
+def decode(kind, data, offset=0):
+    '''
+    Decodes a value of type <kind> from <data> at <offset>. <kind> is
+    either a name from TYPES or a byte count, which returns the raw bytes.
+    '''
+    if isinstance(kind, int):
+        return bytes(data[offset:offset + kind])
+    return TYPES[kind].unpack_from(data, offset)[0]
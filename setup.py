@@ -4,7 +4,9 @@ setup(
     name="dolphinWatch",
     version="0.3",
     packages=find_packages(),
+    python_requires='>=3.7',
     install_requires=['gevent>=1.1'],
+    extras_require={'numpy': ['numpy']},
 
     author="Felk",
     description="Python implementation of the DolphinWatch protocol, a socket based protocol to communicate with the dolphin emulator.",
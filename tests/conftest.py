@@ -0,0 +1,27 @@
+from __future__ import print_function, division
+
+import pytest
+
+from dolphinWatch import DolphinConnection
+from dolphinWatch.testing import FakeDolphinServer
+
+
+@pytest.fixture
+def server():
+    server = FakeDolphinServer(size=0x10000)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(params=[False, True], ids=["text", "binary"])
+def binary(request):
+    return request.param
+
+
+@pytest.fixture
+def conn(server, binary):
+    conn = DolphinConnection(*server.address(), binary=binary)
+    conn.connect()
+    yield conn
+    conn.disconnect()
@@ -0,0 +1,26 @@
+from __future__ import print_function, division
+
+import time
+
+import gevent
+
+# start of the memory emulated by FakeDolphinServer
+BASE = 0x80000000
+
+
+def waitFor(condition, timeout=2.0):
+    '''
+    Lets the event loop run until condition() is true or <timeout> seconds
+    passed. Returns the last result of condition().
+    '''
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        gevent.sleep(0.005)
+    return condition()
+
+
+def settle(seconds=0.05):
+    '''
+    Lets the event loop run for a while, to see that nothing else arrives.
+    '''
+    gevent.sleep(seconds)
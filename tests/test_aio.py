@@ -0,0 +1,180 @@
+'''
+AsyncDolphinConnection against the FakeDolphinServer. The server runs on
+a gevent hub in a thread of its own, asyncio has the main thread.
+'''
+
+from __future__ import print_function, division
+
+import asyncio
+import queue
+import threading
+
+import gevent
+import pytest
+
+from dolphinWatch import AsyncDolphinConnection, DolphinNotConnected
+from dolphinWatch.testing import FakeDolphinServer
+
+from helpers import BASE
+
+
+class ServerThread(object):
+    # runs a FakeDolphinServer, call() runs its methods in its thread
+    def __init__(self):
+        self._calls = queue.Queue()
+        self._stopped = False
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,))
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+
+    def call(self, method, *args):
+        future = asyncio.get_running_loop().create_future()
+        loop = future.get_loop()
+
+        def run():
+            try:
+                result = getattr(self.server, method)(*args)
+            except Exception as e:
+                loop.call_soon_threadsafe(future.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(future.set_result, result)
+        self._calls.put(run)
+        return future
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+
+    def _run(self, started):
+        self.server = FakeDolphinServer(size=0x10000)
+        self.server.start()
+        self.address = self.server.address()
+        started.set()
+        while not self._stopped:
+            try:
+                self._calls.get_nowait()()
+            except queue.Empty:
+                gevent.sleep(0.001)
+        self.server.stop()
+
+
+@pytest.fixture
+def server():
+    server = ServerThread()
+    yield server
+    server.stop()
+
+
+def run(server, test):
+    # runs test(conn, server) with a connected AsyncDolphinConnection
+    async def main():
+        conn = AsyncDolphinConnection(*server.address)
+        assert await conn.connect()
+        try:
+            await asyncio.wait_for(test(conn, server), 5)
+        finally:
+            conn.disconnect()
+    asyncio.run(main())
+
+
+def testReadAndWrite(server):
+    async def test(conn, server):
+        conn.write8(BASE, 0x12)
+        conn.write16(BASE + 2, 0x3456)
+        conn.write32(BASE + 4, 0x789abcde)
+        assert await asyncio.gather(conn.read8(BASE), conn.read16(BASE + 2),
+                                    conn.read32(BASE + 4)) == [
+            0x12, 0x3456, 0x789abcde]
+        assert await server.call("read", BASE, 8) == \
+            b"\x12\x00\x34\x56\x78\x9a\xbc\xde"
+    run(server, test)
+
+
+def testReadBlockAndReadMany(server):
+    async def test(conn, server):
+        await server.call("write", BASE, b"\x01\x02\x03\x04")
+        assert await conn.readBlock(3, BASE) == b"\x01\x02\x03"
+        assert await conn.readMany([(BASE + 2, "u16"), (BASE, "u8"),
+                                    (BASE + 0x1000, 2)]) == [
+            0x0304, 1, b"\x00\x00"]
+    run(server, test)
+
+
+def testSubscribe(server):
+    async def test(conn, server):
+        subscription = conn.subscribe16(BASE)
+        values = []
+        async for value in subscription:
+            values.append(value)
+            if len(values) < 3:
+                await server.call("write", BASE, bytes([0, len(values)]))
+            else:
+                subscription.close()
+        assert values == [0, 1, 2]
+        assert conn.subscriptionStats()["listeners"] == 0
+    run(server, test)
+
+
+def testSubscribeMulti(server):
+    async def test(conn, server):
+        subscription = conn.subscribeMulti(4, BASE)
+        assert await subscription.__anext__() == bytes(4)
+        await server.call("write", BASE + 1, b"\x05")
+        assert await subscription.__anext__() == b"\x00\x05\x00\x00"
+        subscription.close()
+        with pytest.raises(StopAsyncIteration):
+            await subscription.__anext__()
+    run(server, test)
+
+
+def testLostConnectionEndsSubscriptions(server):
+    async def test(conn, server):
+        subscription = conn.subscribe8(BASE)
+        assert await subscription.__anext__() == 0
+        await server.call("disconnectClients")
+        with pytest.raises(DolphinNotConnected):
+            await subscription.__anext__()
+        # and stays ended
+        with pytest.raises(DolphinNotConnected):
+            await subscription.__anext__()
+        assert not conn.isConnected()
+    run(server, test)
+
+
+def testDisconnectEndsSubscriptions(server):
+    async def test(conn, server):
+        subscription = conn.subscribe8(BASE)
+        values = []
+
+        async def iterate():
+            async for value in subscription:
+                values.append(value)
+        task = asyncio.ensure_future(iterate())
+        await asyncio.sleep(0.05)
+        conn.disconnect()
+        await task
+        assert values == [0]
+    run(server, test)
+
+
+def testCommandsWhileConnecting(server):
+    async def main():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: errors.append(context))
+        conn = AsyncDolphinConnection(*server.address)
+        connecting = asyncio.ensure_future(conn.connect())
+        await asyncio.sleep(0)
+        conn.write8(BASE, 0x2a)
+        # the flush scheduled by the write runs before the connection is
+        # made, the command gets sent once it is
+        await asyncio.sleep(0)
+        assert await connecting
+        try:
+            assert await asyncio.wait_for(conn.read8(BASE), 5) == 0x2a
+            assert errors == []
+        finally:
+            conn.disconnect()
+    asyncio.run(main())
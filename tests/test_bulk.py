@@ -0,0 +1,70 @@
+'''
+Block reads and readMany(), which merges close fields into few block
+reads.
+'''
+
+from __future__ import print_function, division
+
+import struct
+
+from helpers import BASE, waitFor, settle
+
+
+def testBlockRead(server, conn):
+    server.write(BASE, b"\x01\x02\x03")
+    first = conn.readBlock(2, BASE)
+    second = conn.readBlock(3, BASE)
+    assert first.get(timeout=2) == b"\x01\x02"
+    assert second.get(timeout=2) == b"\x01\x02\x03"
+    settle()
+    assert server.received()[-1] == "UNSUBSCRIBE_MULTI %d" % BASE
+
+
+def testBlockReadBesideSubscription(server, conn):
+    # the server keeps the block read's SUBSCRIBE_MULTI apart from the
+    # SUBSCRIBE, only the former gets removed afterwards
+    values = []
+    conn.subscribe32(BASE, values.append)
+    assert waitFor(lambda: values)
+    assert conn.readBlock(8, BASE).get(timeout=2) == bytes(8)
+    settle()
+    assert server.received()[-1] == "UNSUBSCRIBE_MULTI %d" % BASE
+    server.write(BASE + 3, b"\x01")
+    assert waitFor(lambda: values == [0, 1])
+
+
+def testBlockReadRestoresSubscribeMulti(server, conn):
+    blocks = []
+    conn.subscribeMulti(4, BASE, lambda data: blocks.append(bytes(data)))
+    assert waitFor(lambda: blocks)
+    assert conn.readBlock(8, BASE).get(timeout=2) == bytes(8)
+    settle()
+    assert server.received()[-1] == "SUBSCRIBE_MULTI 4 %d" % BASE
+    server.write(BASE + 3, b"\x01")
+    assert waitFor(lambda: blocks[-1] == b"\x00\x00\x00\x01")
+
+
+def testReadManyMergesCloseFields(server, conn):
+    server.write(BASE, b"\x01\x02\x03\x04")
+    server.write(BASE + 0x10, struct.pack(">f", 1.5))
+    server.write(BASE + 0x1000, b"\x05")
+    sent = len(server.received())
+    request = conn.readMany([(BASE + 0x1000, "u8"), (BASE, "u16"),
+                             (BASE + 0x10, "f32"), (BASE + 2, 2)])
+    assert request.get(timeout=2) == [5, 0x0102, 1.5, b"\x03\x04"]
+    reads = [cmd for cmd in server.received()[sent:]
+             if cmd.startswith("SUBSCRIBE_MULTI")]
+    assert sorted(reads) == ["SUBSCRIBE_MULTI 1 %d" % (BASE + 0x1000),
+                             "SUBSCRIBE_MULTI 20 %d" % BASE]
+
+
+def testReadManyRespectsMaxSize(server, conn):
+    sent = len(server.received())
+    request = conn.readMany([(BASE, "u8"), (BASE + 8, "u8")], maxSize=8)
+    assert request.get(timeout=2) == [0, 0]
+    assert len([cmd for cmd in server.received()[sent:]
+                if cmd.startswith("SUBSCRIBE_MULTI")]) == 2
+
+
+def testReadManyOfNothing(conn):
+    assert conn.readMany([]).get(timeout=2) == []
@@ -0,0 +1,142 @@
+'''
+Latest values kept by a CoalescingStore.
+'''
+
+from __future__ import print_function, division
+
+import gevent
+import pytest
+
+from dolphinWatch import CoalescingStore
+
+from helpers import BASE, waitFor, settle
+
+
+@pytest.fixture
+def store(conn):
+    return CoalescingStore(conn)
+
+
+def testLatestValues(server, store):
+    store.subscribe16(BASE)
+    store.subscribeMulti(4, BASE + 0x10)
+    assert waitFor(lambda: store.get(BASE) == 0)
+    server.write(BASE, b"\x01\x02")
+    server.write(BASE + 0x10, b"\x01\x02\x03\x04")
+    assert waitFor(lambda: store.get(BASE) == 0x0102)
+    assert waitFor(lambda: store.get(BASE + 0x10) == b"\x01\x02\x03\x04")
+    assert type(store.get(BASE + 0x10)) is bytes
+    assert store.snapshot() == {(BASE, 2): 0x0102,
+                                (BASE + 0x10, 4): b"\x01\x02\x03\x04"}
+    assert store.get(BASE + 0x20, "none") == "none"
+
+
+def testSameAddressDifferentSizes(server, store):
+    store.subscribe8(BASE)
+    store.subscribe32(BASE)
+    server.write(BASE, b"\x01\x02\x03\x04")
+    assert waitFor(lambda: store.get(BASE, size=4) == 0x01020304)
+    assert store.get(BASE, size=1) == 1
+    with pytest.raises(ValueError):
+        store.get(BASE)
+
+
+def testCallbacksGetLatest(server, store):
+    values = []
+
+    def slow(value):
+        gevent.sleep(0.01)
+        values.append(value)
+    store.subscribe16(BASE, slow)
+    assert waitFor(lambda: values == [0])
+    for n in range(1, 51):
+        server.write(BASE, n.to_bytes(2, "big"))
+        gevent.sleep(0.001)
+    assert waitFor(lambda: values[-1] == 50)
+    assert len(values) < 51
+    assert values == sorted(values)
+
+
+def testUnsubscribe(server, conn, store):
+    values = []
+    listener = store.subscribe8(BASE, values.append)
+    assert waitFor(lambda: values == [0])
+    assert store.unsubscribe(listener)
+    assert not store.unsubscribe(listener)
+    assert not listener.active()
+    assert conn.subscriptionStats()["listeners"] == 0
+    server.write(BASE, b"\x01")
+    settle()
+    assert values == [0]
+    assert store.get(BASE) is None and store.snapshot() == {}
+    # the slot gets reused without mixing up values
+    store.subscribe8(BASE + 1)
+    server.write(BASE + 1, b"\x02")
+    assert waitFor(lambda: store.get(BASE + 1) == 2)
+    assert store.get(BASE) is None
+
+
+def testSubscribeAgainReplaces(server, conn, store):
+    first, second = [], []
+    store.subscribe8(BASE, first.append)
+    assert waitFor(lambda: first == [0])
+    store.subscribe8(BASE, second.append)
+    assert conn.subscriptionStats()["listeners"] == 1
+    server.write(BASE, b"\x01")
+    assert waitFor(lambda: second[-1:] == [1])
+    assert first == [0]
+
+
+def testStoredWithoutDispatch(server, conn, store):
+    # values are stored where they are parsed, not by dispatched callbacks
+    store.subscribe16(BASE)
+    store.subscribeMulti(4, BASE + 0x10)
+    for n in range(1, 21):
+        server.write(BASE, n.to_bytes(2, "big"))
+        server.write(BASE + 0x10, bytes([n]) * 4)
+    assert waitFor(lambda: store.get(BASE) == 20 and
+                   store.get(BASE + 0x10) == bytes([20]) * 4)
+    assert conn.dispatchStats()["dispatched"] == 0
+
+
+def testCloseStopsDeliverer(server, conn, store):
+    values = []
+    first = store.subscribe8(BASE, values.append)
+    store.subscribe8(BASE + 1, values.append)
+    assert waitFor(lambda: values == [0, 0])
+    deliverer = store._deliverer
+    store.unsubscribe(first)
+    settle()
+    assert not deliverer.dead
+    store.close()
+    assert waitFor(lambda: deliverer.dead)
+    assert store.snapshot() == {}
+    assert conn.subscriptionStats()["listeners"] == 0
+    # and starts again when needed
+    store.subscribe8(BASE, values.append)
+    assert waitFor(lambda: values == [0, 0, 0])
+    store.close()
+
+
+def testLastUnsubscribeStopsDeliverer(server, store):
+    values = []
+    listener = store.subscribe8(BASE, values.append)
+    assert waitFor(lambda: values == [0])
+    deliverer = store._deliverer
+    store.unsubscribe(listener)
+    assert waitFor(lambda: deliverer.dead)
+
+
+def testCallbackErrorsCounted(server, conn, store):
+    values = []
+
+    def failing(value):
+        values.append(value)
+        raise KeyError(value)
+    before = conn.dispatchStats()["errors"]
+    store.subscribe8(BASE, failing)
+    assert waitFor(lambda: values == [0])
+    server.write(BASE, b"\x01")
+    # the deliverer keeps going after an error
+    assert waitFor(lambda: values == [0, 1])
+    assert conn.dispatchStats()["errors"] == before + 2
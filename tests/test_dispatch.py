@@ -0,0 +1,93 @@
+'''
+The dispatch modes running callbacks of incoming messages.
+'''
+
+from __future__ import print_function, division
+
+import gevent
+import pytest
+
+from dolphinWatch.dispatch import Dispatcher, BatchDispatcher, PoolDispatcher
+
+from helpers import waitFor
+
+ADDRS = [0x80000000 + 4 * i for i in range(16)]
+
+
+def newDispatcher(mode, errors):
+    if mode == "pool":
+        return PoolDispatcher(errors.append, 4)
+    if mode == "batch":
+        return BatchDispatcher(errors.append)
+    return Dispatcher(errors.append)
+
+
+def dispatchAll(dispatcher, callback, count=20):
+    # dispatches <count> values for every address, as a recv would
+    dispatcher.begin()
+    for n in range(count):
+        for addr in ADDRS:
+            dispatcher.dispatch(addr, lambda val, addr=addr:
+                                callback(addr, val), n)
+    dispatcher.flush()
+
+
+@pytest.mark.parametrize("mode", ["batch", "pool"])
+def testOrderPerAddress(mode):
+    received = dict((addr, []) for addr in ADDRS)
+
+    def callback(addr, val):
+        received[addr].append(val)
+        gevent.sleep(0)
+    dispatcher = newDispatcher(mode, [])
+    dispatchAll(dispatcher, callback)
+    dispatchAll(dispatcher, lambda addr, val: callback(addr, val + 20))
+    assert waitFor(lambda: dispatcher.stats()["queued"] == 0)
+    assert all(values == list(range(40)) for values in received.values())
+    assert dispatcher.stats()["dispatched"] == 40 * len(ADDRS)
+
+
+def testSpawnRunsEverything():
+    received = []
+    dispatcher = newDispatcher("spawn", [])
+    dispatchAll(dispatcher, lambda addr, val: received.append((addr, val)))
+    assert waitFor(lambda: len(received) == 20 * len(ADDRS))
+    assert dispatcher.stats()["queued"] == 0
+
+
+def testPoolKeepsAddressOnOneWorker():
+    workers = dict((addr, set()) for addr in ADDRS)
+    dispatcher = newDispatcher("pool", [])
+    for _ in range(3):
+        dispatchAll(dispatcher, lambda addr, val:
+                    workers[addr].add(gevent.getcurrent()))
+    assert waitFor(lambda: dispatcher.stats()["queued"] == 0)
+    assert all(len(greenlets) == 1 for greenlets in workers.values())
+    # and the addresses are spread over more than one of them
+    assert len(set().union(*workers.values())) > 1
+
+
+@pytest.mark.parametrize("mode", ["spawn", "batch", "pool"])
+def testErrorsGoToOnError(mode):
+    errors = []
+    received = []
+
+    def callback(addr, val):
+        if val == 1:
+            raise KeyError(addr)
+        received.append(val)
+    dispatcher = newDispatcher(mode, errors)
+    dispatchAll(dispatcher, callback, count=3)
+    assert waitFor(lambda: len(received) == 2 * len(ADDRS))
+    assert sorted(e.args[0] for e in errors) == ADDRS
+    assert all(isinstance(e, KeyError) for e in errors)
+    assert dispatcher.stats()["errors"] == len(ADDRS)
+
+
+@pytest.mark.parametrize("mode", ["spawn", "batch", "pool"])
+def testDispatchOutsideRecv(mode):
+    # without begin(), callbacks don't wait for a flush()
+    received = []
+    dispatcher = newDispatcher(mode, [])
+    dispatcher.dispatch(ADDRS[0], received.append, 1)
+    assert waitFor(lambda: received == [1], timeout=0.5)
@@ -0,0 +1,72 @@
+'''
+Encoding outgoing commands, and the button helpers.
+'''
+
+from __future__ import print_function, division
+
+from dolphinWatch import GCPadButtons, WiimoteButtons, buttonMask, combine
+from dolphinWatch.protocol import _gcButtonCmd
+
+from helpers import BASE, waitFor
+
+
+def testCombine():
+    assert combine() == 0
+    assert combine(GCPadButtons.A, GCPadButtons.B) == 0x300
+    assert combine(GCPadButtons.A, 0x1000, GCPadButtons.A) == 0x1100
+    assert combine(WiimoteButtons.ONE, WiimoteButtons.TWO) == 0x300
+
+
+def testButtonMask():
+    assert buttonMask(None) == 0
+    assert buttonMask(0x42) == 0x42
+    assert buttonMask(GCPadButtons.START) == 0x1000
+    assert buttonMask([GCPadButtons.L, GCPadButtons.R]) == 0x60
+    assert buttonMask((WiimoteButtons.A,)) == 0x800
+
+
+def testButtonCommands(server, conn):
+    conn.gcButton(0, GCPadButtons.A, 0.5, -1, 1 / 3)
+    conn.gcButton(1, [GCPadButtons.A, GCPadButtons.X], substickY=0.25)
+    conn.wiiButton(2, WiimoteButtons.HOME)
+    conn.wiiButton(3, [WiimoteButtons.ONE, WiimoteButtons.TWO])
+    conn.wiiButton(3, 0x300)
+    assert waitFor(lambda: len(server.received()) >= 5)
+    # the same as formatting with %f every time
+    assert server.received()[-5:] == [
+        "BUTTONSTATES_GC 0 256 %f %f %f %f" % (0.5, -1, 1 / 3, 0),
+        "BUTTONSTATES_GC 1 1280 %f %f %f %f" % (0, 0, 0, 0.25),
+        "BUTTONSTATES_WII 2 32768",
+        "BUTTONSTATES_WII 3 768",
+        "BUTTONSTATES_WII 3 768",
+    ]
+
+
+def testButtonCommandsCached(server, conn):
+    _gcButtonCmd.cache_clear()
+    for _ in range(10):
+        conn.gcButton(0, GCPadButtons.B, 0.1, 0.2)
+    info = _gcButtonCmd.cache_info()
+    assert info.misses == 1 and info.hits == 9
+    # positions that differ by less than %f shows are cached apart, but
+    # still sent as the same
+    conn.gcButton(0, GCPadButtons.B, 0.1000001, 0.2)
+    assert _gcButtonCmd.cache_info().misses == 2
+    assert waitFor(lambda: len(server.received()) >= 11)
+    assert len(set(server.received()[-11:])) == 1
+
+
+def testCommands(server, conn):
+    conn.writeMulti(BASE, [0, 1, 255])
+    conn.writeMulti(BASE + 3, b"\x10\x20")
+    conn.write16(BASE + 6, 0x1234)
+    conn.pause()
+    conn.resume()
+    assert waitFor(lambda: server.read(BASE, 8) ==
+                   b"\x00\x01\xff\x10\x20\x00\x12\x34")
+    assert waitFor(lambda: server.received()[-2:] == ["PAUSE", "RESUME"])
+    assert server.received()[-5:-2] == [
+        "WRITE_MULTI %d 0 1 255" % BASE,
+        "WRITE_MULTI %d 16 32" % (BASE + 3),
+        "WRITE 16 %d 4660" % (BASE + 6),
+    ]
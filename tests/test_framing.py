@@ -0,0 +1,72 @@
+'''
+Text and binary framing of what the server sends.
+'''
+
+from __future__ import print_function, division
+
+import logging
+
+import pytest
+
+from dolphinWatch import DolphinConnection, Framing
+from dolphinWatch.testing import FakeDolphinServer
+
+from helpers import BASE, waitFor
+
+
+def testNegotiated(conn, binary):
+    assert conn.framing() == (Framing.BINARY if binary else Framing.TEXT)
+
+
+def testFallbackToText():
+    server = FakeDolphinServer(binary=False)
+    server.start()
+    conn = DolphinConnection(*server.address(), binary=True,
+                             handshakeTimeout=0.1)
+    try:
+        conn.connect()
+        assert conn.isConnected()
+        assert conn.framing() == Framing.TEXT
+        values = []
+        conn.subscribe8(BASE, values.append)
+        assert waitFor(lambda: values == [0])
+    finally:
+        conn.disconnect()
+        server.stop()
+
+
+@pytest.mark.parametrize("size", [8, 16, 32])
+def testValues(server, conn, size):
+    values = []
+    getattr(conn, "subscribe%d" % size)(BASE, values.append)
+    assert waitFor(lambda: values)
+    value = (1 << size) - 2
+    server.write(BASE, value.to_bytes(size // 8, "big"))
+    assert waitFor(lambda: values == [0, value])
+
+
+def testBlocks(server, conn):
+    blocks = []
+    conn.subscribeMulti(300, BASE, lambda data: blocks.append(bytes(data)))
+    assert waitFor(lambda: blocks)
+    data = bytes(range(256)) + bytes(44)
+    server.write(BASE, data)
+    assert waitFor(lambda: blocks == [bytes(300), data])
+
+
+def testManyMessagesInOneRead(server, conn):
+    # frames and lines split anywhere across reads
+    values = {}
+    for i in range(500):
+        conn.subscribe16(BASE + 2 * i,
+                         lambda value, i=i: values.__setitem__(i, value))
+    assert waitFor(lambda: len(values) == 500)
+    server.write(BASE, b"".join(i.to_bytes(2, "big") for i in range(500)))
+    assert waitFor(lambda: all(values[i] == i for i in range(500)))
+
+
+def testLogs(server, conn, caplog):
+    server.setHandler("PAUSE", lambda args: "LOG 4 paused")
+    with caplog.at_level(logging.INFO, logger="dolphinWatch"):
+        conn.pause()
+        assert waitFor(lambda: "paused" in caplog.messages)
@@ -0,0 +1,35 @@
+'''
+What importing the package pulls in.
+'''
+
+from __future__ import print_function, division
+
+import subprocess
+import sys
+
+
+def run(script):
+    return subprocess.check_output([sys.executable, "-c", script],
+                                   universal_newlines=True).strip()
+
+
+def testStarImport():
+    names = {}
+    exec("from dolphinWatch import *", names)
+    for name in ("DolphinConnection", "DispatchMode", "Overflow",
+                 "DisconnectReason", "GCPadButtons", "Listener"):
+        assert name in names
+    assert "AsyncDolphinConnection" not in names
+
+
+def testNothingLoadedEagerly():
+    assert run("import sys, dolphinWatch; "
+               "print(sorted(m for m in ('gevent', 'asyncio', "
+               "'dolphinWatch.protocol') if m in sys.modules))") == "[]"
+
+
+def testSocketNotPatched():
+    assert run("import socket, dolphinWatch; "
+               "dolphinWatch.DolphinConnection; "
+               "import gevent.monkey; "
+               "print(gevent.monkey.is_module_patched('socket'))") == "False"
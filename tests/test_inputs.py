@@ -0,0 +1,111 @@
+'''
+Playing back pad inputs with an InputScheduler.
+'''
+
+from __future__ import print_function, division
+
+import time
+
+import pytest
+
+from dolphinWatch import GCPadButtons, GCPadSticks, InputScheduler, Pad
+from dolphinWatch.inputs import stickPositions
+
+from helpers import waitFor, settle
+
+
+def _buttonStates(server):
+    return [line for line in server.received()
+            if line.startswith("BUTTONSTATES")]
+
+
+@pytest.fixture
+def inputs(conn):
+    inputs = InputScheduler(conn, refresh=0.1, minInterval=0.02)
+    inputs.start()
+    yield inputs
+    inputs.stop()
+
+
+def testStickPositions():
+    assert stickPositions(None) == (0.0, 0.0, 0.0, 0.0)
+    assert stickPositions(GCPadSticks.LEFT) == (-1.0, 0.0, 0.0, 0.0)
+    assert stickPositions((0.5, 1)) == (0.5, 1.0, 0.0, 0.0)
+    assert stickPositions([1, 2, 3, 4]) == (1.0, 2.0, 3.0, 4.0)
+
+
+def testSentAndReleased(server, inputs):
+    inputs.set(Pad.GC, 0, GCPadButtons.A, GCPadSticks.UP)
+    inputs.set(Pad.WII, 1, 0x0800)
+    assert waitFor(lambda: len(_buttonStates(server)) == 2)
+    assert set(_buttonStates(server)) == {
+        "BUTTONSTATES_GC 0 256 0.000000 1.000000 0.000000 0.000000",
+        "BUTTONSTATES_WII 1 2048",
+    }
+    assert inputs.state(Pad.GC, 0) == (256, (0.0, 1.0, 0.0, 0.0))
+    inputs.release(Pad.GC, 0)
+    inputs.release(Pad.WII, 1)
+    assert waitFor(lambda: len(_buttonStates(server)) == 4)
+    # neutral pads are not refreshed
+    settle(0.25)
+    assert len(_buttonStates(server)) == 4
+    assert inputs.stats()["refreshes"] == 0
+
+
+def testKeepsSticksAndButtons(inputs):
+    inputs.set(Pad.GC, 0, GCPadButtons.B, GCPadSticks.LEFT)
+    inputs.set(Pad.GC, 0, sticks=GCPadSticks.RIGHT)
+    inputs.set(Pad.GC, 0, buttons=[GCPadButtons.A, GCPadButtons.X])
+    assert waitFor(lambda: inputs.state(Pad.GC, 0) ==
+                   (0x500, (1.0, 0.0, 0.0, 0.0)))
+
+
+def testRefresh(server, inputs):
+    inputs.set(Pad.GC, 2, GCPadButtons.START)
+    assert waitFor(lambda: inputs.stats()["refreshes"] >= 2, timeout=1.0)
+    lines = _buttonStates(server)
+    assert len(set(lines)) == 1 and len(lines) >= 3
+
+
+def testCoalesced(server, inputs):
+    for n in range(100):
+        inputs.set(Pad.WII, 0, n)
+    assert waitFor(lambda: inputs.state(Pad.WII, 0)[0] == 99)
+    assert waitFor(lambda: _buttonStates(server)[-1:] ==
+                   ["BUTTONSTATES_WII 0 99"])
+    stats = inputs.stats()
+    assert stats["inputs"] == 100
+    assert stats["sends"] + stats["coalesced"] == 100
+    assert stats["sends"] < 10
+
+
+def testPlayOnTime(server, inputs):
+    start = time.monotonic() + 0.05
+    end = inputs.play([
+        (0, Pad.GC, 0, GCPadButtons.A, None),
+        (3, Pad.GC, 1, GCPadButtons.B, None),
+        (6, Pad.GC, 0, GCPadButtons.NONE, None),
+    ], start=start, fps=60)
+    assert end == pytest.approx(start + 0.1, abs=1e-9)
+    assert inputs.stats()["scheduled"] == 3
+    assert waitFor(lambda: len(_buttonStates(server)) == 3)
+    assert [line.split()[1:3] for line in _buttonStates(server)] == [
+        ["0", "256"], ["1", "512"], ["0", "0"]]
+    assert time.monotonic() >= start + 0.1
+    assert inputs.stats()["lateness"]["count"] == 3
+
+
+def testClear(server, inputs):
+    inputs.play([(0.1, Pad.GC, 0, GCPadButtons.A, None)])
+    inputs.clear()
+    settle(0.2)
+    assert _buttonStates(server) == []
+    with pytest.raises(ValueError):
+        inputs.set(3, 0, 0)
+
+
+def testNotConnected(server, conn, inputs):
+    conn.disconnect()
+    inputs.set(Pad.GC, 0, GCPadButtons.A)
+    assert waitFor(lambda: inputs.stats()["errors"] >= 1)
+    assert inputs.stats()["sends"] == 0
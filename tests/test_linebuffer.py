@@ -0,0 +1,44 @@
+'''
+Splitting received data into lines.
+'''
+
+from __future__ import print_function, division
+
+from dolphinWatch.protocol import LineBuffer
+
+
+def testWholeLines():
+    buf = LineBuffer()
+    assert buf.feed(b"MEM 1 2\nMEM 3 4\n") == [b"MEM 1 2", b"MEM 3 4"]
+    assert buf.feed(b"") == []
+
+
+def testLineAcrossFeeds():
+    buf = LineBuffer()
+    assert buf.feed(b"MEM_MU") == []
+    assert buf.feed(b"LTI 1 2") == []
+    assert buf.feed(b" 3\nMEM") == [b"MEM_MULTI 1 2 3"]
+    assert buf.feed(b" 5 6\n") == [b"MEM 5 6"]
+
+
+def testByteByByte():
+    data = b"LOG 5 one\nLOG 5 two\n"
+    buf = LineBuffer()
+    lines = []
+    for i in range(len(data)):
+        lines += buf.feed(data[i:i + 1])
+    assert lines == [b"LOG 5 one", b"LOG 5 two"]
+
+
+def testStripped():
+    buf = LineBuffer()
+    assert buf.feed(b"SUCCESS\r\n  FAIL \n\n") == [b"SUCCESS", b"FAIL", b""]
+
+
+def testFedDataNotKept():
+    # the caller may reuse its buffer
+    data = bytearray(b"MEM 1 2\nMEM")
+    buf = LineBuffer()
+    assert buf.feed(data) == [b"MEM 1 2"]
+    data[:] = b"XXXXXXXXXXX"
+    assert buf.feed(b" 3 4\n") == [b"MEM 3 4"]
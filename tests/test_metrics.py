@@ -0,0 +1,99 @@
+'''
+Metrics of a connection, their histograms and the Prometheus export.
+'''
+
+from __future__ import print_function, division
+
+import pytest
+
+from dolphinWatch import Histogram, Metrics
+
+from helpers import BASE, waitFor
+
+
+def testHistogramExactForSmallValues():
+    histogram = Histogram(precision=5)
+    for us in range(1, 64):
+        histogram.record(us / 1e6)
+    assert histogram.count == 63
+    assert histogram.min == 1e-6 and histogram.max == 63e-6
+    assert histogram.percentile(50) == pytest.approx(32e-6)
+    assert histogram.percentile(100) == pytest.approx(63e-6)
+    assert histogram.mean() == pytest.approx(32e-6)
+
+
+@pytest.mark.parametrize("precision", [3, 5, 7])
+def testHistogramRelativeError(precision):
+    for us in (100, 1234, 99999, 3000000, 123456789):
+        histogram = Histogram(precision)
+        histogram.record(us / 1e6)
+        # a second, larger value keeps percentile() from returning max
+        histogram.record(us / 1e5)
+        estimate = histogram.percentile(50) * 1e6
+        assert abs(estimate - us) / us < 2.0 ** -precision
+
+
+def testHistogramPercentiles():
+    histogram = Histogram()
+    for ms in range(1, 1001):
+        histogram.record(ms / 1e3)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 1000
+    assert snapshot["sum"] == pytest.approx(500.5)
+    for key, p in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99),
+                   ("p999", 0.999)):
+        assert snapshot[key] == pytest.approx(p, rel=2.0 ** -5)
+    histogram.reset()
+    assert histogram.count == 0 and histogram.percentile(50) is None
+    assert histogram.mean() is None
+
+
+def testPrometheus():
+    metrics = Metrics()
+    metrics.counters["callbacks"] = 3
+    metrics.callbackTime.record(0.001)
+    metrics.addresses[BASE] = [2, 0.5]
+    text = metrics.prometheus(labels={"instance": 'a "b"'})
+    assert text.endswith("\n")
+    lines = text.splitlines()
+    assert "# TYPE dolphinwatch_callbacks_total counter" in lines
+    assert 'dolphinwatch_callbacks_total{instance="a \\"b\\""} 3' in lines
+    assert ('dolphinwatch_callback_time_seconds_count'
+            '{instance="a \\"b\\""} 1') in lines
+    assert ('dolphinwatch_read_rtt_seconds{instance="a \\"b\\"",'
+            'quantile="0.5"} NaN') in lines
+    assert ('dolphinwatch_address_callbacks_total{addr="0x80000000",'
+            'instance="a \\"b\\""} 2') in lines
+    for line in lines:
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            float(value)
+
+
+def testExporters():
+    metrics = Metrics()
+    snapshots = []
+    metrics.addExporter(snapshots.append)
+    metrics.counters["sends"] = 2
+    metrics.export()
+    metrics.reset()
+    metrics.export()
+    assert [s["sends"] for s in snapshots] == [2, 0]
+    metrics.removeExporter(snapshots.append)
+    metrics.export()
+    assert len(snapshots) == 2
+    with pytest.raises(ValueError):
+        metrics.addExporter(None)
+
+
+def testConnectionMetrics(server, conn):
+    metrics = conn.enableMetrics()
+    values = []
+    conn.subscribe8(BASE, values.append)
+    assert waitFor(lambda: values == [0])
+    assert conn.read8(BASE + 1).get(timeout=2) == 0
+    assert metrics.counters["callbacks"] >= 1
+    assert metrics.counters["bytesIn"] > 0
+    assert metrics.counters["sends"] >= 1
+    assert metrics.readRtt.count == 1
+    assert metrics.hotAddresses(1)[0][:2] == (BASE, 1)
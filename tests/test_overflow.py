@@ -0,0 +1,126 @@
+'''
+The Overflow policies for callbacks that can't keep up.
+'''
+
+from __future__ import print_function, division
+
+import gevent
+import pytest
+
+from dolphinWatch import DolphinConnection, DispatchMode, Overflow
+from dolphinWatch.dispatch import BatchDispatcher
+
+from helpers import BASE, waitFor
+
+COUNT = 200
+
+
+def connect(server, binary, **kwargs):
+    conn = DolphinConnection(*server.address(), binary=binary,
+                             highWatermark=8, lowWatermark=2, **kwargs)
+    conn.connect()
+    return conn
+
+
+def flood(server, conn):
+    # subscribes a slow callback and changes the memory <COUNT> times, a
+    # few times per frame like a game would. Returns the values the
+    # callback got and the backpressure changes.
+    values = []
+    changes = []
+
+    def slow(value):
+        gevent.sleep(0.001)
+        values.append(value)
+    conn.onBackpressure(lambda conn, active: changes.append(active))
+    conn.subscribe16(BASE, slow)
+    assert waitFor(lambda: values == [0])
+    for n in range(1, COUNT + 1):
+        server.write(BASE, n.to_bytes(2, "big"))
+        if n % 10 == 0:
+            gevent.sleep(0.001)
+    assert waitFor(lambda: values[-1] == COUNT, timeout=5)
+    assert waitFor(lambda: not conn.isBackpressured())
+    return values, changes
+
+
+@pytest.mark.parametrize("dispatch", [DispatchMode.SPAWN, DispatchMode.BATCH,
+                                      DispatchMode.POOL])
+def testBlockKeepsEverything(server, binary, dispatch):
+    conn = connect(server, binary, dispatch=dispatch,
+                   overflow=Overflow.BLOCK)
+    try:
+        values, changes = flood(server, conn)
+        if dispatch != DispatchMode.SPAWN:
+            assert values == list(range(COUNT + 1))
+        else:
+            assert sorted(values) == list(range(COUNT + 1))
+        assert changes[0] is True and changes[-1] is False
+        stats = conn.dispatchStats()
+        assert stats["backpressures"] >= 1
+        assert stats["dropped"] == stats["coalesced"] == 0
+    finally:
+        conn.disconnect()
+
+
+@pytest.mark.parametrize("dispatch", [DispatchMode.BATCH, DispatchMode.POOL])
+def testDropOldest(server, binary, dispatch):
+    conn = connect(server, binary, dispatch=dispatch,
+                   overflow=Overflow.DROP_OLDEST)
+    try:
+        values, changes = flood(server, conn)
+        stats = conn.dispatchStats()
+        assert stats["dropped"] > 0
+        assert len(values) == COUNT + 1 - stats["dropped"]
+        # what is left still comes in order
+        assert values == sorted(values)
+        assert stats["maxQueued"] <= 8
+        assert changes[0] is True and changes[-1] is False
+    finally:
+        conn.disconnect()
+
+
+def testDropOldestNeedsWorkers(server):
+    with pytest.raises(ValueError):
+        DolphinConnection(*server.address(), highWatermark=8,
+                          overflow=Overflow.DROP_OLDEST)
+
+
+@pytest.mark.parametrize("dispatch", [DispatchMode.SPAWN, DispatchMode.BATCH,
+                                      DispatchMode.POOL])
+def testCoalesceKeepsLatest(server, binary, dispatch):
+    conn = connect(server, binary, dispatch=dispatch,
+                   overflow=Overflow.COALESCE)
+    try:
+        values, changes = flood(server, conn)
+        stats = conn.dispatchStats()
+        assert stats["coalesced"] > 0
+        assert len(values) == COUNT + 1 - stats["coalesced"]
+        assert stats["dropped"] == 0
+        if dispatch != DispatchMode.SPAWN:
+            assert values == sorted(values)
+    finally:
+        conn.disconnect()
+
+
+def testCoalescedCallbackKeepsOrderAfterBackpressure():
+    # a coalesced callback still waiting when backpressure ends must not
+    # be overtaken by, or take values ahead of, later ones of its address
+    values = []
+    dispatcher = BatchDispatcher(None)
+    dispatcher.limit(2, 1, Overflow.COALESCE)
+    for n in (1, 2, 3):
+        dispatcher.dispatch(BASE, values.append, n)
+    assert dispatcher.stats()["coalesced"] == 0
+    # ends backpressure with the callback for 3 still waiting
+    dispatcher.limit(10, 5, Overflow.COALESCE)
+    assert not dispatcher.backpressured()
+    for n in (4, 5):
+        dispatcher.dispatch(BASE, values.append, n)
+    dispatcher.limit(2, 1, Overflow.COALESCE)
+    for n in (6, 7):
+        dispatcher.dispatch(BASE, values.append, n)
+    assert waitFor(lambda: values[-1:] == [7])
+    gevent.sleep(0.01)
+    assert values == sorted(values)
+    assert dispatcher.stats()["coalesced"] == 7 - len(values)
@@ -0,0 +1,58 @@
+'''
+Parsing incoming lines, without a server.
+'''
+
+from __future__ import print_function, division
+
+import pytest
+
+from dolphinWatch import DolphinConnection
+
+from helpers import BASE
+
+
+@pytest.fixture
+def received():
+    # a connection that records what it would dispatch, its commands
+    # pile up unsent
+    conn = DolphinConnection(flushSize=1 << 30)
+    conn._connected = True
+    conn._scheduleFlush = lambda: None
+    conn.subscribe8(BASE, _ignore)
+    conn.subscribeMulti(4, BASE + 4, _ignore)
+    values = []
+    conn._dispatch = lambda addr, callback, val: values.append((addr, val))
+    return conn, values
+
+
+def _ignore(val):
+    pass
+
+
+def testMem(received):
+    conn, values = received
+    conn._process(b"MEM %d 255" % BASE)
+    assert values == [(BASE, 255)]
+
+
+def testMemMultiGivesBytes(received):
+    conn, values = received
+    conn._process(b"MEM_MULTI %d 0 9 10 255" % (BASE + 4))
+    assert values == [(BASE + 4, b"\x00\x09\x0a\xff")]
+    assert type(values[0][1]) is bytes
+
+
+def testMemMultiUnusualTokens(received):
+    # tokens that aren't written like Dolphin writes them are still parsed
+    conn, values = received
+    conn._process(b"MEM_MULTI %d 007 +1  2 00" % (BASE + 4))
+    assert values == [(BASE + 4, b"\x07\x01\x02\x00")]
+
+
+def testMemMultiInvalid(received):
+    conn, values = received
+    with pytest.raises(ValueError):
+        conn._process(b"MEM_MULTI %d 1 256" % (BASE + 4))
+    with pytest.raises(ValueError):
+        conn._process(b"MEM_MULTI %d 1 x" % (BASE + 4))
+    assert values == []
@@ -0,0 +1,103 @@
+'''
+DolphinPool driving several instances, and the merged stream of
+subscribeAll().
+'''
+
+from __future__ import print_function, division
+
+import pytest
+
+from dolphinWatch import DolphinPool
+from dolphinWatch.testing import FakeDolphinServer
+
+from helpers import BASE, waitFor, settle
+
+
+@pytest.fixture
+def servers():
+    servers = [FakeDolphinServer(size=0x100) for _ in range(3)]
+    for server in servers:
+        server.start()
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def pool(servers):
+    pool = DolphinPool([server.address() for server in servers],
+                       reconnect=True, reconnectDelay=0.01)
+    assert pool.connect() == [True, True, True]
+    yield pool
+    pool.disconnect()
+
+
+def testBroadcast(servers, pool):
+    pool.broadcast("write8", BASE, 7)
+    settle()
+    assert [server.read(BASE, 1) for server in servers] == [b"\x07"] * 3
+    requests = pool.broadcast("read8", BASE)
+    assert [request.get(timeout=2) for request in requests] == [7, 7, 7]
+
+
+def testBroadcastSkipsDisconnected(servers, pool):
+    pool[1].disconnect()
+    assert pool.connected() == [0, 2]
+    pool.save("a.sav")
+    assert waitFor(lambda: "a.sav" in servers[2].saveStates)
+    assert pool.load("a.sav", timeout=2) == [True, None, True]
+    assert "a.sav" not in servers[1].saveStates
+
+
+def testSubscribeAllMerges(servers, pool):
+    stream = pool.subscribeAll("subscribe8", BASE)
+    assert sorted(stream.get(timeout=2) for _ in range(3)) == [
+        (0, 0), (1, 0), (2, 0)]
+    servers[2].write(BASE, b"\x05")
+    assert stream.get(timeout=2) == (2, 5)
+    stream.close()
+    assert list(stream) == []
+    assert all(conn.subscriptionStats()["listeners"] == 0 for conn in pool)
+
+
+def testSubscribeAllFollowsConnects(servers, pool):
+    pool[1].disconnect()
+    stream = pool.subscribeAll("subscribe8", BASE)
+    assert sorted(stream.get(timeout=2) for _ in range(2)) == [(0, 0),
+                                                               (2, 0)]
+    pool[1].connect()
+    assert stream.get(timeout=2) == (1, 0)
+    # a lost instance reconnecting gets subscribed once, not twice
+    servers[0].disconnectClients()
+    assert stream.get(timeout=2) == (0, 0)
+    servers[0].write(BASE, b"\x01")
+    assert stream.get(timeout=2) == (0, 1)
+    settle()
+    assert len(stream) == 0
+    assert pool[0].subscriptionStats()["listeners"] == 1
+
+
+def testSubscribeAllIsBounded(servers, pool):
+    stream = pool.subscribeAll("subscribe8", BASE, maxsize=4)
+    assert waitFor(lambda: len(stream) == 3)
+    for n in range(1, 6):
+        servers[0].write(BASE, bytes([n]))
+        settle(0.01)
+    assert waitFor(lambda: stream.dropped == 4)
+    assert [stream.get(timeout=2) for _ in range(4)] == [
+        (0, 2), (0, 3), (0, 4), (0, 5)]
+    stream.close()
+
+
+def testClosedStreamKeepsUpdates(servers, pool):
+    stream = pool.subscribeAll("subscribe8", BASE, maxsize=3)
+    assert waitFor(lambda: len(stream) == 3)
+    stream.close()
+    # the end marker doesn't push out an update
+    assert stream.dropped == 0
+    assert len(stream) == 3
+    assert sorted(stream.get(timeout=2) for _ in range(3)) == [
+        (0, 0), (1, 0), (2, 0)]
+    with pytest.raises(StopIteration):
+        stream.get(timeout=2)
+    assert list(stream) == []
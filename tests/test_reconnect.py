@@ -0,0 +1,124 @@
+'''
+Restoring the subscriptions after the connection got lost.
+'''
+
+from __future__ import print_function, division
+
+import pytest
+
+from dolphinWatch import DolphinConnection, DisconnectReason
+
+from helpers import BASE, waitFor, settle
+
+
+@pytest.fixture
+def conn(server, binary):
+    conn = DolphinConnection(*server.address(), binary=binary,
+                             reconnect=True, reconnectDelay=0.01)
+    conn.connect()
+    # disconnectClients() only knows clients the server got to serve
+    assert waitFor(lambda: server.clients() == 1)
+    yield conn
+    conn.disconnect()
+
+
+def testSubscriptionsReplayed(server, conn):
+    single, merged, block = [], [], []
+    conn.subscribe16(BASE, single.append)
+    conn.subscribe32(BASE + 0x10, merged.append)
+    conn.subscribe8(BASE + 0x11, merged.append)
+    conn.subscribeMulti(4, BASE + 0x20, block.append)
+    assert waitFor(lambda: single and len(merged) == 2 and block)
+    sent = len(server.received())
+    del single[:], merged[:], block[:]
+
+    server.disconnectClients()
+    assert waitFor(lambda: conn.reconnectStats()["reconnects"] == 1)
+    assert conn.isConnected()
+    assert waitFor(lambda: server.clients() == 1)
+    settle()
+    # only the subscriptions on the server get sent again, and the known
+    # values passed on once more, as they may have changed meanwhile
+    assert sorted(cmd for cmd in server.received()[sent:]
+                  if not cmd.startswith("FRAMING")) == [
+        "SUBSCRIBE 16 %d" % BASE,
+        "SUBSCRIBE_MULTI 4 %d" % (BASE + 0x10),
+        "SUBSCRIBE_MULTI 4 %d" % (BASE + 0x20),
+    ]
+    assert single == [0] and merged == [0, 0] and len(block) == 1
+
+    server.write(BASE, b"\x01\x02")
+    server.write(BASE + 0x11, b"\x03")
+    assert waitFor(lambda: single[-1:] == [0x0102] and
+                   sorted(merged[-2:]) == [3, 0x00030000])
+
+
+def testUnsubscribedStayGone(server, conn):
+    values = []
+    listener = conn.subscribe8(BASE, values.append)
+    conn.subscribe8(BASE + 0x10, values.append)
+    assert waitFor(lambda: len(values) == 2)
+    conn.unsubscribe(listener)
+    settle()
+    server.disconnectClients()
+    assert waitFor(lambda: conn.reconnectStats()["reconnects"] == 1)
+    settle()
+    assert server.commandCounts()["SUBSCRIBE"] == 3
+    server.write(BASE, b"\x01")
+    settle()
+    assert values == [0, 0, 0]
+
+
+def testDisconnectCallbacks(server, conn):
+    reasons = []
+    connects = []
+    conn.onDisconnect(lambda conn, reason: reasons.append(reason))
+    conn.onConnect(connects.append)
+    server.disconnectClients()
+    assert waitFor(lambda: connects)
+    assert reasons == [DisconnectReason.CONNECTION_CLOSED_BY_PEER]
+
+
+def testNoReconnectAfterDisconnect(server, conn):
+    conn.disconnect()
+    settle()
+    assert not conn.isConnected()
+    assert conn.reconnectStats()["attempts"] == 0
+
+
+@pytest.mark.parametrize("automatic", [False, True],
+                         ids=["manual", "automatic"])
+def testSubscribingInOnConnect(server, binary, automatic):
+    # subscribing again in onConnect after connecting anew restores the
+    # subscription, without piling up listeners
+    conn = DolphinConnection(*server.address(), binary=binary,
+                             reconnect=automatic, reconnectDelay=0.01)
+    values = []
+    conn.onConnect(lambda conn: conn.subscribe16(BASE, values.append))
+    conn.connect()
+    try:
+        assert waitFor(lambda: values == [0])
+        for n in range(1, 4):
+            assert waitFor(lambda: server.clients() == 1)
+            server.write(BASE, bytes([0, n]))
+            assert waitFor(lambda: values[-1:] == [n])
+            sent = server.commandCounts()["SUBSCRIBE"]
+            server.disconnectClients()
+            if automatic:
+                assert waitFor(lambda: conn.reconnectStats()["reconnects"]
+                               == n)
+            else:
+                assert waitFor(lambda: not conn.isConnected())
+                conn.connect()
+            assert waitFor(lambda: server.commandCounts()["SUBSCRIBE"] ==
+                           sent + 1)
+        settle()
+        assert conn.subscriptionStats()["listeners"] == 1
+        del values[:]
+        server.write(BASE, b"\x00\x05")
+        assert waitFor(lambda: values == [5])
+        settle()
+        assert values == [5]
+        assert server.commandCounts()["SUBSCRIBE"] == 4
+    finally:
+        conn.disconnect()
@@ -0,0 +1,88 @@
+'''
+The ReplayServer serving recorded traces.
+'''
+
+from __future__ import print_function, division
+
+import logging
+
+import pytest
+
+from dolphinWatch import DolphinConnection
+from dolphinWatch.testing import ReplayServer
+from dolphinWatch.trace import TraceRecorder
+
+from helpers import BASE, waitFor
+
+
+@pytest.fixture
+def trace(tmp_path):
+    path = str(tmp_path / "run.trace")
+    with TraceRecorder(path, logs=True) as recorder:
+        recorder.mem(BASE, 1, timestamp=10.0)
+        recorder.mem(BASE + 4, 2, timestamp=10.05)
+        recorder.log(4, b"hello", timestamp=10.1)
+        recorder.memMulti(BASE + 8, b"\x01\x02", timestamp=10.15)
+        recorder.mem(BASE, 3, timestamp=10.2)
+    return path
+
+
+def replay(trace, binary, **kwargs):
+    # replays <trace> to a new connection, returns what its subscriptions
+    # got and the server
+    server = ReplayServer(trace, binary=binary, **kwargs)
+    server.start()
+    conn = DolphinConnection(*server.address(), binary=binary)
+    received = {BASE: [], BASE + 4: [], BASE + 8: []}
+    try:
+        conn.connect()
+        conn.subscribe32(BASE, received[BASE].append)
+        conn.subscribe32(BASE + 4, received[BASE + 4].append)
+        conn.subscribeMulti(2, BASE + 8,
+                            lambda data: received[BASE + 8].append(
+                                bytes(data)))
+        assert waitFor(lambda: server.clients() == 1)
+        assert server.wait(timeout=5)
+        assert waitFor(lambda: received[BASE][-1:] == [3])
+    finally:
+        conn.disconnect()
+        server.stop()
+    return received, server
+
+
+def testReplaysEverything(trace, binary, caplog):
+    with caplog.at_level(logging.INFO, logger="dolphinWatch"):
+        received, server = replay(trace, binary, speed=None)
+        assert "hello" in caplog.messages
+    assert received == {BASE: [1, 3], BASE + 4: [2],
+                        BASE + 8: [b"\x01\x02"]}
+    stats = server.stats()
+    assert len(stats) == 1
+    assert stats[0]["records"] == 5 and stats[0]["done"]
+
+
+def testAddrsKeepLogs(trace, binary, caplog):
+    # the address field of a LOG record is its level, which must not get
+    # filtered by address
+    with caplog.at_level(logging.INFO, logger="dolphinWatch"):
+        received, server = replay(trace, binary, speed=None,
+                                  addrs=[BASE, BASE + 8])
+        assert "hello" in caplog.messages
+    assert received == {BASE: [1, 3], BASE + 4: [],
+                        BASE + 8: [b"\x01\x02"]}
+    assert server.stats()[0]["records"] == 4
+
+
+def testWithoutLogs(trace, binary, caplog):
+    with caplog.at_level(logging.INFO, logger="dolphinWatch"):
+        received, server = replay(trace, binary, speed=None, logs=False)
+        assert "hello" not in caplog.messages
+    assert server.stats()[0]["records"] == 4
+
+
+def testPace(trace, binary):
+    # 0.2s recorded at twice the speed, twice
+    received, server = replay(trace, binary, speed=2.0, loops=2)
+    stats = server.stats()[0]
+    assert stats["records"] == 10 and stats["loops"] == 2
+    assert 0.15 <= stats["elapsed"] < 1.0
@@ -0,0 +1,128 @@
+'''
+Matching of answers to outstanding reads and loads, which come back in
+the order the commands were sent.
+'''
+
+from __future__ import print_function, division
+
+from collections import deque
+
+import gevent
+import pytest
+
+from dolphinWatch import DolphinTimeout
+from dolphinWatch.testing import encodeLine
+
+from helpers import BASE, waitFor
+
+
+def scriptReads(server, delay=0.0):
+    # answers READs with 1, 2, 3 ... instead of the memory, <delay> seconds
+    # late but still in order
+    answered = [0]
+    late = deque()
+
+    def sendLate(client):
+        gevent.sleep(delay)
+        while late:
+            client.send(encodeLine(late.popleft(), client.binary))
+
+    def answer(args):
+        answered[0] += 1
+        line = b"MEM %s %d" % (args[1].encode(), answered[0])
+        if not delay:
+            return line.decode()
+        if not late:
+            gevent.spawn(sendLate, server._clients[0])
+        late.append(line)
+    server.setHandler("READ", answer)
+
+
+def testReadsOfOneAddressInOrder(server, conn):
+    scriptReads(server)
+    requests = [conn.read8(BASE) for _ in range(5)]
+    assert [request.get(timeout=2) for request in requests] == [1, 2, 3, 4, 5]
+
+
+def testReadsOfDifferentAddresses(server, conn):
+    server.write(BASE, b"\x01\x02")
+    server.write(BASE + 0x100, b"\x03")
+    first = conn.read16(BASE)
+    second = conn.read8(BASE + 0x100)
+    assert second.get(timeout=2) == 3
+    assert first.get(timeout=2) == 0x0102
+
+
+def testReadCallback(server, conn):
+    values = []
+    server.write(BASE, b"\x2a")
+    conn.read8(BASE, values.append)
+    assert waitFor(lambda: values == [42])
+
+
+def testReadTimeout(server, conn):
+    server.setHandler("READ", lambda args: None)
+    request = conn.read8(BASE, timeout=0.05)
+    with pytest.raises(DolphinTimeout):
+        request.get(timeout=2)
+
+
+def testLateAnswerStaysMatched(server, conn):
+    # the answer to a timed out read must not go to the next one
+    scriptReads(server, delay=0.1)
+    first = conn.read8(BASE, timeout=0.05)
+    second = conn.read8(BASE)
+    with pytest.raises(DolphinTimeout):
+        first.get(timeout=2)
+    assert second.get(timeout=2) == 2
+
+
+def testCancelledReadStaysMatched(server, conn):
+    scriptReads(server, delay=0.05)
+    first = conn.read8(BASE)
+    second = conn.read8(BASE)
+    assert first.cancel()
+    assert second.get(timeout=2) == 2
+
+
+def testLoadsInOrder(server, conn):
+    conn.save("a.sav")
+    assert waitFor(lambda: "a.sav" in server.saveStates)
+    first = conn.loadAsync("a.sav")
+    second = conn.loadAsync("missing.sav")
+    third = conn.loadAsync("a.sav")
+    assert [first.get(timeout=2), second.get(timeout=2),
+            third.get(timeout=2)] == [True, False, True]
+
+
+def testLoadTimeout(server, conn):
+    conn.save("a.sav")
+    assert waitFor(lambda: "a.sav" in server.saveStates)
+    server.pause()
+    with pytest.raises(DolphinTimeout):
+        conn.load("a.sav", timeout=0.05)
+    server.resume()
+    # the feedback of the timed out load still arrives and gets consumed
+    assert conn.loadAsync("missing.sav").get(timeout=2) is False
+
+
+def testDisconnectFailsOutstanding(server, conn):
+    server.setHandler("READ", lambda args: None)
+    request = conn.read8(BASE)
+    gevent.sleep(0)
+    conn.disconnect()
+    with pytest.raises(Exception):
+        request.get(timeout=2)
+
+
+def testReadOfSubscribedAddress(server, conn):
+    values = []
+    server.write(BASE, b"\x11\x22\x33\x44")
+    conn.subscribe32(BASE, values.append)
+    assert waitFor(lambda: values == [0x11223344])
+    # an answer of another size could not be told from an update
+    with pytest.raises(ValueError):
+        conn.read8(BASE)
+    assert conn.read32(BASE).get(timeout=2) == 0x11223344
+    server.write(BASE, b"\x55")
+    assert waitFor(lambda: values == [0x11223344, 0x55223344])
@@ -0,0 +1,148 @@
+'''
+Saving, loading and evicting with a SaveStateManager.
+'''
+
+from __future__ import print_function, division
+
+import os
+import json
+
+import gevent
+import pytest
+
+from dolphinWatch import (DolphinConnection, DolphinTimeout,
+                          SaveStateManager, savestates)
+from dolphinWatch.testing import FakeDolphinServer
+
+from helpers import BASE, waitFor
+
+
+@pytest.fixture
+def server():
+    # the manager watches the files Dolphin writes
+    server = FakeDolphinServer(size=0x1000, saveToDisk=True)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def conn(server):
+    conn = DolphinConnection(*server.address())
+    conn.connect()
+    yield conn
+    conn.disconnect()
+
+
+def manager(conn, tmp_path, **kwargs):
+    return SaveStateManager(conn, str(tmp_path), timeout=2,
+                            pollInterval=0.01, **kwargs)
+
+
+def testSaveAndLoad(server, conn, tmp_path):
+    states = manager(conn, tmp_path)
+    server.write(BASE, b"\x01")
+    state = states.save("first", frame=10).get(timeout=2)
+    assert state.size == 0x1000 and state.metadata == {"frame": 10}
+    server.write(BASE, b"\x02")
+    assert states.load("first").get(timeout=2)
+    assert server.read(BASE, 1) == b"\x01"
+    # the index survives the manager, it gets written once the load's
+    # bookkeeping ran
+    assert waitFor(lambda: states["first"].loads == 1)
+    states.flush()
+    assert manager(conn, tmp_path)["first"].loads == 1
+
+
+def testEvictsLeastRecentlyUsed(conn, tmp_path):
+    states = manager(conn, tmp_path, maxStates=2)
+    for name in ("a", "b"):
+        states.save(name).get(timeout=2)
+    assert states.load("a").get(timeout=2)
+    states.save("c").get(timeout=2)
+    assert sorted(state.name for state in states.states()) == ["a", "c"]
+    assert not os.path.exists(str(tmp_path / "b"))
+
+
+def testJustSavedNotEvicted(conn, tmp_path):
+    states = manager(conn, tmp_path, maxStates=1)
+    states.save("pinned", pin=True).get(timeout=2)
+    state = states.save("new").get(timeout=2)
+    assert "new" in states and os.path.exists(state.path)
+    assert "pinned" in states
+    # the next save may evict it
+    states.save("newer").get(timeout=2)
+    assert "new" not in states
+
+
+def testLoadBookkeepingOffTheHub(conn, tmp_path, monkeypatch):
+    states = manager(conn, tmp_path)
+    states.save("a").get(timeout=2)
+    states.save("b").get(timeout=2)
+    assert states.load("a").get(timeout=2)
+    assert states.load("b").get(timeout=2)
+    assert waitFor(lambda: states["b"].loads == 1)
+    hub = gevent.get_hub()
+    calls = []
+    monkeypatch.setattr(states, "_writeIndex",
+                        lambda: calls.append(gevent.getcurrent()))
+    monkeypatch.setattr(states, "prefetch",
+                        lambda name: calls.append(gevent.getcurrent()))
+    assert states.load("a").get(timeout=2)
+    assert waitFor(lambda: len(calls) == 2)
+    assert hub not in calls
+
+
+def testSaveWithoutTimeoutEnds(server, conn, tmp_path, monkeypatch):
+    monkeypatch.setattr(savestates, "SAVE_DEADLINE", 0.1)
+    # a save Dolphin never writes
+    server.setHandler("SAVE", lambda args: None)
+    states = SaveStateManager(conn, str(tmp_path), timeout=None,
+                              pollInterval=0.01)
+    with pytest.raises(DolphinTimeout):
+        states.save("lost").get(timeout=2)
+    assert "lost" not in states
+
+
+@pytest.mark.parametrize("name", ["", "..", "sub/state", "sub\\state",
+                                  savestates.INDEX_FILENAME,
+                                  savestates.INDEX_FILENAME + ".tmp"])
+def testNameMustBePlain(conn, tmp_path, name):
+    states = manager(conn, tmp_path)
+    with pytest.raises(ValueError):
+        states.save(name)
+
+
+def testIndexNamesChecked(conn, tmp_path):
+    outside = tmp_path / "outside"
+    outside.write_bytes(b"keep")
+    directory = tmp_path / "states"
+    directory.mkdir()
+    (directory / "good").write_bytes(b"state")
+    (directory / savestates.INDEX_FILENAME).write_text(json.dumps({
+        "last": None,
+        "states": {"good": {"size": 5}, "../outside": {"size": 4}},
+    }))
+    states = SaveStateManager(conn, str(directory), maxStates=0)
+    assert [state.name for state in states.states()] == ["good"]
+    assert states.evict() == ["good"]
+    assert outside.read_bytes() == b"keep"
+
+
+def testIndexWritesBatched(conn, tmp_path, monkeypatch):
+    states = manager(conn, tmp_path)
+    for name in ("a", "b"):
+        states.save(name).get(timeout=2)
+    states.flush()
+    writes = []
+    replace = savestates._replace
+    monkeypatch.setattr(savestates, "_replace",
+                        lambda path, text: writes.append(replace(path, text)))
+    for _ in range(3):
+        states.pin("a")
+        states.pin("b")
+    # nothing written on the spot
+    assert writes == []
+    states.flush()
+    assert len(writes) == 1
+    assert manager(conn, tmp_path)["b"].pinned
@@ -0,0 +1,113 @@
+'''
+Memory-layout schemas: unpacking, watching for changes and NumPy dtypes.
+'''
+
+from __future__ import print_function, division
+
+import struct
+
+import pytest
+
+from dolphinWatch import Schema, Array
+
+from helpers import BASE, waitFor
+
+Pokemon = Schema("Pokemon", [
+    ("species", 0x00, "u16"),
+    ("level",   0x04, "u8"),
+    ("moves",   0x08, Array("u16", 4)),
+    ("nickname", 0x10, 4),
+], size=0x18)
+Party = Schema("Party", [
+    ("members", 0x04, Array(Pokemon, 2)),
+    ("count",   0x00, "u32"),
+    ("money",   0x34, "f32"),
+])
+
+
+def pokemon(species, level, moves, nickname):
+    data = bytearray(Pokemon.size)
+    struct.pack_into(">H", data, 0, species)
+    data[4] = level
+    struct.pack_into(">4H", data, 8, *moves)
+    data[0x10:0x14] = nickname
+    return bytes(data)
+
+
+PARTY = (struct.pack(">I", 2) + pokemon(25, 5, (1, 2, 3, 4), b"PIKA") +
+         pokemon(4, 7, (5, 6, 0, 0), b"CHAR") + struct.pack(">f", 1.5))
+
+
+def testLayout():
+    assert Pokemon.size == 0x18
+    assert Party.size == 0x38
+    assert Party.names == ("count", "members", "money")
+
+
+def testUnpack():
+    party = Party.unpack(PARTY)
+    assert party.count == 2 and party.money == 1.5
+    first, second = party.members
+    assert (first.species, first.level, first.moves, first.nickname) == (
+        25, 5, (1, 2, 3, 4), b"PIKA")
+    assert second == Pokemon.unpack(PARTY, 4 + Pokemon.size)
+    assert second != first
+    assert repr(second).startswith("Pokemon(species=4, level=7")
+
+
+def testOverlapsAndSize():
+    with pytest.raises(ValueError):
+        Schema("Bad", [("a", 0, "u32"), ("b", 2, "u8")])
+    with pytest.raises(ValueError):
+        Schema("Bad", [("a", 0, "u32")], size=2)
+
+
+def testWatchReportsChangedFields():
+    calls = []
+    watcher = Party.watch(lambda record, changed: calls.append(
+        (record, changed)))
+    watcher(PARTY)
+    assert calls[0][1] == ["count", "members", "money"]
+    watcher(PARTY)
+    assert len(calls) == 1
+    data = bytearray(PARTY)
+    data[4 + Pokemon.size + 4] = 8
+    struct.pack_into(">f", data, 0x34, 2.0)
+    watcher(bytes(data))
+    record, changed = calls[1]
+    assert changed == ["members", "money"]
+    assert record.members[1].level == 8 and record.money == 2.0
+
+
+def testWatchCopiesReusedBuffers():
+    # with binary framing the data is a memoryview into the receive
+    # buffer, which changes under the watcher's feet
+    calls = []
+    watcher = Party.watch(lambda record, changed: calls.append(changed))
+    buf = bytearray(PARTY)
+    watcher(memoryview(buf))
+    buf[3] = 1
+    watcher(memoryview(buf))
+    assert calls == [["count", "members", "money"], ["count"]]
+
+
+def testDtype():
+    numpy = pytest.importorskip("numpy")
+    dtype = Party.dtype()
+    assert dtype.itemsize == Party.size
+    array = numpy.frombuffer(PARTY * 3, dtype)
+    assert list(array["count"]) == [2, 2, 2]
+    assert array[1]["members"][0]["moves"].tolist() == [1, 2, 3, 4]
+    assert array[2]["members"][1]["nickname"].tobytes() == b"CHAR"
+    assert array[0]["money"] == 1.5
+
+
+def testSubscribeSchema(server, conn):
+    calls = []
+    conn.subscribeSchema(BASE, Party, lambda record, changed: calls.append(
+        (record, changed)))
+    assert waitFor(lambda: calls)
+    server.write(BASE, PARTY)
+    assert waitFor(lambda: len(calls) == 2)
+    assert calls[1][0] == Party.unpack(PARTY)
+    assert calls[1][1] == ["count", "members", "money"]
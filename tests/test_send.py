@@ -0,0 +1,88 @@
+'''
+Buffering of outgoing commands.
+'''
+
+from __future__ import print_function, division
+
+import gevent
+
+from dolphinWatch import DolphinConnection
+
+from helpers import BASE, waitFor, settle
+
+
+def testSentOncePerLoopIteration(server, conn):
+    before = conn.sendStats()
+    for n in range(10):
+        conn.write8(BASE + n, n + 1)
+    stats = conn.sendStats()
+    assert stats["commands"] == before["commands"] + 10
+    assert stats["sends"] == before["sends"]
+    gevent.sleep(0)
+    stats = conn.sendStats()
+    assert stats["sends"] == before["sends"] + 1
+    assert stats["saved"] == stats["commands"] - stats["sends"]
+    assert waitFor(lambda: server.read(BASE, 10) == bytes(range(1, 11)))
+
+
+def testFlush(server, conn):
+    before = conn.sendStats()["sends"]
+    conn.write8(BASE, 1)
+    conn.flush()
+    assert conn.sendStats()["sends"] == before + 1
+    assert waitFor(lambda: server.read(BASE, 1) == b"\x01")
+    conn.flush()
+    assert conn.sendStats()["sends"] == before + 1
+
+
+def testFlushSize(server):
+    conn = DolphinConnection(*server.address(), flushSize=64)
+    conn.connect()
+    try:
+        before = conn.sendStats()
+        for n in range(20):
+            conn.write32(BASE, n)
+        # every command is 22 or 23 bytes, so every third one fills the
+        # buffer and gets sent right away
+        assert conn.sendStats()["sends"] - before["sends"] == 6
+        gevent.sleep(0)
+        assert conn.sendStats()["sends"] - before["sends"] == 7
+        assert waitFor(lambda: server.read(BASE, 4) == b"\x00\x00\x00\x13")
+    finally:
+        conn.disconnect()
+
+
+def testBatchExecutedAtOnce(server, conn):
+    with conn.batch():
+        conn.write8(BASE, 1)
+        conn.write8(BASE + 1, 2)
+        # sent, but Dolphin only executes them at the end of the line
+        conn.flush()
+        settle()
+        assert server.read(BASE, 2) == b"\x00\x00"
+    assert waitFor(lambda: server.read(BASE, 2) == b"\x01\x02")
+    assert server.received()[-2:] == ["WRITE 8 %d 1" % BASE,
+                                      "WRITE 8 %d 2" % (BASE + 1)]
+
+
+def testBatchEndsOnException(server, conn):
+    try:
+        with conn.batch():
+            conn.write8(BASE, 1)
+            raise KeyError
+    except KeyError:
+        pass
+    assert waitFor(lambda: server.read(BASE, 1) == b"\x01")
+    conn.write8(BASE + 1, 2)
+    assert waitFor(lambda: server.read(BASE + 1, 1) == b"\x02")
+
+
+def testSentBeforeDisconnecting(server):
+    conn = DolphinConnection(*server.address())
+    conn.connect()
+    conn.write8(BASE, 1)
+    conn.pause()
+    conn.disconnect()
+    assert waitFor(lambda: server.received() == ["WRITE 8 %d 1" % BASE,
+                                                 "PAUSE"])
+    assert server.read(BASE, 1) == b"\x01"
@@ -0,0 +1,93 @@
+'''
+The FakeDolphinServer has to behave like Dolphin where the subscription
+registry relies on it.
+'''
+
+from __future__ import print_function, division
+
+import pytest
+from gevent import socket
+
+from dolphinWatch.protocol import LineBuffer
+from dolphinWatch.testing import encodeMem, encodeMemMulti
+
+from helpers import BASE, settle
+
+
+class RawClient(object):
+    # speaks the text protocol with the server directly
+    def __init__(self, server):
+        self.sock = socket.create_connection(server.address())
+        self.lines = LineBuffer()
+        self.received = []
+
+    def send(self, *cmds):
+        self.sock.sendall(b"".join(cmd + b"\n" for cmd in cmds))
+
+    def expect(self, n, timeout=2.0):
+        self.sock.settimeout(timeout)
+        while len(self.received) < n:
+            self.received.extend(bytes(line) for line in
+                                 self.lines.feed(self.sock.recv(4096)))
+        lines = self.received[:n]
+        del self.received[:n]
+        return lines
+
+    def nothingMore(self):
+        self.sock.settimeout(0.05)
+        with pytest.raises(socket.timeout):
+            self.received.extend(self.lines.feed(self.sock.recv(4096)))
+        return not self.received
+
+    def close(self):
+        self.sock.close()
+
+
+def mem(addr, val):
+    return encodeMem(addr, val).rstrip()
+
+
+def multi(addr, data):
+    return encodeMemMulti(addr, data).rstrip()
+
+
+@pytest.fixture
+def raw(server):
+    client = RawClient(server)
+    yield client
+    client.close()
+
+
+def testSubscribeAndSubscribeMultiAreApart(server, raw):
+    raw.send(b"SUBSCRIBE 8 %d" % BASE, b"SUBSCRIBE_MULTI 2 %d" % BASE)
+    assert raw.expect(2) == [mem(BASE, 0), multi(BASE, b"\x00\x00")]
+    server.write(BASE, b"\x01")
+    assert sorted(raw.expect(2)) == [mem(BASE, 1),
+                                     multi(BASE, b"\x01\x00")]
+
+
+def testUnsubscribeOnlyRemovesItsKind(server, raw):
+    raw.send(b"SUBSCRIBE 8 %d" % BASE, b"SUBSCRIBE_MULTI 2 %d" % BASE)
+    raw.expect(2)
+    raw.send(b"UNSUBSCRIBE_MULTI %d" % BASE)
+    settle()
+    server.write(BASE, b"\x02")
+    assert raw.expect(1) == [mem(BASE, 2)]
+    raw.send(b"SUBSCRIBE_MULTI 2 %d" % BASE, b"UNSUBSCRIBE %d" % BASE)
+    assert raw.expect(1) == [multi(BASE, b"\x02\x00")]
+    settle()
+    server.write(BASE, b"\x03")
+    assert raw.expect(1) == [multi(BASE, b"\x03\x00")]
+    assert raw.nothingMore()
+
+
+def testSubscribeAgainReplacesAndAnswers(server, raw):
+    # the registry resizes a feed by subscribing again without
+    # unsubscribing first, and counts on the value being sent right away
+    raw.send(b"SUBSCRIBE_MULTI 2 %d" % BASE)
+    raw.expect(1)
+    raw.send(b"SUBSCRIBE_MULTI 4 %d" % BASE)
+    assert raw.expect(1) == [multi(BASE, b"\x00\x00\x00\x00")]
+    server.write(BASE + 3, b"\x04")
+    assert raw.expect(1) == [multi(BASE, b"\x00\x00\x00\x04")]
+    assert raw.nothingMore()
@@ -0,0 +1,121 @@
+'''
+Merging and splitting of overlapping subscriptions by the registry.
+'''
+
+from __future__ import print_function, division
+
+import gevent
+import pytest
+
+from dolphinWatch import DolphinConnection, DispatchMode
+
+from helpers import BASE, waitFor, settle
+
+
+def testSameMemorySharesOneSubscription(server, conn):
+    first, second = [], []
+    conn.subscribe16(BASE, first.append)
+    conn.subscribe16(BASE, second.append)
+    assert waitFor(lambda: first and second)
+    assert conn.subscriptionStats() == {"listeners": 2, "entries": 1,
+                                        "feeds": 1}
+    assert server.commandCounts()["SUBSCRIBE"] == 1
+    server.write(BASE, b"\x12\x34")
+    assert waitFor(lambda: first[-1] == second[-1] == 0x1234)
+
+
+@pytest.mark.parametrize("dispatch", [DispatchMode.SPAWN, DispatchMode.BATCH,
+                                      DispatchMode.POOL])
+def testJoiningListenerGetsValue(server, binary, dispatch):
+    # the value for a listener joining an existing feed gets dispatched
+    # outside of a recv, it must not wait for the next message
+    conn = DolphinConnection(*server.address(), binary=binary,
+                             dispatch=dispatch)
+    conn.connect()
+    try:
+        first, second = [], []
+        conn.subscribe32(BASE, first.append)
+        assert waitFor(lambda: first)
+        conn.subscribe32(BASE, second.append)
+        assert waitFor(lambda: second == [0], timeout=0.5)
+    finally:
+        conn.disconnect()
+
+
+def testOverlappingGetMerged(server, conn):
+    word, byte = [], []
+    conn.subscribe32(BASE, word.append)
+    conn.subscribe8(BASE + 1, byte.append)
+    assert conn.subscriptionStats()["feeds"] == 1
+    assert waitFor(lambda: word and byte)
+    server.write(BASE + 1, b"\x07")
+    assert waitFor(lambda: word[-1] == 0x00070000 and byte[-1] == 7)
+    # a change the byte doesn't see only goes to the word
+    server.write(BASE + 3, b"\x01")
+    assert waitFor(lambda: word[-1] == 0x00070001)
+    settle()
+    assert byte == [0, 7]
+
+
+def testUnsubscribeSplits(server, conn):
+    left, right, block = [], [], []
+    conn.subscribe8(BASE, left.append)
+    conn.subscribe8(BASE + 8, right.append)
+    assert conn.subscriptionStats()["feeds"] == 2
+    listener = conn.subscribeMulti(16, BASE, block.append)
+    assert conn.subscriptionStats()["feeds"] == 1
+    assert waitFor(lambda: block)
+    assert conn.unsubscribe(listener)
+    assert not conn.unsubscribe(listener)
+    assert not listener.active()
+    assert conn.subscriptionStats() == {"listeners": 2, "entries": 2,
+                                        "feeds": 2}
+    settle()
+    server.write(BASE, b"\x01")
+    server.write(BASE + 8, b"\x02")
+    assert waitFor(lambda: left[-1:] == [1] and right[-1:] == [2])
+    settle()
+    assert len(block) == 1
+
+
+def testUnchangedValuesArePassedOnOnce(server, conn):
+    values = []
+    conn.subscribe16(BASE, values.append)
+    assert waitFor(lambda: values)
+    # merging and splitting resends the values, unchanged ones are held
+    # back by the registry
+    listener = conn.subscribe8(BASE + 1, lambda value: None)
+    conn.unsubscribe(listener)
+    settle()
+    assert values == [0]
+
+
+def testJoiningMultiListenerGetsLastValue(server, conn):
+    first, second = [], []
+    server.write(BASE + 0x10, b"\x01\x02\x03\x04")
+    conn.subscribeMulti(4, BASE + 0x10, first.append)
+    assert waitFor(lambda: first)
+    conn.subscribeMulti(4, BASE + 0x10, second.append)
+    assert waitFor(lambda: second)
+    settle()
+    # answered from the last value, without asking the server again
+    assert server.commandCounts()["SUBSCRIBE_MULTI"] == 1
+    assert [bytes(data) for data in first] == [b"\x01\x02\x03\x04"]
+    assert second == [b"\x01\x02\x03\x04"]
+
+
+def testLateAnswersOfReplacedFeeds(server, conn):
+    # values of a feed replaced by one of the other kind may still arrive,
+    # they must not reach callbacks expecting the other type
+    values = []
+    conn.subscribe32(BASE, values.append)
+    server.animate(BASE, 4, rate=1000)
+    for _ in range(20):
+        listener = conn.subscribe8(BASE + 1, lambda value: None)
+        gevent.sleep(0.002)
+        conn.unsubscribe(listener)
+        gevent.sleep(0.002)
+    server.stopAnimations()
+    settle()
+    assert values
+    assert all(isinstance(value, int) for value in values)
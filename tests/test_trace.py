@@ -0,0 +1,118 @@
+'''
+Recording traces and reading them back.
+'''
+
+from __future__ import print_function, division
+
+import os
+import time
+
+import pytest
+
+from dolphinWatch.trace import TraceRecorder, TraceReader, TraceKind
+
+from helpers import BASE, waitFor
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "run.trace")
+
+
+def testRecordAndRead(path):
+    with TraceRecorder(path, logs=True) as recorder:
+        recorder.mem(BASE, 5)
+        recorder.memMulti(BASE + 4, b"\x01\x02")
+        recorder.log(4, b"hello")
+    with TraceReader(path) as reader:
+        events = list(reader)
+        assert [(e.kind, e.addr, bytes(e.data)) for e in events] == [
+            (TraceKind.MEM, BASE, b"\x00\x00\x00\x05"),
+            (TraceKind.MEM_MULTI, BASE + 4, b"\x01\x02"),
+            (TraceKind.LOG, 4, b"hello"),
+        ]
+        assert [value for _, value in reader.values(BASE)] == [5]
+
+
+def testWrittenWithoutMoreTraffic(path):
+    # what got recorded reaches the file within the sync interval, even if
+    # nothing else gets recorded after it
+    recorder = TraceRecorder(path, syncInterval=0.05)
+    try:
+        recorder.mem(BASE, 1)
+
+        def recorded():
+            with TraceReader(path) as reader:
+                return len(list(reader)) == 1
+        assert waitFor(recorded, timeout=1.0)
+    finally:
+        recorder.close()
+
+
+def testWrittenOnceBufferFull(path):
+    recorder = TraceRecorder(path, bufferSize=1024, syncInterval=60)
+    try:
+        for i in range(100):
+            recorder.mem(BASE, i)
+
+        def recorded():
+            with TraceReader(path) as reader:
+                return len(list(reader)) >= 50
+        assert waitFor(recorded, timeout=1.0)
+    finally:
+        recorder.close()
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"),
+                    reason="needs /proc to count open files")
+def testInvalidFileNotLeftOpen(path):
+    with open(path, "wb") as f:
+        f.write(b"not a trace, but long enough for a header")
+    files = len(os.listdir("/proc/self/fd"))
+    with pytest.raises(ValueError) as error:
+        TraceReader(path)
+    # the traceback keeps the reader alive
+    assert error.value
+    assert len(os.listdir("/proc/self/fd")) == files
+
+
+def testAppend(path):
+    with TraceRecorder(path) as recorder:
+        recorder.mem(BASE, 1)
+    with TraceRecorder(path) as recorder:
+        recorder.mem(BASE, 2)
+    with TraceReader(path) as reader:
+        values = list(reader.values(BASE))
+    assert [value for _, value in values] == [1, 2]
+    assert values[0][0] <= values[1][0]
+
+
+def testAppendAfterReboot(path):
+    # timestamps ahead of the clock come from before a reboot
+    with TraceRecorder(path) as recorder:
+        recorder.mem(BASE, 1, timestamp=time.monotonic() + 3600)
+    with pytest.raises(ValueError):
+        TraceRecorder(path)
+
+
+def testAppendDropsCutOffRecord(path):
+    with TraceRecorder(path) as recorder:
+        recorder.mem(BASE, 1)
+        recorder.mem(BASE, 2)
+    with open(path, "r+b") as f:
+        f.seek(0, 2)
+        f.truncate(f.tell() - 2)
+    with TraceRecorder(path) as recorder:
+        recorder.mem(BASE, 3)
+    with TraceReader(path) as reader:
+        assert [value for _, value in reader.values(BASE)] == [1, 3]
+
+
+def testTimeRange(path):
+    with TraceRecorder(path) as recorder:
+        for i in range(10):
+            recorder.mem(BASE, i, timestamp=float(i))
+    with TraceReader(path) as reader:
+        assert reader.timeRange() == (0.0, 9.0)
+        assert [value for _, value in reader.values(BASE, 3.0, 5.0)] == [
+            3, 4, 5]
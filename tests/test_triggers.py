@@ -0,0 +1,131 @@
+'''
+Triggers: subscriptions only calling back for matching values.
+'''
+
+from __future__ import print_function, division
+
+import pytest
+
+from dolphinWatch.triggers import (above, below, between, bitsChanged,
+                                   compare, delta, mask, pattern)
+
+from helpers import BASE, waitFor, settle
+
+
+def _run(predicate, values, size=2):
+    test = predicate._compile(size)
+    return [value for value in values if test(value)]
+
+
+def testCompare():
+    assert _run(below(3), [1, 3, 2, 5]) == [1, 2]
+    assert _run(above(3), [1, 3, 4, 5]) == [4, 5]
+    assert _run(compare("==", 3), [1, 3, 4, 3]) == [3, 3]
+    assert _run(compare("!=", 3), [1, 3, 4]) == [1, 4]
+    assert _run(between(2, 4), [1, 2, 4, 5]) == [2, 4]
+    with pytest.raises(ValueError):
+        compare("=>", 3)
+
+
+def testSigned():
+    assert _run(below(0, signed=True), [0xffff, 1, 0x8000], 2) == [
+        0xffff, 0x8000]
+    assert _run(below(0), [0xffff, 1]) == []
+    assert _run(between(-2, 2, signed=True), [0xfe, 0xfd, 2], 1) == [0xfe, 2]
+
+
+def testEdge():
+    # the first value only tells whether the condition held already
+    assert _run(below(10, edge=True), [5, 20, 5, 4, 30, 1]) == [5, 1]
+    assert _run(below(10, edge=True), [20, 5, 4]) == [5]
+    # every trigger keeps its own state
+    predicate = above(1, edge=True)
+    first, second = predicate._compile(1), predicate._compile(1)
+    assert [first(2), first(0), first(2)] == [False, False, True]
+    assert [second(0), second(2)] == [False, True]
+
+
+def testBits():
+    assert _run(mask(0x03), [0x01, 0x03, 0x07]) == [0x03, 0x07]
+    assert _run(mask(0x03, 0x01), [0x01, 0x03, 0x05]) == [0x01, 0x05]
+    assert _run(bitsChanged(0x04), [0, 4, 5, 1, 1]) == [4, 1]
+
+
+def testDelta():
+    assert _run(delta(10), [100, 105, 111, 115, 120, 130]) == [111, 130]
+    assert _run(delta(2, signed=True), [0xffff, 1, 0, 0xfffe], 2) == [
+        1, 0xfffe]
+
+
+def testPattern():
+    assert _run(pattern(b"OVER"), [b"GAME OVER", b"GAME ON"]) == [
+        b"GAME OVER"]
+    assert _run(pattern(b"AB", offset=1), [b"AB__", b"_AB_"], 4) == [
+        b"_AB_"]
+    assert _run(pattern(b"\x10", offset=0, bitmask=b"\xf0"),
+                [b"\x1f", b"\x2f", bytearray(b"\x10")], 1) == [
+        b"\x1f", bytearray(b"\x10")]
+    with pytest.raises(ValueError):
+        pattern(b"AB", bitmask=b"\xff\xff")
+    with pytest.raises(ValueError):
+        pattern(b"AB", offset=0, bitmask=b"\xff")
+    with pytest.raises(ValueError):
+        pattern(b"AB", offset=3)._compile(4)
+
+
+def testWrongKind(conn):
+    with pytest.raises(ValueError):
+        conn.trigger(8, BASE, pattern(b"A"), print)
+    with pytest.raises(ValueError):
+        conn.triggerMulti(4, BASE, below(1), print)
+    with pytest.raises(ValueError):
+        conn.trigger(12, BASE, below(1), print)
+
+
+def testTrigger(server, conn):
+    fired = []
+    conn.trigger(16, BASE, below(20, edge=True), fired.append)
+    settle()
+    # 0 is below already, which an edge trigger only takes note of
+    assert fired == []
+    for value in (50, 10, 5, 30, 19):
+        server.write(BASE, value.to_bytes(2, "big"))
+        settle(0.02)
+    assert waitFor(lambda: fired == [10, 19])
+    # values not matching are never dispatched
+    assert conn.dispatchStats()["dispatched"] == 2
+
+
+def testTriggerMulti(server, conn):
+    fired = []
+    conn.triggerMulti(12, BASE, pattern(b"GAME OVER"),
+                      lambda data: fired.append(bytes(data)))
+    server.write(BASE, b"PLAYING")
+    settle()
+    server.write(BASE, b"GAME OVER")
+    assert waitFor(lambda: fired == [b"GAME OVER\x00\x00\x00"])
+
+
+def testTriggersShareMemory(server, conn):
+    values, low, high = [], [], []
+    conn.subscribe16(BASE, values.append)
+    conn.trigger(8, BASE, below(2), low.append)
+    conn.trigger(8, BASE + 1, above(2), high.append)
+    assert waitFor(lambda: values == [0] and low == [0])
+    server.write(BASE, b"\x05\x09")
+    assert waitFor(lambda: values == [0, 0x0509] and high == [9])
+    server.write(BASE, b"\x01\x09")
+    assert waitFor(lambda: values[-1] == 0x0109 and low == [0, 1])
+    # the unchanged byte is not tested again
+    assert high == [9]
+
+
+def testUnsubscribe(server, conn):
+    fired = []
+    listener = conn.trigger(8, BASE, above(0), fired.append)
+    server.write(BASE, b"\x01")
+    assert waitFor(lambda: fired == [1])
+    conn.unsubscribe(listener)
+    server.write(BASE, b"\x02")
+    settle()
+    assert fired == [1]